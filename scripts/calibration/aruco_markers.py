@@ -6,55 +6,89 @@ import numpy as np
 from compas.geometry import Transformation
 
 
-def detect_markers(frame, aruco_dict=None):
-    if aruco_dict is None:
-        aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_6X6_250)
-
-    parameters = cv2.aruco.DetectorParameters_create()
-    # Tunning for improving accuracy
-    parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_CONTOUR
-    # Tunning for improving performance under assumption that marker covers 10% of max dimension. (min rate 0.4)
-    parameters.minMarkerPerimeterRate = 0.3  # Margin given from 0.4 # default = 0.03
-
-    if max(frame.shape[0:2]) > 1280:
-        # Tunning for 1280x1024 resolution or above
-        parameters.adaptiveThreshWinSizeMin = 5  # default = 3
-        parameters.adaptiveThreshWinSizeMax = 45  # default = 23
-        # Tunning for better pose estimation accuracy
-        parameters.minDistanceToBorder = 40  # default = 3
-    else:
-        # Tunning for better pose estimation accuracy
-        parameters.minDistanceToBorder = 20  # default = 3
+class MarkerDetector(object):
+    """Reusable ArUco marker detector, for detecting markers (and estimating their poses) on every frame.
+
+    The dictionary is looked up once, the tuned detector parameters and the default camera matrix are created once
+    per resolution. Poses of all markers in a frame are estimated in a single call and returned packed:
+    ids (n,), corners (n, 4, 2), rvecs and tvecs (n, 3).
+    """
+
+    def __init__(self, aruco_dict=None, matrix_coefficients=None, distortion_coefficients=None):
+        if aruco_dict is None:
+            aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_6X6_250)
+        self.aruco_dict = aruco_dict
+        self.matrix_coefficients = matrix_coefficients
+        if distortion_coefficients is None:
+            distortion_coefficients = np.zeros((5, 1))
+        self.distortion_coefficients = distortion_coefficients
+        self._parameters = {}
+        self._default_matrices = {}
+
+    def parameters(self, frame_size):
+        """Detector parameters tuned for frames of the given (height, width)"""
+        parameters = self._parameters.get(frame_size)
+        if parameters is None:
+            parameters = cv2.aruco.DetectorParameters_create()
+            # Tunning for improving accuracy
+            parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_CONTOUR
+            # Tunning for improving performance under assumption that marker covers 10% of max dimension. (min rate 0.4)
+            parameters.minMarkerPerimeterRate = 0.3  # Margin given from 0.4 # default = 0.03
+
+            if max(frame_size) > 1280:
+                # Tunning for 1280x1024 resolution or above
+                parameters.adaptiveThreshWinSizeMin = 5  # default = 3
+                parameters.adaptiveThreshWinSizeMax = 45  # default = 23
+                # Tunning for better pose estimation accuracy
+                parameters.minDistanceToBorder = 40  # default = 3
+            else:
+                # Tunning for better pose estimation accuracy
+                parameters.minDistanceToBorder = 20  # default = 3
+            self._parameters[frame_size] = parameters
+        return parameters
+
+    def camera_matrix(self, frame_size):
+        """The given camera matrix or, without one, a rough guess for frames of the given (height, width)"""
+        if self.matrix_coefficients is not None:
+            return self.matrix_coefficients
+        matrix = self._default_matrices.get(frame_size)
+        if matrix is None:
+            height, width = frame_size
+            matrix = np.array([[2000., 0., width / 2.], [0., 2000., height / 2.], [0., 0., 1.]])
+            self._default_matrices[frame_size] = matrix
+        return matrix
+
+    def detect(self, frame):
+        """Detect markers, returns ids (n,), corners (n, 4, 2) and the rejected candidates"""
+        parameters = self.parameters(frame.shape[:2])
+        corners, ids, rejected_img_points = cv2.aruco.detectMarkers(frame, self.aruco_dict, parameters=parameters)
+        if ids is None:
+            return np.zeros(0, dtype=np.int32), np.zeros((0, 4, 2), dtype=np.float32), rejected_img_points
+        return ids.reshape(-1), np.array(corners, dtype=np.float32).reshape(-1, 4, 2), rejected_img_points
+
+    def estimate_pose(self, frame, marker_real_size):
+        """Detect markers and estimate all their poses at once, returns ids, corners, rvecs (n, 3) and tvecs (n, 3)"""
+        ids, corners, _ = self.detect(frame)
+        if not len(ids):
+            return ids, corners, np.zeros((0, 3)), np.zeros((0, 3))
+        rvecs, tvecs, _ = cv2.aruco.estimatePoseSingleMarkers(
+            corners.reshape(-1, 1, 4, 2),
+            marker_real_size,
+            self.camera_matrix(frame.shape[:2]),
+            self.distortion_coefficients,
+        )
+        return ids, corners, rvecs.reshape(-1, 3), tvecs.reshape(-1, 3)
 
-    corners, ids, rejected_img_points = cv2.aruco.detectMarkers(frame, aruco_dict, parameters=parameters)
 
-    return ids, corners, rejected_img_points
+def detect_markers(frame, aruco_dict=None):
+    """Detect markers in a single frame, use a `MarkerDetector` to detect markers repeatedly"""
+    return MarkerDetector(aruco_dict).detect(frame)
 
 
 def estimate_pose(frame, marker_real_size, matrix_coefficients=None, distortion_coefficients=None, aruco_dict=None):
-    if matrix_coefficients is None:
-        imsize = frame.shape
-        matrix_coefficients = np.array([[2000.,    0., imsize[0]/2.],
-                                        [0., 2000., imsize[1]/2.],
-                                        [0.,    0.,           1.]])
-
-    if distortion_coefficients is None:
-        distortion_coefficients = np.zeros((5, 1))
-
-    ids, corners, rejected_img_points = detect_markers(frame, aruco_dict)
-    rvecs, tvecs, marker_points = [], [], []
-    estimated_frames = None
-
-    if np.all(ids is not None):
-        for i in range(len(ids)):
-            # Estimate pose of each marker and return the values rvec and tvec---different from camera coefficients
-            rvec, tvec, marker_points = cv2.aruco.estimatePoseSingleMarkers(corners[i], marker_real_size, matrix_coefficients, distortion_coefficients)
-            (rvec - tvec).any()  # get rid of that nasty numpy value array error
-
-            rvecs.append(rvec)
-            tvecs.append(tvec)
-
-    return ids, corners, rvecs, tvecs, marker_points, estimated_frames
+    """Estimate the poses of the markers in a single frame, use a `MarkerDetector` to do so repeatedly"""
+    detector = MarkerDetector(aruco_dict, matrix_coefficients, distortion_coefficients)
+    return detector.estimate_pose(frame, marker_real_size)
 
 
 def transformation_from_rvec_tvec(rvec, tvec):
@@ -88,7 +122,7 @@ def save_aruco_board(board, marker_size, marker_spacing, resolution_per_mm):
     cv2.imshow(board_name, img)
 
 
-def save_coefficients(mtx, dist, r_vecs, t_vecs, new_cam_mat, roi, path):
+def save_coefficients(mtx, dist, r_vecs, t_vecs, new_cam_mat, roi, path, image_size=None):
     """ Save the camera matrix and the distortion coefficients to given path/file. """
     cv_file = cv2.FileStorage(path, cv2.FILE_STORAGE_WRITE)
     cv_file.write("K", mtx)
@@ -97,6 +131,9 @@ def save_coefficients(mtx, dist, r_vecs, t_vecs, new_cam_mat, roi, path):
     cv_file.write("T", t_vecs)
     cv_file.write("NK", new_cam_mat)
     cv_file.write("ROI", roi)
+    if image_size is not None:
+        # width and height of the calibration images, lets the calibration be used at other resolutions
+        cv_file.write("SIZE", np.array(image_size, dtype=np.float64))
     cv_file.release()
 
 
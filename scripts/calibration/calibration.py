@@ -1,8 +1,12 @@
 """
 https://github.com/gramaziokohler/clamp_controller/blob/master/src/visual_docking/calibration.py
 """
+import os
 import time
 import argparse
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from typing import Tuple
 from typing import Any
 
@@ -16,6 +20,7 @@ from aruco_markers import save_coefficients
 # termination criteria
 criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
 window_name = 'VideoStream'
+image_extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
 
 
 class VideoCaptureAdapter:
@@ -32,19 +37,81 @@ class VideoCaptureAdapter:
         self.device.stop()
 
 
-def calibrate(url, square_size_cm, width=9, height=6, camera_model_name=None):
-    """ Apply camera calibration operation for images in the given directory path. """
-    # prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(8,6,0)
-    objp = np.zeros((height*width, 3), np.float32)
-    objp[:, :2] = np.mgrid[0:width, 0:height].T.reshape(-1, 2)
+class RunningCalibration:
+    """
+    Keeps a rough calibration up to date while views are being captured, so the operator can tell when to stop.
 
-    objp = objp * square_size_cm
+    After each added view, the calibration is recomputed on a background thread from at most max_views views,
+    evenly sampled from all captured ones. If views are added while a solve is running, one more solve follows
+    once it is done. coverage is the fraction of the image area covered by the board in at least one view.
+    """
 
-    # Arrays to store object points and image points from all the images.
-    objpoints = []  # 3d point in real world space
-    imgpoints = []  # 2d points in image plane.
+    def __init__(self, image_size, max_views=12, coverage_scale=0.125):
+        self.image_size = image_size
+        self.max_views = max_views
+        self.coverage_scale = coverage_scale
+        self.objpoints = []
+        self.imgpoints = []
+        self.rms = None
+        self.coverage = 0.0
+        w, h = image_size
+        self._coverage_mask = np.zeros((int(h * coverage_scale), int(w * coverage_scale)), np.uint8)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self._is_stale = False
 
-    image_size = None
+    def add_view(self, objp, corners):
+        self.objpoints.append(objp)
+        self.imgpoints.append(corners)
+        hull = cv2.convexHull(corners * self.coverage_scale).astype(np.int32)
+        cv2.fillConvexPoly(self._coverage_mask, hull, 1)
+        self.coverage = cv2.countNonZero(self._coverage_mask) / float(self._coverage_mask.size)
+        self._is_stale = True
+        self.poll()
+
+    def poll(self):
+        """ Collect the result of a finished solve and start a new one if views were added meanwhile. """
+        if self._pending is not None:
+            if not self._pending.done():
+                return
+            self.rms = self._pending.result()[0]
+            self._pending = None
+        if self._is_stale and len(self.objpoints) >= 3:
+            indices = np.unique(np.linspace(0, len(self.objpoints) - 1, self.max_views).astype(int))
+            self._pending = self._executor.submit(
+                self._solve, [self.objpoints[i] for i in indices], [self.imgpoints[i] for i in indices])
+            self._is_stale = False
+
+    def solve_all(self):
+        """ Start the full calibration using all views. Returns a future, resolving to cv2.calibrateCamera's result. """
+        return self._executor.submit(self._solve, list(self.objpoints), list(self.imgpoints))
+
+    def _solve(self, objpoints, imgpoints):
+        return cv2.calibrateCamera(objpoints, imgpoints, self.image_size, None, None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def draw_status(self, frame, message=None):
+        if message is None:
+            rms = '-' if self.rms is None else '{:.3f}'.format(self.rms)
+            message = 'views: {}  RMS: {}  coverage: {:.0%}'.format(len(self.objpoints), rms, self.coverage)
+        cv2.putText(frame, message, (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 255), 2)
+
+
+def calibrate(url, square_size_cm, width=9, height=6, camera_model_name=None):
+    """
+    Apply camera calibration operation for frames captured from the given stream.
+
+    Press 'c' to capture a view and 'q' to finish. The RMS reprojection error of a running calibration and the
+    image coverage of the captured views are shown on the stream.
+
+    The board's pose in the first captured view defines the world coordinate system, its rvec and tvec are returned.
+    """
+    objp = object_points(width, height, square_size_cm)
+    running = None
+    highlight = None  # last accepted view, shown for a moment
+    highlight_until = 0.0
 
     if url.endswith(".cti"):
         if not camera_model_name:
@@ -59,68 +126,217 @@ def calibrate(url, square_size_cm, width=9, height=6, camera_model_name=None):
         while is_running:
 
             _ret, frame = vcap.read()
-            cv2.imshow(window_name, frame)
+            display = frame.copy()  # keep the frame itself clean for corner detection
+            if running:
+                running.poll()
+                running.draw_status(display)
+            if highlight is not None and time.time() < highlight_until:
+                cv2.drawChessboardCorners(display, (width, height), highlight, True)
+            cv2.imshow(window_name, display)
             key = cv2.waitKey(1)
             if key & 0xFF == ord('q'):
                 is_running = False
 
             if key & 0xFF == ord('c'):
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-                # Find the chess board corners
-                ret, corners = cv2.findChessboardCorners(gray, (width, height), None)
+                corners, _coverage, image_size = find_corners((frame, width, height))
 
                 # If found, add object points, image points (after refining them)
-                if ret:
+                if corners is not None:
                     print('Image captured, object points found')
-                    objpoints.append(objp)
-
-                    corners2 = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
-                    imgpoints.append(corners2)
-
-                    # # Draw and display the corners
-                    cv2.drawChessboardCorners(frame, (width, height), corners2, ret)
-                    cv2.imshow(window_name, frame)
-                    image_size = frame.shape[:2]
-                    cv2.waitKey(1000)
-
-                    print("objpoints:\n")
-                    for p in objpoints:
-                        print(p)
-
-                    print("\nimgpoints:\n")
-                    for p in imgpoints:
-                        print(p)
+                    if running is None:
+                        running = RunningCalibration(image_size)
+                    running.add_view(objp, corners)
+                    highlight = corners
+                    highlight_until = time.time() + 1.0
                 else:
                     print('Image captured but NO object points found')
 
+        if running is None:
+            raise ValueError('No views captured, nothing to calibrate')
+
+        # the full solve may take a while, keep the stream alive meanwhile
+        result = running.solve_all()
+        while not result.done():
+            _ret, frame = vcap.read()
+            running.draw_status(frame, 'solving using {} views...'.format(len(running.objpoints)))
+            cv2.imshow(window_name, frame)
+            cv2.waitKey(1)
+
     finally:
         if vcap:
             vcap.release()
+        if running:
+            running.shutdown()
 
-    ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
+    ret, mtx, dist, rvecs, tvecs = result.result()
 
-    h, w = image_size
+    w, h = image_size = running.image_size
     newcam_mtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (w, h), 1, (w, h))
 
     cv2.destroyAllWindows()
 
-    return ret, mtx, dist, rvecs, tvecs, newcam_mtx, roi
+    return ret, mtx, dist, rvecs[0], tvecs[0], newcam_mtx, roi, image_size
+
+
+def object_points(width, height, square_size_cm):
+    """ Chessboard corners in board coordinates, like (0,0,0), (1,0,0), (2,0,0) ....,(8,6,0) times the square size. """
+    objp = np.zeros((height*width, 3), np.float32)
+    objp[:, :2] = np.mgrid[0:width, 0:height].T.reshape(-1, 2)
+    return objp * square_size_cm
+
+
+def find_corners(job):
+    """
+    Find and refine the chessboard corners in a single frame. Runs in a worker process.
+
+    job is (frame or image path, width, height). Returns the refined corners (None if the board wasn't found),
+    the fraction of the image covered by the board and the image size (w, h), which is None for unreadable images.
+    """
+    frame, width, height = job
+    if isinstance(frame, str):
+        gray = cv2.imread(frame, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            print('Could not read image: {}'.format(frame))
+            return None, 0.0, None
+    elif frame.ndim == 3:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = frame
+    image_size = gray.shape[::-1]
+
+    flags = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE + cv2.CALIB_CB_FAST_CHECK
+    ret, corners = cv2.findChessboardCorners(gray, (width, height), flags)
+    if not ret:
+        return None, 0.0, image_size
+
+    corners = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+    coverage = cv2.contourArea(cv2.convexHull(corners)) / float(image_size[0] * image_size[1])
+    return corners, coverage, image_size
+
+
+def offline_frames(source, frame_step=1):
+    """ Yield the image paths in a directory, or every frame_step-th frame of a recording. """
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith(image_extensions):
+                yield os.path.join(source, name)
+        return
+
+    recording = cv2.VideoCapture(source)
+    try:
+        index = 0
+        while True:
+            ret, frame = recording.read()
+            if not ret:
+                break
+            if index % frame_step == 0:
+                yield frame
+            index += 1
+    finally:
+        recording.release()
+
+
+def calibrate_offline(source, square_size_cm, width=9, height=6, workers=None, min_coverage=0.05, frame_step=1,
+                      batch_size=64, reference=0):
+    """
+    Calibrate from a directory of images or a recording, without user interaction.
+
+    Corner detection runs on a pool of worker processes. Frames in which the board covers less than
+    min_coverage of the image add little information and are dropped before the (single) calibration.
+
+    The board's pose in the reference frame defines the world coordinate system, reference is either the index of
+    the frame (among the directory's images sorted by name, or the recording's frames used with frame_step) or the
+    file name of an image in the directory. Raises a ValueError if that frame is rejected. Returns the reference
+    frame's rvec and tvec instead of those of all views.
+    """
+    objp = object_points(width, height, square_size_cm)
+    objpoints = []
+    imgpoints = []
+    image_size = None
+    rejected = 0
+    reference_index = None  # of the reference among all frames
+    reference_view = None  # of the reference among the accepted views
+
+    frames = enumerate(offline_frames(source, frame_step))
+    with Pool(workers) as pool:
+        # decoded frames of a recording are handed over in batches, which bounds the memory in flight
+        while True:
+            indices, batch = [], []
+            for index, frame in islice(frames, batch_size):
+                if _is_reference(index, frame, reference):
+                    reference_index = index
+                indices.append(index)
+                batch.append((frame, width, height))
+            if not batch:
+                break
+            for index, (corners, coverage, size) in zip(indices, pool.map(find_corners, batch)):
+                if size is None:
+                    rejected += 1
+                    continue
+                if image_size is None:
+                    image_size = size
+                elif size != image_size:
+                    raise ValueError(f"All frames must have the same size, got {size} and {image_size}")
+                if corners is None or coverage < min_coverage:
+                    rejected += 1
+                    continue
+                if index == reference_index:
+                    reference_view = len(objpoints)
+                objpoints.append(objp)
+                imgpoints.append(corners)
+
+    print(f'Object points found in {len(imgpoints)} frames, {rejected} frames rejected')
+    if not imgpoints:
+        raise ValueError('No usable frames found in: {}'.format(source))
+    if reference_index is None:
+        raise ValueError(f'Reference frame {reference} not found in: {source}')
+    if reference_view is None:
+        raise ValueError(f'Reference frame {reference} was rejected (board not found, too small or unreadable)')
+
+    ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, image_size, None, None)
+    newcam_mtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, image_size, 1, image_size)
+    return ret, mtx, dist, rvecs[reference_view], tvecs[reference_view], newcam_mtx, roi, image_size
+
+
+def _is_reference(index, frame, reference):
+    if isinstance(reference, int):
+        return index == reference
+    return isinstance(frame, str) and os.path.basename(frame) == os.path.basename(reference)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Camera calibration')
-    parser.add_argument('--url', type=str, required=True, help='url of the camera stream')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--url', type=str, help='url of the camera stream')
+    source.add_argument('--images', type=str, help='directory of images or a recording to calibrate from offline')
     parser.add_argument('--square_size', type=float, required=False, help='chessboard square size')
     parser.add_argument('--width', type=int, required=False, help='chessboard width size, default is 9')
     parser.add_argument('--height', type=int, required=False, help='chessboard height size, default is 6')
     parser.add_argument('--save_file', type=str, required=True, help='YML file to save calibration matrices')
     parser.add_argument("--camera_model_name", "-m", type=str, required=False, help="Name of the camera model (e.g. Blackfly S BFS-PGE-19S4C)")
 
+    parser.add_argument('--workers', type=int, required=False,
+                        help='offline: number of worker processes, default is all cores')
+    parser.add_argument('--min_coverage', type=float, default=0.05,
+                        help='offline: minimal fraction of the image covered by the board')
+    parser.add_argument('--frame_step', type=int, default=1, help='offline: only use every n-th frame of a recording')
+    parser.add_argument('--reference', type=str, default='0',
+                        help='offline: index or image file name of the frame defining the world coordinates, '
+                             'default is the first one')
+
     args = parser.parse_args()
-    ret, mtx, dist, rvecs, tvecs, new_cam_mat, roi = calibrate(args.url, args.square_size, args.width, args.height, args.camera_model_name)
+    width = args.width or 9
+    height = args.height or 6
+    if args.images:
+        reference = int(args.reference) if args.reference.isdigit() else args.reference
+        ret, mtx, dist, rvec, tvec, new_cam_mat, roi, image_size = calibrate_offline(
+            args.images, args.square_size, width, height, args.workers, args.min_coverage, args.frame_step,
+            reference=reference)
+    else:
+        ret, mtx, dist, rvec, tvec, new_cam_mat, roi, image_size = calibrate(
+            args.url, args.square_size, width, height, args.camera_model_name)
     result_filepath, extension = args.save_file.split(".")
     timestamp = time.strftime("%Y%m%d-%H%M%S")
     result_filepath = ".".join([result_filepath + timestamp, extension])
-    save_coefficients(mtx, dist, rvecs[0], tvecs[0], new_cam_mat, roi, result_filepath)
+    save_coefficients(mtx, dist, rvec, tvec, new_cam_mat, roi, result_filepath, image_size)
     print("Calibration is finished. RMS: ", ret)
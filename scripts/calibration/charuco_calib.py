@@ -6,13 +6,16 @@ https://github.com/opencv/opencv_contrib/blob/e247b680a6bd396f110274b6c214406a93
 """
 import time
 import os
-from copy import deepcopy
+from itertools import islice
+from multiprocessing import Pool
 from argparse import ArgumentParser
 
 import cv2 as cv
 import numpy as np
 
 from td2d.genicam_device import GenTlDevice
+from aruco_markers import save_coefficients
+from calibration import offline_frames
 
 
 CAMERA = "Blackfly S BFS-PGE-31S4C"
@@ -23,75 +26,201 @@ MARKER_SIZE_M = 0.023
 DICT_SIZE = cv.aruco.DICT_5X5_250
 WINDOW = "Charuco Calibration"
 RESULT_DIR = "C:\\Users\\ckasirer\\repos\\compas_urt\\data\\calibration\\"
+MIN_CORNERS = 4
+
+
+class CornerStore(object):
+    """
+    The ChArUco corners and ids of all captured views, packed into two arrays which grow by doubling.
+
+    The corners of view i are corners[starts[i]:starts[i + 1]], a few hundred bytes per view instead of a frame.
+    If spill_dir is given, the accepted frames are additionally written there (losslessly), for later review or
+    to calibrate again offline.
+    """
+
+    def __init__(self, spill_dir=None):
+        self.corners = np.zeros((256, 1, 2), dtype=np.float32)
+        self.ids = np.zeros((256, 1), dtype=np.int32)
+        self.starts = [0]
+        self.spill_dir = spill_dir
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def add(self, corners, ids, frame=None):
+        start, end = self.starts[-1], self.starts[-1] + len(corners)
+        if end > len(self.corners):
+            capacity = max(2 * len(self.corners), end)
+            self.corners = np.resize(self.corners, (capacity, 1, 2))
+            self.ids = np.resize(self.ids, (capacity, 1))
+        self.corners[start:end] = corners.reshape(-1, 1, 2)
+        self.ids[start:end] = ids.reshape(-1, 1)
+        self.starts.append(end)
+        if self.spill_dir and frame is not None:
+            cv.imwrite(os.path.join(self.spill_dir, "frame_%04d.png" % len(self)), frame)
+
+    def views(self):
+        """ Per view corners and ids, as expected by calibrateCameraCharuco (views into the packed arrays) """
+        bounds = list(zip(self.starts[:-1], self.starts[1:]))
+        return [self.corners[s:e] for s, e in bounds], [self.ids[s:e] for s, e in bounds]
 
 
-def calibrate():
-    device = GenTlDevice(CAMERA, GENTL_ENDPOINT)
-    board, dictionary = create_board()
-    detector = cv.aruco.ArucoDetector(dictionary)
+def create_board():
+    d = cv.aruco.getPredefinedDictionary(DICT_SIZE)
+    return cv.aruco.CharucoBoard(BOARD_DIMS, SQUARE_SIZE_M, MARKER_SIZE_M, d), d
 
-    corners_list = []
-    ids_list = []
-    frame_list = []
-
-    while True:
-        image = device.get_next_image()
-        grayscale = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
-        image_size = grayscale.shape
-        corners, ids, rejected = detector.detectMarkers(grayscale)
-        image_copy = deepcopy(image)
-        if ids is not None and len(ids) > 0:
-            corners, ids, rejected, recovered = cv.aruco.refineDetectedMarkers(grayscale, board, corners, ids, rejected)
-            ret, c_corners, c_ids = cv.aruco.interpolateCornersCharuco(corners, ids, grayscale, board)
-            cv.aruco.drawDetectedMarkers(image_copy, corners)
-            cv.aruco.drawDetectedCornersCharuco(image_copy, c_corners, c_ids)
-
-
-        cv.imshow(WINDOW, image_copy)
-
-        key = cv.waitKey(20)
-        if key == 27:
-            break
-        elif key == ord('c'):
-            # record frame and its detected markers
-            if len(ids) == 0:
-                print("No ids detected!")
-                continue
-            print("adding frame to list")
-            corners_list.append(c_corners)
-            ids_list.append(c_ids)
-            frame_list.append(grayscale)
-
-    # start calibration using collected data
-    if not (corners_list or ids_list or frame_list):
-        print("no calibration info captured")
-
-    corners_list = [x for x in corners_list if len(x) >= 4]
-    ids_list = [x for x in ids_list if len(x) >= 4]
-    ret, camera_matrix, dist_coeff, rvec, tvec = cv.aruco.calibrateCameraCharuco(
-        corners_list, ids_list, board, image_size, None, None
-    )
 
-    print(f"ret:{ret}, camera_matrix:{camera_matrix}, dist_coeff:{dist_coeff}, rvec:{rvec}, tvec:{tvec}")
+def detect_charuco(grayscale, board, detector):
+    """ Detect the board's markers and interpolate its chessboard corners, returns markers, corners and ids """
+    corners, ids, rejected = detector.detectMarkers(grayscale)
+    if ids is None or len(ids) == 0:
+        return None, None, None
+    corners, ids, rejected, recovered = cv.aruco.refineDetectedMarkers(grayscale, board, corners, ids, rejected)
+    ret, c_corners, c_ids = cv.aruco.interpolateCornersCharuco(corners, ids, grayscale, board)
+    if not ret:
+        return corners, None, None
+    return corners, c_corners, c_ids
 
-    save_coefficients(camera_matrix, dist_coeff, rvec, tvec, RESULT_DIR)
 
-def create_board():
-    d = cv.aruco.getPredefinedDictionary(DICT_SIZE)
-    return cv.aruco.CharucoBoard(BOARD_DIMS, SQUARE_SIZE_M, MARKER_SIZE_M, d), d
+def solve(store, image_size):
+    """ Calibrate from the stored views, returns the same values as `calibration.calibrate` """
+    board, _ = create_board()
+    corners_list, ids_list = store.views()
+    ret, camera_matrix, dist_coeff, rvecs, tvecs = cv.aruco.calibrateCameraCharuco(
+        corners_list, ids_list, board, image_size, None, None
+    )
+    new_camera_matrix, roi = cv.getOptimalNewCameraMatrix(camera_matrix, dist_coeff, image_size, 1, image_size)
+    return ret, camera_matrix, dist_coeff, rvecs, tvecs, new_camera_matrix, roi, image_size
 
 
-def save_coefficients(mtx, dist, r_vecs, t_vecs, dir_path):
-    timestr = time.strftime("%Y%m%d-%H%M%S")
-    path = os.path.join(dir_path, f"calib_result_{timestr}.dat")
-    """ Save the camera matrix and the distortion coefficients to given path/file. """
-    cv_file = cv.FileStorage(path, cv.FILE_STORAGE_WRITE)
-    cv_file.write("K", mtx)
-    cv_file.write("D", dist)
-    cv_file.write("R", r_vecs[0])
-    cv_file.write("T", t_vecs[0])
-    cv_file.release()
+def calibrate(spill_dir=None):
+    device = GenTlDevice(CAMERA, GENTL_ENDPOINT)
+    board, dictionary = create_board()
+    detector = cv.aruco.ArucoDetector(dictionary)
+    store = CornerStore(spill_dir)
+    display = None
+    image_size = None
+
+    try:
+        while True:
+            image = device.get_next_image()
+            grayscale = cv.cvtColor(image, cv.COLOR_BGR2GRAY) if image.ndim == 3 else image
+            image_size = grayscale.shape[::-1]
+            markers, c_corners, c_ids = detect_charuco(grayscale, board, detector)
+
+            # drawn into a buffer reused across frames, the device's buffer is handed back on the next fetch
+            if display is None or display.shape[:2] != grayscale.shape:
+                display = np.empty(grayscale.shape + (3,), dtype=np.uint8)
+            if image.ndim == 3:
+                np.copyto(display, image)
+            else:
+                cv.cvtColor(image, cv.COLOR_GRAY2BGR, dst=display)
+            if markers is not None:
+                cv.aruco.drawDetectedMarkers(display, markers)
+            if c_corners is not None:
+                cv.aruco.drawDetectedCornersCharuco(display, c_corners, c_ids)
+            cv.imshow(WINDOW, display)
+
+            key = cv.waitKey(20)
+            if key == 27:
+                break
+            elif key == ord('c'):
+                # record the frame's detected corners
+                if c_ids is None or len(c_ids) < MIN_CORNERS:
+                    print("Not enough corners detected!")
+                    continue
+                store.add(c_corners, c_ids, grayscale)
+                print(f"added view {len(store)}")
+    finally:
+        device.stop()
+        cv.destroyAllWindows()
+
+    if not len(store):
+        raise ValueError("no calibration info captured")
+    return solve(store, image_size)
+
+
+_worker_board = None
+
+
+def find_charuco_corners(frame):
+    """
+    Find the ChArUco corners in a frame (or image path). Runs in a worker process.
+
+    Returns corners, ids and the image size, which is None for unreadable images.
+    """
+    global _worker_board
+    if _worker_board is None:
+        board, dictionary = create_board()
+        _worker_board = board, cv.aruco.ArucoDetector(dictionary)
+    board, detector = _worker_board
+
+    if isinstance(frame, str):
+        grayscale = cv.imread(frame, cv.IMREAD_GRAYSCALE)
+        if grayscale is None:
+            print('Could not read image: {}'.format(frame))
+            return None, None, None
+    elif frame.ndim == 3:
+        grayscale = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+    else:
+        grayscale = frame
+    _, c_corners, c_ids = detect_charuco(grayscale, board, detector)
+    return c_corners, c_ids, grayscale.shape[::-1]
+
+
+def calibrate_offline(source, workers=None, frame_step=1, batch_size=64):
+    """
+    Calibrate from a directory of images (e.g. frames spilled by `calibrate`) or a recording, in parallel.
+
+    Like `calibration.calibrate_offline`, frames are handed to a pool of worker processes in batches.
+    """
+    store = CornerStore()
+    image_size = None
+    rejected = 0
+    frames = offline_frames(source, frame_step)
+    with Pool(workers) as pool:
+        while True:
+            batch = list(islice(frames, batch_size))
+            if not batch:
+                break
+            for c_corners, c_ids, size in pool.map(find_charuco_corners, batch):
+                if size is None:
+                    rejected += 1
+                    continue
+                if image_size is None:
+                    image_size = size
+                elif size != image_size:
+                    raise ValueError(f"All frames must have the same size, got {size} and {image_size}")
+                if c_ids is None or len(c_ids) < MIN_CORNERS:
+                    rejected += 1
+                    continue
+                store.add(c_corners, c_ids)
+
+    print(f'Corners found in {len(store)} frames, {rejected} frames rejected')
+    if not len(store):
+        raise ValueError('No usable frames found in: {}'.format(source))
+    return solve(store, image_size)
 
 
 if __name__ == '__main__':
-    calibrate()
+    parser = ArgumentParser(description='ChArUco camera calibration')
+    parser.add_argument('--images', type=str, help='directory of images or a recording to calibrate from offline')
+    parser.add_argument('--spill_dir', type=str, help='live: directory to save the captured frames to')
+    parser.add_argument('--save_dir', type=str, default=RESULT_DIR, help='directory to save the calibration file to')
+    parser.add_argument('--workers', type=int, required=False,
+                        help='offline: number of worker processes, default is all cores')
+    parser.add_argument('--frame_step', type=int, default=1, help='offline: only use every n-th frame of a recording')
+    args = parser.parse_args()
+
+    if args.images:
+        ret, mtx, dist, rvecs, tvecs, new_cam_mat, roi, image_size = calibrate_offline(
+            args.images, args.workers, args.frame_step)
+    else:
+        ret, mtx, dist, rvecs, tvecs, new_cam_mat, roi, image_size = calibrate(args.spill_dir)
+    print(f"ret:{ret}, camera_matrix:{mtx}, dist_coeff:{dist}, rvec:{rvecs[0]}, tvec:{tvecs[0]}")
+
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    result_filepath = os.path.join(args.save_dir, f"calib_result_{timestr}.dat")
+    save_coefficients(mtx, dist, rvecs[0], tvecs[0], new_cam_mat, roi, result_filepath, image_size)
@@ -0,0 +1,164 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from typing import AsyncIterator
+from typing import Optional
+
+from .device import CaptureDevice
+from .device import Frame
+from .gui import UiManager
+from .perception import Tile
+from .perception import TileLocator
+
+
+class AsyncCaptureDevice:
+    """Asyncio interface to a (blocking) `CaptureDevice`.
+
+    Frames are fetched on a dedicated thread, so the event loop is never blocked and neither polls. The thread is the
+    only one ever touching the device, which is what GenTL devices require. Iterate over it to get frames:
+
+        async with AsyncCaptureDevice(device) as frames:
+            async for frame in frames:
+                ...
+
+    Closing stops the device, once a fetch still in progress has completed.
+    """
+
+    def __init__(self, capture_device: CaptureDevice):
+        self.capture_device = capture_device
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="td2d_capture")
+        self._is_closed = False
+        self._stopped = None
+
+    async def get_next_frame(self) -> Frame:
+        """The next frame, raises StopAsyncIteration once a finite source (e.g. `ImageSequenceDevice`) is exhausted"""
+        if self._is_closed:
+            raise RuntimeError("Capture device has been closed")
+        loop = asyncio.get_running_loop()
+        frame = await loop.run_in_executor(self._executor, self._fetch)
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    def _fetch(self) -> Optional[Frame]:
+        # StopIteration can't be set on a future, it would leave the awaiting coroutine hanging
+        try:
+            return self.capture_device.get_next_frame()
+        except StopIteration:
+            return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Frame:
+        if self._is_closed:
+            raise StopAsyncIteration
+        return await self.get_next_frame()
+
+    async def aclose(self) -> None:
+        if not self._is_closed:
+            self._is_closed = True
+            # queued behind any fetch in progress
+            self._stopped = asyncio.get_running_loop().run_in_executor(self._executor, self.capture_device.stop)
+            self._executor.shutdown(wait=False)
+        # shielded so that cancelling the caller can't skip stopping, awaited by every caller
+        await asyncio.shield(self._stopped)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+class AsyncTileLocator:
+    """Asyncio interface to a `TileLocator`, yielding located tiles.
+
+    Fetching frames and locating tiles both run off the event loop, each on its own thread, and are chained by a
+    background task which hands tiles to the consumer through a queue of queue_size tiles. Once the queue is full:
+    - drop_stale: the oldest queued tile is dropped, a slow consumer always gets the most recent tile
+    - otherwise the task waits for the consumer, and no further frames are fetched until it catches up
+
+    The locator should be created with show_ui=False, its thread is not started. Closing (or cancelling the task
+    iterating over `tiles`) stops the background task and the camera:
+
+        async with AsyncTileLocator(TileLocator(endpoint, model, calibration_file, show_ui=False)) as locator:
+            async for tile in locator.tiles():
+                ...
+    """
+
+    def __init__(self, locator: TileLocator, threshold: int = None, queue_size=1, drop_stale=True):
+        self.locator = locator
+        self.threshold = threshold if threshold is not None else UiManager.DEFAULT_THRESHOLD
+        self.queue_size = queue_size
+        self.drop_stale = drop_stale
+        self.dropped_tiles = 0
+        self.frames = AsyncCaptureDevice(locator.device)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="td2d_locate")
+        self._producer = None
+
+    async def tiles(self) -> AsyncIterator[Tile]:
+        """Tiles located in the camera's frames, in order of capture, until closed or the capture device is exhausted"""
+        if self._producer is not None:
+            raise RuntimeError("Tiles are already being located")
+        queue = asyncio.Queue(self.queue_size)
+        self._producer = asyncio.ensure_future(self._produce(queue))
+        try:
+            while True:
+                item = await queue.get()
+                if isinstance(item, StopAsyncIteration):
+                    return  # raising it would turn into a RuntimeError in an async generator
+                if isinstance(item, BaseException):
+                    raise item
+                item.publish_time = time.perf_counter()
+                self.locator.current_tile = item
+                self.locator.latency.record(item)
+                if self.locator.detection_log is not None:
+                    self.locator.detection_log.log(item, self.threshold)
+                yield item
+        finally:
+            await self.aclose()
+
+    async def _produce(self, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            async for frame in self.frames:
+                if frame.is_stale:
+                    continue  # the camera is being reopened, the last tile remains the last known
+                frame_gate = self.locator.frame_gate
+                if frame_gate is not None and not frame_gate.check(frame.image):
+                    self.locator.latency.skip(frame.sequence)
+                    continue  # static or blurred, the last tile remains valid
+                tile, _ = await loop.run_in_executor(self._executor, self.locator.locate, frame, self.threshold, False)
+                if tile is None:
+                    self.locator.latency.skip(frame.sequence)
+                    continue
+                await self._put(queue, tile)
+            # a finite capture device is exhausted. Not dropping the last tile for it, but waiting for the consumer
+            await queue.put(StopAsyncIteration())
+        except Exception as e:
+            await self._put(queue, e)
+
+    async def _put(self, queue: asyncio.Queue, item) -> None:
+        if self.drop_stale and queue.full():
+            queue.get_nowait()
+            self.dropped_tiles += 1
+        await queue.put(item)
+
+    async def aclose(self) -> None:
+        """Stop locating tiles and stop the camera"""
+        if self._producer is not None:
+            self._producer.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._producer
+        await self.frames.aclose()
+        self._executor.shutdown(wait=False)
+        if self.locator.detection_log is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.locator.detection_log.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
@@ -4,6 +4,25 @@ import cv2
 import numpy
 
 
+@dataclass
+class SensorWindow:
+    """The part of the sensor read out by a camera, in the pixel coordinates of the images used during calibration.
+
+    binning: number of sensor pixels combined (or skipped) along each axis into a single image pixel
+    """
+
+    offset_x: int
+    offset_y: int
+    width: int
+    height: int
+    binning: int = 1
+
+    @property
+    def image_size(self) -> Tuple[int, int]:
+        """Width and height of the images delivered by a camera reading out this window"""
+        return self.width // self.binning, self.height // self.binning
+
+
 @dataclass
 class OpenCVCalibrationData:
     """Loads calibration co-efficients from calibration output from the file generated by the calibration script.
@@ -16,6 +35,7 @@ class OpenCVCalibrationData:
     region_of_interest: subset of the image which should be now distortion free. x_start and y_start in the original image along with new width and height
 
     inv_camera_matrix: invert of the camera matrix used during the translation of pixel to world coordinates
+    image_size: width and height of the images used during calibration, if stored in the calibration file
     scaling factor: a big mystery, but used as well for the translation of pixel to world coordinates
 
     """
@@ -28,6 +48,7 @@ class OpenCVCalibrationData:
     region_of_interest: Any
     inv_camera_matrix: Any
     inv_new_camera_matrix: Any
+    image_size: Any = None
 
     inv_rotate_mat = None
     scaling_factor = None
@@ -51,11 +72,14 @@ class OpenCVCalibrationData:
         roi = cv_file.getNode("ROI").mat()
         if roi is not None:
             roi = (roi[0, 0], roi[1, 0], roi[2, 0], roi[3, 0])
+        image_size = cv_file.getNode("SIZE").mat()
+        if image_size is not None:
+            image_size = (int(image_size[0, 0]), int(image_size[1, 0]))
         inv_camera_matrix = None
         inv_new_camera_matrix = None
         if camera_matrix is not None:
             inv_camera_matrix = numpy.linalg.inv(camera_matrix)
-        if new_camera_matrix:
+        if new_camera_matrix is not None:
             inv_new_camera_matrix = numpy.linalg.inv(new_camera_matrix)
         cv_file.release()
         return OpenCVCalibrationData(
@@ -67,8 +91,77 @@ class OpenCVCalibrationData:
             roi,
             inv_camera_matrix,
             inv_new_camera_matrix,
+            image_size,
         )
 
+    def transformed(self, scale=(1.0, 1.0), offset=(0, 0)) -> "OpenCVCalibrationData":
+        """Returns a copy of this calibration data which is valid for images cropped at `offset` and then scaled.
+
+        Both offset and scale refer to the pixel coordinates of the images used during calibration.
+        Scaling is about pixel centers, as done by camera binning or `cv2.resize`.
+        Distortion coefficients and extrinsic parameters are not affected.
+        """
+        scale_x, scale_y = scale
+        offset_x, offset_y = offset
+        affine = numpy.array(
+            [
+                [scale_x, 0.0, (0.5 - offset_x) * scale_x - 0.5],
+                [0.0, scale_y, (0.5 - offset_y) * scale_y - 0.5],
+                [0.0, 0.0, 1.0],
+            ]
+        )
+        camera_matrix = affine.dot(self.camera_matrix)
+        new_camera_matrix = affine.dot(self.new_camera_matrix)
+        x, y, w, h = self.region_of_interest
+        roi = ((x - offset_x) * scale_x, (y - offset_y) * scale_y, w * scale_x, h * scale_y)
+        return OpenCVCalibrationData(
+            camera_matrix,
+            self.dist_coefficients,
+            self.rotate_vecs,
+            self.translate_vecs,
+            new_camera_matrix,
+            roi,
+            numpy.linalg.inv(camera_matrix),
+            numpy.linalg.inv(new_camera_matrix),
+        )
+
+    def sensor_window(self, working_size: Tuple[int, int] = None, max_binning=4, margin=2) -> SensorWindow:
+        """The smallest sensor window containing all the pixels needed to produce the undistorted region of interest.
+
+        The border of the region of interest is projected back through the lens model, to find where in the
+        distorted (raw) image it originates from.
+        If a working size is given, the largest binning factor (a power of two, up to max_binning) is picked
+        which still leaves the region of interest at least as large as the working size.
+        """
+        x, y, w, h = self.region_of_interest
+        steps = numpy.linspace(0.0, 1.0, 32)
+        left, top = numpy.full_like(steps, x), numpy.full_like(steps, y)
+        right, bottom = left + w, top + h
+        border_u = numpy.concatenate((x + steps * w, x + steps * w, left, right))
+        border_v = numpy.concatenate((top, bottom, y + steps * h, y + steps * h))
+        border = numpy.vstack((border_u, border_v, numpy.ones_like(border_u)))
+        rays = self.inv_new_camera_matrix.dot(border).T
+        no_transform = numpy.zeros(3)
+        distorted, _ = cv2.projectPoints(rays, no_transform, no_transform, self.camera_matrix, self.dist_coefficients)
+        distorted = distorted.reshape(-1, 2)
+
+        binning = 1
+        if working_size is not None:
+            while (
+                binning * 2 <= max_binning
+                and w / (binning * 2) >= working_size[0]
+                and h / (binning * 2) >= working_size[1]
+            ):
+                binning *= 2
+
+        start_x, start_y = numpy.floor(distorted.min(axis=0)) - margin
+        end_x, end_y = numpy.ceil(distorted.max(axis=0)) + margin
+        start_x = max(0, int(start_x) // binning * binning)
+        start_y = max(0, int(start_y) // binning * binning)
+        width = -(-(int(end_x) - start_x) // binning) * binning
+        height = -(-(int(end_y) - start_y) // binning) * binning
+        return SensorWindow(start_x, start_y, width, height, binning)
+
     def calculate_scaling_factor(self):
         # https://www.fdxlabs.com/calculate-x-y-z-real-world-coordinates-from-a-single-camera-using-opencv/
         # convert rotation vector to rotation matrix (3x3)
@@ -88,61 +181,192 @@ class OpenCVCalibrationData:
         self.scaling_factor = result_xyz[2, 0]
 
 
+@dataclass
+class CalibrationView:
+    """Everything needed to undistort images of one particular resolution and to locate their pixels in the world.
+
+    image_size: width and height of the (distorted) input images
+    calibration_data: the calibration data transformed to the input images' pixel coordinates
+    region_of_interest: x, y, width and height of the undistorted, cropped output within the new camera matrix's image
+    map_x, map_y: undistortion maps, directly producing the cropped output
+    pixel_to_world: 3x3 matrix taking homogeneous pixel coordinates of the output to real world coordinates
+
+    """
+
+    image_size: Tuple[int, int]
+    calibration_data: OpenCVCalibrationData
+    region_of_interest: Tuple[int, int, int, int]
+    map_x: numpy.ndarray
+    map_y: numpy.ndarray
+    pixel_to_world: numpy.ndarray
+
+
 class OpenCVCalibrator:
-    def __init__(self, calibration_data: OpenCVCalibrationData, image_size: Tuple[int, int] = None):
+    """Undistorts images and translates pixel coordinates of the undistorted images to real world coordinates.
+
+    A single calibration serves images of any resolution, e.g. frames downscaled for faster processing.
+    The matrices and maps needed for a resolution are derived the first time an image of that size is seen
+    and cached from there on.
+
+    image_size: width and height of the images used during calibration. Defaults to the size stored in the
+        calibration file or, for older files, to the size of the image the calibrator is initialized with.
+    sensor_window: if the camera only reads out a window of its sensor (see `GenTlDevice`), the window actually
+        applied to the camera. Images are then assumed to show this window, at whichever resolution.
+
+    Pixel coordinates are always translated as if they were taken from the full resolution images used during
+    calibration, so results do not depend on the processing resolution.
+    """
+
+    def __init__(
+        self,
+        calibration_data: OpenCVCalibrationData,
+        image_size: Tuple[int, int] = None,
+        sensor_window: SensorWindow = None,
+    ):
         self._calibration_data = calibration_data
-        self.image_width = int(calibration_data.region_of_interest[2])
-        self.image_height = int(calibration_data.region_of_interest[3])
-        self.roi_x = int(calibration_data.region_of_interest[0])
-        self.roi_y = int(calibration_data.region_of_interest[1])
+        self.calibration_image_size = image_size or calibration_data.image_size
+        self.sensor_window = sensor_window
+        self._views = {}
+        self._active_view = None
         self.is_initialized = False
 
+    @property
+    def image_width(self) -> int:
+        return self._active_view.region_of_interest[2]
+
+    @property
+    def image_height(self) -> int:
+        return self._active_view.region_of_interest[3]
+
+    @property
+    def roi_x(self) -> int:
+        return self._active_view.region_of_interest[0]
+
+    @property
+    def roi_y(self) -> int:
+        return self._active_view.region_of_interest[1]
+
     def initialize(self, image: numpy.ndarray):
-        self._calibration_data.calculate_scaling_factor()
+        if self.calibration_image_size is None and self.sensor_window is None:
+            self.calibration_image_size = image.shape[1], image.shape[0]
+        if self._calibration_data.scaling_factor is None:
+            self._calibration_data.calculate_scaling_factor()
         _ = self.undistortify(image)
         self.is_initialized = True
         print("### Calibration init info ###")
+        print(f"Input size: w:{image.shape[1]} h:{image.shape[0]}")
         print(f"Cropped ROI size: w:{self.image_width} h:{self.image_height}")
         print(f"Scaling factor: {self._calibration_data.scaling_factor}")
         print(f"Camera matrix: {self._calibration_data.camera_matrix}")
         print(f"New camera matrix: {self._calibration_data.new_camera_matrix}")
         print("### Calibration init info ###")
 
+    def view(self, image_size: Tuple[int, int]) -> CalibrationView:
+        """Get the (cached) calibration view for input images of the given width and height"""
+        image_size = int(image_size[0]), int(image_size[1])
+        view = self._views.get(image_size)
+        if view is None:
+            view = self._create_view(image_size)
+            self._views[image_size] = view
+        return view
+
+    def _create_view(self, image_size: Tuple[int, int]) -> CalibrationView:
+        base = self._calibration_data
+        if base.scaling_factor is None:
+            base.calculate_scaling_factor()
+
+        if self.sensor_window is not None:
+            offset = self.sensor_window.offset_x, self.sensor_window.offset_y
+            source_size = self.sensor_window.width, self.sensor_window.height
+        else:
+            if self.calibration_image_size is None:
+                raise ValueError("Size of the calibration images is unknown, initialize the calibrator first.")
+            offset = 0, 0
+            source_size = self.calibration_image_size
+        scale = image_size[0] / source_size[0], image_size[1] / source_size[1]
+        data = base.transformed(scale, offset)
+        roi_x, roi_y, roi_w, roi_h = (int(value) for value in data.region_of_interest)
+
+        # shift the new camera matrix so that the maps only cover the region of interest, no cropping needed later
+        roi_camera_matrix = data.new_camera_matrix.copy()
+        roi_camera_matrix[0, 2] -= roi_x
+        roi_camera_matrix[1, 2] -= roi_y
+        map_x, map_y = cv2.initUndistortRectifyMap(
+            data.camera_matrix, data.dist_coefficients, None, roi_camera_matrix, (roi_w, roi_h), cv2.CV_16SC2
+        )
+
+        # output pixels -> pixels of the calibration's cropped images, inverting the transformation above
+        to_calibration_pixels = numpy.array(
+            [
+                [1.0 / scale[0], 0.0, (roi_x + 0.5) / scale[0] - 0.5 + offset[0] - base.region_of_interest[0]],
+                [0.0, 1.0 / scale[1], (roi_y + 0.5) / scale[1] - 0.5 + offset[1] - base.region_of_interest[1]],
+                [0.0, 0.0, 1.0],
+            ]
+        )
+        # https://www.fdxlabs.com/calculate-x-y-z-real-world-coordinates-from-a-single-camera-using-opencv/
+        # world = inv(R) . (s * inv(NK) . uv1 - T), with the translation folded into the homogeneous column
+        pixel_to_world = base.scaling_factor * base.inv_rotate_mat.dot(base.inv_new_camera_matrix)
+        pixel_to_world = pixel_to_world.dot(to_calibration_pixels)
+        pixel_to_world[:, 2] -= base.inv_rotate_mat.dot(base.translate_vecs).ravel()
+
+        return CalibrationView(image_size, data, (roi_x, roi_y, roi_w, roi_h), map_x, map_y, pixel_to_world)
+
     def undistortify(self, image: numpy.ndarray):
         """Remove distortion from image using the loaded distortion coefficients.
 
         Returns the distortion free portion of the original image, cropped using the region of interest parameters.
+        Subsequent calls to `pixel_to_irl_coords` refer to pixels of the returned image.
         """
-        result = cv2.undistort(
-            image,
-            self._calibration_data.camera_matrix,
-            self._calibration_data.dist_coefficients,
-            None,
-            self._calibration_data.new_camera_matrix,
-        )
+        self._active_view = self.view((image.shape[1], image.shape[0]))
+        return cv2.remap(image, self._active_view.map_x, self._active_view.map_y, cv2.INTER_LINEAR)
+
+    def undistort_points(self, points, image_size: Tuple[int, int]) -> numpy.ndarray:
+        """Undistort pixel coordinates of an input image of image_size, instead of undistorting the whole image.
+
+        Returns the (n, 2) coordinates the points have in the output `undistortify` would produce for the image,
+        region of interest offset included. Subsequent calls to `pixel_to_irl_coords` refer to these coordinates.
+        """
+        self._active_view = self.view(image_size)
+        data = self._active_view.calibration_data
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 1, 2)
+        undistorted = cv2.undistortPoints(
+            points, data.camera_matrix, data.dist_coefficients, P=data.new_camera_matrix
+        ).reshape(-1, 2)
+        return undistorted - numpy.array(self._active_view.region_of_interest[:2], dtype=numpy.float64)
 
-        # crop the image
-        return result[self.roi_y : self.roi_y + self.image_height, self.roi_x : self.roi_x + self.image_width]
+    def pixels_to_irl_coords(self, pixels, image_size: Tuple[int, int] = None) -> numpy.ndarray:
+        """Translate many pixels at once, (n, 2) pixel coordinates to (n, 3) real world coordinates.
 
-    def pixel_to_irl_coords(self, pixel_coords: Tuple[int, int]) -> Tuple[float, float, float]:
+        See `pixel_to_irl_coords`.
+        """
+        view = self._active_view if image_size is None else self.view(image_size)
+        pixels = numpy.asarray(pixels, dtype=numpy.float64).reshape(-1, 2)
+        return pixels.dot(view.pixel_to_world[:, :2].T) + view.pixel_to_world[:, 2]
+
+    def units_per_pixel(self, image_size: Tuple[int, int] = None) -> float:
+        """Real world length of a pixel of the undistorted output for input images of image_size.
+
+        The geometric mean of the pixel's width and height in world units, see `pixel_to_irl_coords`.
+        """
+        view = self._active_view if image_size is None else self.view(image_size)
+        width, height = numpy.linalg.norm(view.pixel_to_world[:, :2], axis=0)
+        return float(numpy.sqrt(width * height))
+
+    def pixel_to_irl_coords(
+        self, pixel_coords: Tuple[float, float], image_size: Tuple[int, int] = None
+    ) -> Tuple[float, float, float]:
         """The coordinates received are in camera space, but x,y origin is not necessarily at the center of the camera.
 
         The plan, position a tile until its centroid reads closest possible to 0, 0.
         Then measure the location in REAL real world coordinates using the robot.
+
+        pixel_coords refer to the undistorted output for input images of image_size, which defaults to the size
+        of the image most recently passed to `undistortify`.
         """
-        # https://www.fdxlabs.com/calculate-x-y-z-real-world-coordinates-from-a-single-camera-using-opencv/
-        # dot of pixel coords with inverse camera mtx
-        # dot of result with inverse of translation vecs
-        # dot of result with inverse of rotation
-        uv1 = numpy.array([[pixel_coords[0], pixel_coords[1], 1]], dtype=numpy.float32).reshape(3, 1)
-        scaled_uv1 = self._calibration_data.scaling_factor * uv1
-        irl_xyz = self._calibration_data.inv_new_camera_matrix.dot(
-            scaled_uv1
-        )  # should this be the inverse new cam matrix instead?
-        irl_xyz = irl_xyz - self._calibration_data.translate_vecs
-        irl_xyz = self._calibration_data.inv_rotate_mat.dot(irl_xyz)
+        view = self._active_view if image_size is None else self.view(image_size)
+        irl_xyz = view.pixel_to_world.dot((pixel_coords[0], pixel_coords[1], 1.0))
         return (
-            irl_xyz[0, 0],
-            irl_xyz[1, 0],
-            irl_xyz[2, 0],
+            irl_xyz[0],
+            irl_xyz[1],
+            irl_xyz[2],
         )
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import os
+import struct
+from dataclasses import astuple
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+import numpy
+
+from .calibration import CalibrationView
+from .calibration import OpenCVCalibrationData
+from .calibration import OpenCVCalibrator
+from .calibration import SensorWindow
+
+
+class CalibrationCacheError(Exception):
+    pass
+
+
+class CalibrationCache:
+    """A single binary file holding a calibration and everything derived from it.
+
+    Besides the raw coefficients, the cache holds the inverted matrices, the scaling factor and, per cached
+    resolution, the undistortion maps and the pixel to world transform. Loading it therefore involves no parsing
+    and no computation. Arrays are memory mapped read-only, so processes loading the same cache share their pages.
+
+    The cache is tagged with a hash of the calibration file and of the settings the views were derived with
+    (see `source_hash`), a cache with a different hash is stale.
+
+    Layout: magic, header length (uint64, little endian), JSON header, then each array at an aligned offset.
+    """
+
+    MAGIC = b"TD2DCAL\x01"
+    ALIGNMENT = 64
+    _DATA_ARRAYS = ("camera_matrix", "new_camera_matrix", "inv_camera_matrix", "inv_new_camera_matrix")
+    _BASE_ARRAYS = _DATA_ARRAYS + ("dist_coefficients", "rotate_vecs", "translate_vecs", "inv_rotate_mat")
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def file_hash(calibration_file: str) -> str:
+        """Hash identifying the contents of a calibration file"""
+        with open(calibration_file, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @staticmethod
+    def source_hash(
+        calibration_file: str, image_size: Tuple[int, int] = None, sensor_window: SensorWindow = None
+    ) -> str:
+        """Hash identifying a calibration file along with the settings used to derive views from it"""
+        digest = hashlib.sha256(CalibrationCache.file_hash(calibration_file).encode())
+        settings = {
+            "version": CalibrationCache.MAGIC.hex(),
+            "image_size": list(image_size) if image_size else None,
+            "sensor_window": [int(v) for v in astuple(sensor_window)] if sensor_window else None,
+        }
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _read_header(self, f) -> Tuple[dict, int]:
+        magic = f.read(len(self.MAGIC))
+        if magic != self.MAGIC:
+            raise CalibrationCacheError(f"Not a calibration cache (or an outdated one): {self.path}")
+        (header_length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length).decode())
+        return header, self._align(len(self.MAGIC) + 8 + header_length)
+
+    def is_valid(self, source_hash: str) -> bool:
+        """True if the cache exists and was created from the calibration identified by source_hash"""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "rb") as f:
+                header, _ = self._read_header(f)
+        except (CalibrationCacheError, ValueError, struct.error):
+            return False
+        return header["source_hash"] == source_hash
+
+    def write(self, calibrator: OpenCVCalibrator, source_hash: str, file_hash: str = None) -> bool:
+        """Write the calibrator's calibration and all the views it has created so far.
+
+        file_hash (see `file_hash`) lets `read_calibration_data` use the cache regardless of the view settings.
+        Returns False if the cache couldn't be replaced: on Windows, a file can't be replaced while another process
+        has it memory mapped. The existing cache is left as it is then.
+        """
+        data = calibrator._calibration_data
+        if data.scaling_factor is None:
+            data.calculate_scaling_factor()
+        arrays = {name: getattr(data, name) for name in self._BASE_ARRAYS}
+        views = []
+        for image_size, view in calibrator._views.items():
+            prefix = "{}x{}/".format(*image_size)
+            for name in self._DATA_ARRAYS:
+                arrays[prefix + name] = getattr(view.calibration_data, name)
+            arrays[prefix + "map_x"] = view.map_x
+            arrays[prefix + "map_y"] = view.map_y
+            arrays[prefix + "pixel_to_world"] = view.pixel_to_world
+            views.append({"image_size": list(image_size), "region_of_interest": list(view.region_of_interest)})
+
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            array = numpy.ascontiguousarray(array)
+            arrays[name] = array
+            layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset = self._align(offset + array.nbytes)
+
+        header = {
+            "source_hash": source_hash,
+            "file_hash": file_hash,
+            "region_of_interest": [float(v) for v in data.region_of_interest],
+            "image_size": list(calibrator.calibration_image_size) if calibrator.calibration_image_size else None,
+            "sensor_window": [int(v) for v in astuple(calibrator.sensor_window)] if calibrator.sensor_window else None,
+            "scaling_factor": float(data.scaling_factor),
+            "views": views,
+            "arrays": layout,
+        }
+        encoded = json.dumps(header).encode()
+
+        # write to a temporary file first, so that concurrent readers never see a partially written cache
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack("<Q", len(encoded)))
+            f.write(encoded)
+            data_start = self._align(f.tell())
+            for name, array in arrays.items():
+                f.seek(data_start + layout[name]["offset"])
+                f.write(array.tobytes())
+        try:
+            os.replace(temp_path, self.path)
+        except PermissionError:
+            os.remove(temp_path)
+            return False
+        return True
+
+    def _map(self) -> Tuple[dict, Dict[str, numpy.ndarray]]:
+        with open(self.path, "rb") as f:
+            header, data_start = self._read_header(f)
+        buffer = numpy.memmap(self.path, dtype=numpy.uint8, mode="r")
+        return header, self._map_arrays(buffer, data_start, header["arrays"])
+
+    def _base_data(self, header: dict, arrays: Dict[str, numpy.ndarray]) -> OpenCVCalibrationData:
+        data = self._calibration_data("", tuple(header["region_of_interest"]), arrays, header["image_size"])
+        data.inv_rotate_mat = arrays["inv_rotate_mat"]
+        data.scaling_factor = header["scaling_factor"]
+        return data
+
+    def read_calibration_data(self, file_hash: str) -> Optional[OpenCVCalibrationData]:
+        """The calibration alone, if the cache was created from the file identified by file_hash, otherwise None.
+
+        Unlike `read`, this doesn't depend on the settings the views were derived with.
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                header, _ = self._read_header(f)
+        except (CalibrationCacheError, ValueError, struct.error):
+            return None
+        if header.get("file_hash") != file_hash:
+            return None
+        return self._base_data(*self._map())
+
+    def read(self) -> OpenCVCalibrator:
+        """Recreate the calibrator, with all the cached views"""
+        header, arrays = self._map()
+        data = self._base_data(header, arrays)
+        sensor_window = SensorWindow(*header["sensor_window"]) if header["sensor_window"] else None
+        image_size = tuple(header["image_size"]) if header["image_size"] else None
+        calibrator = OpenCVCalibrator(data, image_size, sensor_window)
+
+        for view in header["views"]:
+            image_size = tuple(view["image_size"])
+            prefix = "{}x{}/".format(*image_size)
+            view_data = self._calibration_data(prefix, tuple(view["region_of_interest"]), arrays)
+            calibrator._views[image_size] = CalibrationView(
+                image_size,
+                view_data,
+                tuple(view["region_of_interest"]),
+                arrays[prefix + "map_x"],
+                arrays[prefix + "map_y"],
+                arrays[prefix + "pixel_to_world"],
+            )
+        return calibrator
+
+    @staticmethod
+    def _calibration_data(prefix, roi, arrays, image_size=None) -> OpenCVCalibrationData:
+        return OpenCVCalibrationData(
+            arrays[prefix + "camera_matrix"],
+            arrays["dist_coefficients"],
+            arrays["rotate_vecs"],
+            arrays["translate_vecs"],
+            arrays[prefix + "new_camera_matrix"],
+            roi,
+            arrays[prefix + "inv_camera_matrix"],
+            arrays[prefix + "inv_new_camera_matrix"],
+            tuple(image_size) if image_size else None,
+        )
+
+    @staticmethod
+    def _map_arrays(buffer: numpy.memmap, data_start: int, layout: dict) -> Dict[str, numpy.ndarray]:
+        arrays = {}
+        for name, entry in layout.items():
+            dtype = numpy.dtype(entry["dtype"])
+            start = data_start + entry["offset"]
+            count = int(numpy.prod(entry["shape"]))
+            arrays[name] = buffer[start : start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+        return arrays
+
+    @classmethod
+    def _align(cls, offset: int) -> int:
+        return -(-offset // cls.ALIGNMENT) * cls.ALIGNMENT
+
+
+def load_calibration_data(calibration_file: str, cache_file: str = None) -> OpenCVCalibrationData:
+    """Get the calibration data of a calibration file, e.g. to choose a sensor window before loading a calibrator.
+
+    Taken from the cache if it was created from this calibration file, whatever its views, otherwise parsed.
+    """
+    cache = CalibrationCache(cache_file or calibration_file + ".bin")
+    data = cache.read_calibration_data(CalibrationCache.file_hash(calibration_file))
+    return data if data is not None else OpenCVCalibrationData.from_file(calibration_file)
+
+
+def load_calibrator(
+    calibration_file: str,
+    cache_file: str = None,
+    image_sizes: Iterable[Tuple[int, int]] = (),
+    image_size: Tuple[int, int] = None,
+    sensor_window: SensorWindow = None,
+) -> OpenCVCalibrator:
+    """Get a calibrator for the given calibration file, from its cache if it is up to date.
+
+    Otherwise the calibration file is loaded and the cache is (re)written. If the cache can't be rewritten because
+    another process is using it (see `CalibrationCache.write`), the calibrator is used without caching it.
+    Views for all image_sizes are made part of the cache, so they need not be derived on the next start either.
+    If the size of the calibration images is unknown (no image_size, sensor_window or size stored in the
+    calibration file), views can't be derived before the calibrator is initialized with a frame: image_sizes are
+    ignored then.
+    cache_file defaults to the calibration file's path with a `.bin` suffix appended.
+    """
+    cache = CalibrationCache(cache_file or calibration_file + ".bin")
+    source_hash = CalibrationCache.source_hash(calibration_file, image_size, sensor_window)
+    is_cached = cache.is_valid(source_hash)
+    if is_cached:
+        calibrator = cache.read()
+    else:
+        calibrator = OpenCVCalibrator(OpenCVCalibrationData.from_file(calibration_file), image_size, sensor_window)
+
+    if calibrator.calibration_image_size is None and calibrator.sensor_window is None:
+        image_sizes = ()
+    missing = [size for size in image_sizes if (int(size[0]), int(size[1])) not in calibrator._views]
+    if missing or not is_cached:
+        for size in missing:
+            calibrator.view(size)
+        if not cache.write(calibrator, source_hash, CalibrationCache.file_hash(calibration_file)):
+            print(f"Calibration cache {cache.path} is in use by another process, not updating it")
+    return calibrator
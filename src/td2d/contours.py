@@ -0,0 +1,72 @@
+from typing import List
+from typing import Sequence
+
+import cv2
+import numpy
+
+
+def find_area_contours(
+    binary: numpy.ndarray,
+    min_area: float,
+    max_area: float,
+    retrieval_mode: int = cv2.RETR_EXTERNAL,
+    approximation: int = cv2.CHAIN_APPROX_SIMPLE,
+    min_fill: float = 0.0,
+) -> List[numpy.ndarray]:
+    """Find the contours of a binary image whose area lies between min_area and max_area (exclusive).
+
+    Contours are traced on the whole image and filtered by their area afterwards. Discarding small and large
+    connected components (cv2.connectedComponentsWithStats) before tracing was measured as well: on a tray of tiles
+    it took 35-44 ms instead of 6-7 ms, as labelling the components costs more than tracing the discarded contours.
+
+    min_fill: minimal ratio of the set pixels enclosed by a contour to its area. Discards outlines, which enclose a
+        large area with few pixels, e.g. the blurred border around a brighter region. Only computed for contours
+        within the area range, within their bounding boxes.
+    """
+    found, _ = cv2.findContours(binary, retrieval_mode, approximation)
+    contours = []
+    for contour in found:
+        area = cv2.contourArea(contour)
+        if min_area < area < max_area and (min_fill <= 0 or _fill(binary, contour) >= min_fill * area):
+            contours.append(contour)
+    return contours
+
+
+def _fill(binary: numpy.ndarray, contour: numpy.ndarray) -> int:
+    """Number of set pixels enclosed by the contour"""
+    x, y, w, h = cv2.boundingRect(contour)
+    mask = numpy.zeros((h, w), dtype=numpy.uint8)
+    cv2.drawContours(mask, (contour,), 0, 255, cv2.FILLED, offset=(-x, -y))
+    return cv2.countNonZero(cv2.bitwise_and(mask, binary[y : y + h, x : x + w]))
+
+
+def band_lut(thresholds: Sequence[int]) -> numpy.ndarray:
+    """Lookup table assigning each 8 bit intensity its band: 0 up to thresholds[0], i + 1 above thresholds[i]"""
+    return numpy.searchsorted(numpy.sort(thresholds), numpy.arange(256), side="left").astype(numpy.uint8)
+
+
+def find_band_contours(
+    gray: numpy.ndarray,
+    thresholds: Sequence[int],
+    min_area: float,
+    max_area: float,
+    retrieval_mode: int = cv2.RETR_EXTERNAL,
+    approximation: int = cv2.CHAIN_APPROX_SIMPLE,
+    min_fill: float = 0.5,
+) -> List[List[numpy.ndarray]]:
+    """Find the contours of regions in several intensity bands, e.g. of dark and bright tiles on the same tray.
+
+    Pixels are classified into bands by a single lookup table pass (see `band_lut`), band i + 1 holding the pixels
+    brighter than thresholds[i] but not brighter than thresholds[i + 1]. Contours are then found per band with
+    `find_area_contours`, on masks taken from the one label image. The border of a bright region
+    passes through the lower bands, min_fill keeps the resulting outlines from being taken for regions of their own.
+
+    Returns a list of contours per band, thresholds[0] being the threshold of the first band.
+    """
+    labels = cv2.LUT(gray, band_lut(thresholds))
+    return [
+        find_area_contours(
+            cv2.compare(labels, float(band), cv2.CMP_EQ), min_area, max_area, retrieval_mode, approximation, min_fill
+        )
+        for band in range(1, len(thresholds) + 1)
+    ]
@@ -0,0 +1,147 @@
+import json
+import os
+import queue
+import struct
+from threading import Thread
+
+import numpy
+
+RECORD_DTYPE = numpy.dtype(
+    [
+        ("sequence", "<i8"),
+        ("capture_time", "<f8"),
+        ("receive_time", "<f8"),
+        ("publish_time", "<f8"),
+        ("centroid", "<f8", (3,)),
+        ("direction", "<f8", (3,)),
+        ("polygon", "<f4", (4, 2)),
+        ("threshold", "<i4"),
+        ("reserved", "<i4"),
+    ]
+)
+
+
+class DetectionLogError(Exception):
+    pass
+
+
+class _LogFormat:
+    """Magic, header length (uint32, little endian) and a JSON header, padded to HEADER_SIZE, followed by records.
+
+    The header holds the record layout, so that files stay readable if fields are added later.
+    """
+
+    MAGIC = b"TD2DLOG\x01"
+    HEADER_SIZE = 4096
+
+    @classmethod
+    def header(cls, dtype: numpy.dtype) -> bytes:
+        encoded = json.dumps({"dtype": dtype.descr}).encode()
+        header = cls.MAGIC + struct.pack("<I", len(encoded)) + encoded
+        if len(header) > cls.HEADER_SIZE:
+            raise DetectionLogError("Record layout doesn't fit into the header")
+        return header.ljust(cls.HEADER_SIZE, b"\0")
+
+    @classmethod
+    def read_dtype(cls, path: str) -> numpy.dtype:
+        with open(path, "rb") as f:
+            start = f.read(len(cls.MAGIC) + 4)
+            if len(start) < len(cls.MAGIC) + 4 or not start.startswith(cls.MAGIC):
+                raise DetectionLogError(f"Not a detection log: {path}")
+            (length,) = struct.unpack("<I", start[len(cls.MAGIC) :])
+            descr = json.loads(f.read(length).decode())["dtype"]
+        # JSON turns the shapes of array fields into lists
+        return numpy.dtype([(field[0], field[1], *(tuple(shape) for shape in field[2:])) for field in descr])
+
+
+class DetectionLogger:
+    """Appends a fixed-size record (see RECORD_DTYPE) per located tile to a binary file.
+
+    `log` only puts the record's values on a queue and never blocks. A background thread writes them in batches of
+    up to batch_size records, or whatever has arrived within flush_interval seconds. At most max_pending records
+    are queued: if the writer can't keep up, further records are dropped (counted in dropped_records) rather than
+    holding up the caller.
+
+    Logging to an existing log appends to it. Read logs with `read_detection_log`.
+    """
+
+    def __init__(self, path: str, batch_size=256, max_pending=65536, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped_records = 0
+        self._queue = queue.Queue(max_pending)
+        self._file = self._open(path)
+        self._writer = Thread(target=self._write, name="td2d_detection_log", daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def _open(path: str):
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            if _LogFormat.read_dtype(path) != RECORD_DTYPE:
+                raise DetectionLogError(f"Detection log {path} has a different record layout")
+            f = open(path, "ab")
+            # a record cut short by a crash would shift all later records, drop it
+            size = f.tell()
+            partial = (size - _LogFormat.HEADER_SIZE) % RECORD_DTYPE.itemsize
+            if partial:
+                f.truncate(size - partial)
+            return f
+        f = open(path, "wb")
+        f.write(_LogFormat.header(RECORD_DTYPE))
+        return f
+
+    def log(self, tile, threshold: int) -> None:
+        """Queue a record of the tile, located using the given threshold"""
+        polygon = tile.polygon if tile.polygon is not None else numpy.full((4, 2), numpy.nan)
+        direction = tile.direction_vec
+        record = (
+            tile.sequence,
+            tile.capture_time,
+            tile.receive_time,
+            tile.publish_time,
+            tuple(tile.centroid),
+            (direction[0], direction[1], direction[2]),
+            numpy.asarray(polygon, dtype=numpy.float32).reshape(4, 2),
+            threshold,
+            0,
+        )
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+
+    def _write(self) -> None:
+        is_closing = False
+        while not is_closing:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch and batch[-1] is None:
+                batch.pop()
+                is_closing = True
+            if batch:
+                self._file.write(numpy.array(batch, dtype=RECORD_DTYPE).tobytes())
+                self._file.flush()
+
+    def close(self) -> None:
+        """Write all queued records and close the file"""
+        self._queue.put(None)
+        self._writer.join()
+        self._file.close()
+
+
+def read_detection_log(path: str) -> numpy.ndarray:
+    """All records of a detection log as a (read-only, memory mapped) structured array.
+
+    Records still being written when the log is read are left out.
+    """
+    dtype = _LogFormat.read_dtype(path)
+    count = (os.path.getsize(path) - _LogFormat.HEADER_SIZE) // dtype.itemsize
+    if count <= 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode="r", offset=_LogFormat.HEADER_SIZE, shape=(count,))
@@ -1,32 +1,112 @@
+import os
+import time
 from abc import ABC
 from abc import abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator
+from typing import Sequence
+from typing import Tuple
 
 import numpy
 import cv2
 
 
+@dataclass
+class Frame:
+    """A single image along with the timing information of its acquisition.
+
+    image: the image data
+    sequence: frame number as assigned by the image source. Consecutive frames have consecutive numbers,
+        gaps mean frames were dropped somewhere between the source and the consumer.
+    capture_time: time at which the frame was exposed, in host time (seconds, `time.perf_counter` clock)
+    receive_time: time at which the frame was handed over to the host application (same clock as capture_time)
+    is_stale: the source failed to deliver a new frame in time, this is the last good one again (see
+        `td2d.genicam_device.GenTlDevice`). Consumers should keep their previous results rather than process it.
+
+    """
+
+    image: numpy.ndarray
+    sequence: int
+    capture_time: float
+    receive_time: float
+    is_stale: bool = False
+
+
 class CaptureDevice(ABC):
     """An image source"""
 
+    _sequence = -1
+
     @abstractmethod
     def get_next_image(self):
         """Returns a single image from an image source"""
         pass
 
+    def get_next_frame(self) -> Frame:
+        """Returns a single image from an image source along with its timing information.
+
+        Image sources which have no notion of exposure time are considered to capture the image upon receiving it.
+        """
+        image = self.get_next_image()
+        now = time.perf_counter()
+        self._sequence += 1
+        return Frame(image, self._sequence, now, now)
+
+    def advance(self) -> None:
+        """Move on to the next image, for sources which hold on to an image until asked (see `ImageSequenceDevice`)"""
+        pass
+
     @abstractmethod
     def stop(self):
         """Cleanup and free resources, if required"""
         pass
 
 
+_REDUCED_READ_FLAGS = {
+    (1, False): cv2.IMREAD_COLOR,
+    (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+    (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+    (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+    (1, True): cv2.IMREAD_GRAYSCALE,
+    (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def read_image(filepath: str, reduction=1, grayscale=False, size: Tuple[int, int] = None) -> numpy.ndarray:
+    """Read an image, decoding no more than needed.
+
+    reduction: 1, 2, 4 or 8. The image is decoded at 1/reduction of its resolution, which for JPEG is considerably
+        faster than decoding at full resolution. Other formats are decoded fully, but not kept at full resolution
+    grayscale: only decode luminance, a third of the memory of a color image
+    size: optionally resize the decoded image to this width and height
+    """
+    try:
+        flags = _REDUCED_READ_FLAGS[(reduction, grayscale)]
+    except KeyError:
+        raise ValueError(f"Unsupported reduction: {reduction}, use one of 1, 2, 4 or 8")
+    image = cv2.imread(filepath, flags)
+    if image is None:
+        raise IOError(f"Could not read image: {filepath}")
+    if size is not None and (image.shape[1], image.shape[0]) != tuple(size):
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return image
+
+
 class SingleImageDevice(CaptureDevice):
-    """Read an image from the given file path"""
+    """Read an image from the given file path
+
+    By default the image is resized to WIDTH_HEIGHT, pass size=None to keep the decoded resolution.
+    See `read_image` for reduction and grayscale.
+    """
 
     WIDTH_HEIGHT = (1024, 768)
 
-    def __init__(self, filepath):
-        self.image = cv2.imread(filepath)
-        self.image = cv2.resize(self.image, self.WIDTH_HEIGHT)
+    def __init__(self, filepath, size: Tuple[int, int] = WIDTH_HEIGHT, reduction=1, grayscale=False):
+        self.image = read_image(filepath, reduction, grayscale, size)
         # self.image = cv.medianBlur(self.image, 5)
 
     def get_next_image(self) -> numpy.ndarray:
@@ -39,3 +119,85 @@ class SingleImageDevice(CaptureDevice):
     def stop(self):
         # self.image.release() ?
         pass
+
+
+class ImageSequenceDevice(CaptureDevice):
+    """Read a sequence of images, e.g. all images in a directory, one per call to `get_next_image`.
+
+    The next `prefetch` images are decoded on a background thread while the current one is being processed,
+    so that decoding doesn't hold up the processing. See `read_image` for size, reduction and grayscale.
+
+    Once all images have been returned, starts over if loop is set, otherwise raises StopIteration.
+    The device can also be iterated over directly.
+
+    With hold set, the current image is returned again until `advance` is called, e.g. so that each image can be
+    looked at and processed once in an interactive loop, instead of the images passing by at the loop's pace.
+    """
+
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+    def __init__(
+        self,
+        filepaths: Sequence[str],
+        size: Tuple[int, int] = None,
+        reduction=1,
+        grayscale=False,
+        prefetch=2,
+        loop=False,
+        hold=False,
+    ):
+        self.filepaths = list(filepaths)
+        if not self.filepaths:
+            raise ValueError("No images to read")
+        self.read_args = (reduction, grayscale, size)
+        self.prefetch = prefetch
+        self.loop = loop
+        self.hold = hold
+        self._current = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = deque()
+        self._next_index = 0
+
+    @classmethod
+    def from_directory(cls, directory: str, **kwargs) -> "ImageSequenceDevice":
+        """All images in the directory, in alphabetical order"""
+        names = sorted(name for name in os.listdir(directory) if name.lower().endswith(cls.IMAGE_EXTENSIONS))
+        return cls([os.path.join(directory, name) for name in names], **kwargs)
+
+    def _fill(self) -> None:
+        while len(self._pending) <= self.prefetch:
+            if self._next_index == len(self.filepaths):
+                if not self.loop:
+                    return
+                self._next_index = 0
+            filepath = self.filepaths[self._next_index]
+            self._pending.append(self._executor.submit(read_image, filepath, *self.read_args))
+            self._next_index += 1
+
+    def get_next_image(self) -> numpy.ndarray:
+        if self._current is not None:
+            return self._current
+        self._fill()
+        if not self._pending:
+            raise StopIteration
+        image = self._pending.popleft().result()
+        if self.hold:
+            self._current = image
+        return image
+
+    def advance(self) -> None:
+        self._current = None
+
+    def __iter__(self) -> Iterator[numpy.ndarray]:
+        while True:
+            try:
+                yield self.get_next_image()
+            except StopIteration:
+                return
+
+    def stop(self):
+        self._current = None
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=False)
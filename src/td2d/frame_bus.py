@@ -0,0 +1,239 @@
+import argparse
+import os
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from threading import Thread
+
+import numpy
+
+from .device import CaptureDevice
+from .device import Frame
+
+
+class FrameBusError(Exception):
+    pass
+
+
+class _FrameRing:
+    """Layout of the shared memory block: a control block followed by slot_count frame slots.
+
+    Control block (int64): magic, slot_count, height, width, channels, itemsize, latest bus sequence, closed flag.
+    Slot header: bus sequence at write start and end (int64), frame sequence (int64), capture and receive time
+    (float64). The image data follows the header.
+
+    The writer stamps the slot's start sequence, writes the image and the timing information, stamps the end
+    sequence and then publishes the bus sequence as the latest. A reader knows a slot is intact as long as both
+    stamps equal the sequence it expects.
+    """
+
+    MAGIC = 0x7464326466627573  # "td2dfbus"
+    CONTROL_SIZE = 64
+    SLOT_HEADER_SIZE = 64
+    ALIGNMENT = 64
+
+    def __init__(self, buffer, slot_count, shape, itemsize):
+        self.slot_count = slot_count
+        self.shape = shape
+        self.dtype = numpy.dtype(f"u{itemsize}")
+        image_size = int(numpy.prod(shape)) * itemsize
+        self.slot_size = -(-(self.SLOT_HEADER_SIZE + image_size) // self.ALIGNMENT) * self.ALIGNMENT
+        self.control = numpy.ndarray((8,), numpy.int64, buffer, 0)
+        self.sequences = []
+        self.times = []
+        self.images = []
+        for index in range(slot_count):
+            offset = self.CONTROL_SIZE + index * self.slot_size
+            self.sequences.append(numpy.ndarray((3,), numpy.int64, buffer, offset))
+            self.times.append(numpy.ndarray((2,), numpy.float64, buffer, offset + 24))
+            self.images.append(numpy.ndarray(shape, self.dtype, buffer, offset + self.SLOT_HEADER_SIZE))
+
+    @classmethod
+    def required_size(cls, slot_count, shape, itemsize):
+        image_size = int(numpy.prod(shape)) * itemsize
+        slot_size = -(-(cls.SLOT_HEADER_SIZE + image_size) // cls.ALIGNMENT) * cls.ALIGNMENT
+        return cls.CONTROL_SIZE + slot_count * slot_size
+
+    @property
+    def latest(self) -> int:
+        return int(self.control[6])
+
+    @property
+    def is_closed(self) -> bool:
+        return bool(self.control[7])
+
+
+class FrameServer(Thread):
+    """Owns a capture device and publishes its frames into a shared memory ring buffer.
+
+    GenTL devices can only be opened by a single process. Running a frame server lets any number of processes on
+    the same host consume the device's frames through a `SharedMemoryDevice` attached to the same name.
+
+    The ring holds slot_count frames. Consumers read frames in place, a frame stays intact until the server has
+    written slot_count - 1 newer ones.
+    """
+
+    DEFAULT_NAME = "td2d_frames"
+
+    def __init__(self, capture_device: CaptureDevice, name=DEFAULT_NAME, slot_count=8):
+        super().__init__(daemon=True)
+        self.capture_device = capture_device
+        self.name = name
+        self.slot_count = slot_count
+        self.is_running = False
+        self.memory = None
+        self.ring = None
+        self._sequence = 0
+        self._open(capture_device.get_next_frame())
+
+    def _open(self, frame: Frame):
+        image = frame.image
+        size = _FrameRing.required_size(self.slot_count, image.shape, image.itemsize)
+        self.memory = SharedMemory(self.name, create=True, size=size)
+        self.ring = _FrameRing(self.memory.buf, self.slot_count, image.shape, image.itemsize)
+        channels = image.shape[2] if image.ndim == 3 else 0
+        self.ring.control[:] = 0
+        height, width = image.shape[:2]
+        self.ring.control[:6] = (_FrameRing.MAGIC, self.slot_count, height, width, channels, image.itemsize)
+        self.publish(frame)
+
+    def publish(self, frame: Frame) -> None:
+        """Write a frame into the next slot and make it the latest"""
+        self._sequence += 1
+        index = self._sequence % self.slot_count
+        sequences = self.ring.sequences[index]
+        sequences[0] = self._sequence
+        self.ring.images[index][...] = frame.image
+        sequences[2] = frame.sequence
+        self.ring.times[index][:] = (frame.capture_time, frame.receive_time)
+        sequences[1] = self._sequence
+        self.ring.control[6] = self._sequence
+
+    def run(self):
+        self.is_running = True
+        try:
+            while self.is_running:
+                frame = self.capture_device.get_next_frame()
+                if not frame.is_stale:  # readers keep the last published frame while the camera is reopened
+                    self.publish(frame)
+        finally:
+            self.ring.control[7] = 1
+
+    def stop(self):
+        """Stop publishing, release the device and remove the shared memory block"""
+        self.is_running = False
+        if self.is_alive():
+            self.join()
+        self.ring.control[7] = 1
+        self.capture_device.stop()
+        self.ring = None  # views into the buffer prevent closing it
+        self.memory.close()
+        self.memory.unlink()
+
+
+class SharedMemoryDevice(CaptureDevice):
+    """Reads frames published by a `FrameServer`, possibly running in another process.
+
+    Always returns the latest frame, readers which can't keep up skip the frames in between (visible as gaps in
+    the frame sequence numbers). Images are views into the shared memory, not copies, and stay intact until the
+    server has published slot_count - 1 newer frames. Use `is_intact` to verify, or pass copy=True to get copies.
+    """
+
+    POLL_INTERVAL_S = 0.001
+
+    def __init__(self, name=FrameServer.DEFAULT_NAME, copy=False, timeout=5.0):
+        self.name = name
+        self.copy = copy
+        self.timeout = timeout
+        try:
+            self.memory = SharedMemory(name)
+        except FileNotFoundError:
+            raise FrameBusError(f"No frame server running with name: {name}")
+        # the block belongs to the server, don't let this process' resource tracker remove it on exit. Only POSIX
+        # has a resource tracker for shared memory, elsewhere the call would try to spawn one and fail.
+        if os.name == "posix":
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        control = numpy.ndarray((8,), numpy.int64, self.memory.buf, 0)
+        if control[0] != _FrameRing.MAGIC:
+            raise FrameBusError(f"Shared memory block {name} is not a frame ring")
+        slot_count, height, width, channels, itemsize = (int(v) for v in control[1:6])
+        shape = (height, width, channels) if channels else (height, width)
+        del control
+        self.ring = _FrameRing(self.memory.buf, slot_count, shape, itemsize)
+        self._last_read = 0
+
+    def get_next_image(self) -> numpy.ndarray:
+        return self.get_next_frame().image
+
+    def get_next_frame(self) -> Frame:
+        """Wait for a frame newer than the last one read and return the latest one"""
+        deadline = time.perf_counter() + self.timeout
+        while True:
+            latest = self.ring.latest
+            if latest > self._last_read:
+                frame = self._read(latest)
+                if frame is not None:
+                    self._last_read = latest
+                    return frame
+                continue  # lapped by the server while reading, take the newest one instead
+            if self.ring.is_closed:
+                raise FrameBusError(f"Frame server {self.name} has stopped")
+            if time.perf_counter() > deadline:
+                raise FrameBusError(f"No new frame from frame server {self.name} within {self.timeout}s")
+            time.sleep(self.POLL_INTERVAL_S)
+
+    def _read(self, sequence: int):
+        index = sequence % self.ring.slot_count
+        sequences = self.ring.sequences[index]
+        if sequences[1] != sequence:
+            return None
+        frame_sequence = int(sequences[2])
+        capture_time, receive_time = (float(t) for t in self.ring.times[index])
+        image = self.ring.images[index]
+        if self.copy:
+            image = image.copy()
+        if sequences[0] != sequence:
+            return None
+        return Frame(image, frame_sequence, capture_time, receive_time)
+
+    def is_intact(self) -> bool:
+        """True if the server hasn't started overwriting the (not copied) frame returned last yet"""
+        sequence = self._last_read
+        return int(self.ring.sequences[sequence % self.ring.slot_count][0]) == sequence
+
+    def stop(self):
+        self.ring = None  # views into the buffer prevent closing it
+        self.memory.close()
+
+
+def main():
+    from .genicam_device import GenTlDevice
+
+    parser = argparse.ArgumentParser(description="Publish a GenTL camera's frames to other processes on this host.")
+    parser.add_argument("-i", "--input", help="GenTL endpoint (.cti)", required=True)
+    parser.add_argument("-n", "--model_name", help="Name of the GenTL camera model to use", required=True)
+    parser.add_argument("--name", help="Name of the shared memory block", default=FrameServer.DEFAULT_NAME)
+    parser.add_argument("--slots", help="Number of frames in the ring buffer", type=int, default=8)
+    parser.add_argument("--serial_number", help="Serial number of the camera, if there are several of the model")
+    parser.add_argument(
+        "--fetch_timeout", help="Reopen the camera if it delivers no frame for this many seconds", type=float
+    )
+    args = parser.parse_args()
+
+    device = GenTlDevice(
+        args.model_name, args.input, serial_number=args.serial_number, fetch_timeout=args.fetch_timeout
+    )
+    server = FrameServer(device, args.name, args.slots)
+    server.start()
+    print(f"Publishing frames as '{args.name}', press Ctrl+C to stop.")
+    try:
+        while server.is_alive():
+            server.join(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
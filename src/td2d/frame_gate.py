@@ -0,0 +1,79 @@
+import cv2
+import numpy
+
+
+class FrameGate:
+    """Decides whether a frame is worth running the detection on, based on a subsampled copy of it.
+
+    A frame is skipped if
+    - it hardly differs from the last frame that passed: in none of its blocks of block x block (subsampled) pixels
+      the mean absolute difference of their gray values exceeds min_change. Averaging per block rather than over
+      the whole frame keeps a small moving object from being drowned out by the static rest, while still
+      averaging out noise. Comparing against the last passed frame instead of the previous one makes slow drifts
+      pass eventually.
+    - it is blurred, e.g. by motion: the variance of its Laplacian is below min_relative_sharpness times that of the
+      sharpest recent frames, or below min_sharpness. The sharpness reference decays by sharpness_decay per frame,
+      so that it follows changes of the scene.
+
+    Subsampling takes every subsample-th pixel of every subsample-th row (of the green channel for color images),
+    so the cost per frame is a small fraction of a single full size pass.
+    """
+
+    def __init__(
+        self,
+        subsample=8,
+        min_change=3.0,
+        min_relative_sharpness=0.5,
+        min_sharpness=0.0,
+        sharpness_decay=0.99,
+        block=8,
+    ):
+        self.subsample = subsample
+        self.block = block
+        self.min_change = min_change
+        self.min_relative_sharpness = min_relative_sharpness
+        self.min_sharpness = min_sharpness
+        self.sharpness_decay = sharpness_decay
+        self.sharpness = 0.0
+        self.change = 0.0
+        self.static_frames = 0
+        self.blurred_frames = 0
+        self._reference = None
+        self._sharpness_reference = 0.0
+
+    def reset(self) -> None:
+        """Let the next frame pass regardless of its change, e.g. after the detection settings have changed"""
+        self._reference = None
+
+    def _subsampled(self, image: numpy.ndarray) -> numpy.ndarray:
+        small = image[:: self.subsample, :: self.subsample]
+        if small.ndim == 3:
+            small = small[..., 1]
+        return numpy.ascontiguousarray(small)
+
+    def _change(self, small: numpy.ndarray) -> float:
+        """Largest mean absolute difference to the reference over any block"""
+        difference = cv2.absdiff(small, self._reference).astype(numpy.float32)
+        height, width = difference.shape
+        grid = max(width // self.block, 1), max(height // self.block, 1)
+        return float(cv2.resize(difference, grid, interpolation=cv2.INTER_AREA).max())
+
+    def check(self, image: numpy.ndarray) -> bool:
+        """True if the detection should run on this image"""
+        small = self._subsampled(image)
+        if self._reference is not None and self._reference.shape == small.shape:
+            self.change = self._change(small)
+            if self.change <= self.min_change:
+                self.static_frames += 1
+                return False
+        else:
+            self.change = float("inf")
+
+        self.sharpness = float(cv2.Laplacian(small, cv2.CV_32F).var())
+        self._sharpness_reference = max(self.sharpness, self._sharpness_reference * self.sharpness_decay)
+        if self.sharpness < max(self.min_sharpness, self.min_relative_sharpness * self._sharpness_reference):
+            self.blurred_frames += 1
+            return False
+
+        self._reference = small
+        return True
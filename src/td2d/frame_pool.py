@@ -0,0 +1,55 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from typing import Any
+from typing import Callable
+from typing import Optional
+from typing import Tuple
+
+from .device import Frame
+
+
+class OrderedFramePool:
+    """Processes frames in parallel, handing results back in the order of the frames.
+
+    Frames are dispatched round-robin to `workers` worker threads, each calling function(image, *args) on its frame.
+    OpenCV releases the GIL while working, so threads scale with cores without copying frames between processes.
+
+    `submit` returns the most recent result which is complete along with all results of earlier frames. Results
+    completed in the meantime but superseded by a newer one are skipped (counted in skipped_results), as are
+    results never waited for. At most max_pending frames are in flight, once the workers fall that far behind,
+    `submit` waits for the oldest one.
+
+    Images are copied on submission, as capture devices may reuse their buffers for the next frame.
+    """
+
+    def __init__(self, function: Callable, workers: int, max_pending: int = None):
+        self.function = function
+        self.max_pending = max_pending or 2 * workers
+        self.skipped_results = 0
+        self._executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix="td2d_frames") for _ in range(workers)]
+        self._pending = deque()
+        self._submitted = 0
+
+    def submit(self, frame: Frame, *args) -> Optional[Tuple[Frame, Any]]:
+        """Dispatch a frame and get the newest result ready in frame order, if there is one"""
+        frame = replace(frame, image=frame.image.copy())
+        executor = self._executors[self._submitted % len(self._executors)]
+        self._pending.append((frame, executor.submit(self.function, frame.image, *args)))
+        self._submitted += 1
+
+        result = None
+        while self._pending and (self._pending[0][1].done() or len(self._pending) > self.max_pending):
+            if result is not None:
+                self.skipped_results += 1
+            frame, future = self._pending.popleft()
+            result = frame, future.result()
+        return result
+
+    def shutdown(self) -> None:
+        """Stop the workers, dropping frames not yet processed"""
+        for frame, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        for executor in self._executors:
+            executor.shutdown(wait=True)
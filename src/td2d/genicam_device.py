@@ -1,59 +1,433 @@
+import time
+from dataclasses import replace
+from threading import Event
+from threading import Lock
+from threading import RLock
+from threading import Thread
+from typing import Dict
+from typing import Tuple
+
 from numpy import ndarray
 from harvesters.core import Harvester
 
+from .calibration import SensorWindow
 from .device import CaptureDevice
+from .device import Frame
 
 
 class GenTlDeviceError(Exception):
     pass
 
 
+class GenTlDeviceManager:
+    """
+    A Harvester per GenTL producer, shared by all devices opened through it (see `get`).
+
+    Loading the producer and enumerating its devices are the slow parts of opening a device, they happen once per
+    producer instead of on every open. Enumerating again invalidates all devices opened through the Harvester, so
+    it's only done while none is open: when a device can't be found or opened, e.g. after it was replugged.
+    While others are open, opening such a device fails until they are closed. There is a single Harvester per
+    producer and process, as producers need not support being opened more than once (TLOpen).
+    """
+
+    _managers: Dict[str, "GenTlDeviceManager"] = {}
+    _managers_lock = Lock()
+
+    def __init__(self, gentl_endpoint: str):
+        self.endpoint = gentl_endpoint
+        self.harvester = Harvester()
+        self.harvester.add_file(gentl_endpoint)
+        self._is_enumerated = False
+        self._acquirers = set()
+        self._lock = RLock()
+
+    @classmethod
+    def get(cls, gentl_endpoint: str) -> "GenTlDeviceManager":
+        """The shared manager of a GenTL producer, created on first use"""
+        with cls._managers_lock:
+            if gentl_endpoint not in cls._managers:
+                cls._managers[gentl_endpoint] = cls(gentl_endpoint)
+            return cls._managers[gentl_endpoint]
+
+    @property
+    def is_in_use(self) -> bool:
+        """True while devices opened through this manager are open"""
+        return bool(self._acquirers)
+
+    def refresh(self) -> None:
+        """Enumerate the producer's devices again, e.g. after a device was plugged in. Only while none is open."""
+        with self._lock:
+            if self._acquirers:
+                raise GenTlDeviceError(f"Can't enumerate devices while {len(self._acquirers)} are open")
+            self.harvester.update()
+            self._is_enumerated = True
+
+    def _match(self, model_name: str = None, serial_number: str = None):
+        for info in self.harvester.device_info_list:
+            if model_name is not None and info.model != model_name:
+                continue
+            if serial_number is not None and info.serial_number != serial_number:
+                continue
+            return info
+        return None
+
+    def find(self, model_name: str = None, serial_number: str = None):
+        """Device info of the first device of the given model and/or serial number.
+
+        If there is none, the devices are enumerated again, unless that would invalidate open devices.
+        """
+        with self._lock:
+            if not self._is_enumerated:
+                self.refresh()
+            info = self._match(model_name, serial_number)
+            if info is None and not self._acquirers:
+                self.refresh()
+                info = self._match(model_name, serial_number)
+            if info is None:
+                if len(self.harvester.device_info_list) == 0:
+                    raise GenTlDeviceError("No devices detected!")
+                name = model_name if serial_number is None else f"{model_name} ({serial_number})"
+                raise GenTlDeviceError(f"No device with name: {name} is present.")
+            return info
+
+    def open(self, model_name: str = None, serial_number: str = None) -> Tuple[object, str]:
+        """Create an image acquirer for the device, returns it along with the device's serial number.
+
+        Close it with `close`. If the device can't be opened using the current enumeration, e.g. because it restarted
+        since, the devices are enumerated again, unless that would invalidate open devices.
+        """
+        with self._lock:
+            try:
+                acquirer, serial_number = self._create(self.find(model_name, serial_number))
+            except GenTlDeviceError as e:
+                if self._acquirers:
+                    # enumerating again would invalidate them, the caller may retry once they are closed
+                    raise GenTlDeviceError(f"{e} Waiting for {len(self._acquirers)} open devices to be closed.")
+                self.refresh()
+                acquirer, serial_number = self._create(self.find(model_name, serial_number))
+            self._acquirers.add(acquirer)
+            return acquirer, serial_number
+
+    def _create(self, info) -> Tuple[object, str]:
+        search_key = {"serial_number": info.serial_number} if info.serial_number else {"model": info.model}
+        try:
+            return self.harvester.create(search_key), info.serial_number
+        except Exception as e:  # ValueError if not found, GenTL exceptions for devices gone since the enumeration
+            raise GenTlDeviceError(f"Could not open device {search_key}: {e}")
+
+    def close(self, acquirer) -> None:
+        """Close a device opened through this manager"""
+        with self._lock:
+            self._acquirers.discard(acquirer)
+            try:
+                acquirer.destroy()
+            except Exception:  # a lost device may fail to shut down cleanly, it's released either way
+                pass
+
+    def shutdown(self) -> None:
+        """Close all devices and release the producer"""
+        with self._lock:
+            self._acquirers.clear()
+            self.harvester.reset()
+            self._is_enumerated = False
+
+
 class GenTlDevice(CaptureDevice):
     """
     Get live stream frames from a GenICam device via a GenTL producer.
-    Input color format is expected to be RBG8.
+    Input color format is expected to be RBG8, unless a different pixel_format (e.g. Mono8) is requested.
+
+    The device is the first one of model_name, or the one with the given serial_number. Devices are opened through
+    the producer's shared `GenTlDeviceManager`, which loads the producer and enumerates its devices only once. If the
+    device needs the producer enumerated again (it can't be found or reopened) while other devices of the producer
+    are open, opening it fails until they are closed, so that they aren't affected.
 
-    Input gets resized to WIDTH_HEIGHT
+    If a sensor_window is given, the camera is configured to only read out (and transfer) that part of the sensor,
+    binned as requested. Hardware constraints may slightly alter the window, the one actually applied is available
+    as `sensor_window` and is what should be passed on to the `OpenCVCalibrator`. Otherwise, and again on `stop`,
+    the camera is set to read out its full sensor in DEFAULT_PIXEL_FORMAT, as the settings persist on the camera.
+
+    If fetch_timeout (seconds) is given, a device which delivers no frame for that long is considered stalled: it is
+    closed and reopened by a background thread, every reconnect_interval seconds until that succeeds (e.g. once the
+    other devices are closed, if the producer needs to be enumerated again). Meanwhile `get_next_frame` returns the
+    last good frame again, flagged as `Frame.is_stale`, at most every fetch_timeout seconds. The sensor
+    configuration is applied again on reopening. Without fetch_timeout, fetching waits indefinitely.
+
+    WIDTH_HEIGHT is the default working resolution, used to choose a binning factor for the sensor window.
     """
 
     WIDTH_HEIGHT = (800, 600)
+    DEFAULT_PIXEL_FORMAT = "RGB8"
 
-    def __init__(self, model_name: str, gentl_endpoint: str):
+    def __init__(
+        self,
+        model_name: str,
+        gentl_endpoint: str,
+        sensor_window: SensorWindow = None,
+        pixel_format: str = None,
+        serial_number: str = None,
+        fetch_timeout: float = None,
+        reconnect_interval: float = 1.0,
+    ):
         self.endpoint = gentl_endpoint
         self.model_name = model_name
-        self.harvester = Harvester()
+        self.serial_number = serial_number
+        self.manager = GenTlDeviceManager.get(gentl_endpoint)
         self.device = None
         self.buffer = None
-        self._start_capture_device()
+        self.sensor_window = sensor_window
+        self.pixel_format = pixel_format
+        self.fetch_timeout = fetch_timeout
+        self.reconnect_interval = reconnect_interval
+        self.stalls = 0
+        self._clock_offset = None
+        self._last_frame = None
+        self._lock = Lock()
+        self._reconnected = None
+        self._reconnect_event = Event()
+        self._reconnector = None
+        self._is_stopped = False
+        self.device = self._open()
+
+    @property
+    def is_stalled(self) -> bool:
+        """True while the device is being reopened"""
+        return self.device is None
 
-    def _start_capture_device(self):
-        self.harvester.add_file(self.endpoint)
-        self.harvester.update()
+    @property
+    def harvester(self) -> Harvester:
+        return self.manager.harvester
 
-        if len(self.harvester.device_info_list) == 0:
-            raise GenTlDeviceError("No devices detected!")
+    def _open(self):
+        """Open, configure and start the device. Remembers its serial number, so that reopening gets the same one."""
+        device, self.serial_number = self.manager.open(self.model_name, self.serial_number)
         try:
-            self.device = self.harvester.create({"model": self.model_name})
-        except ValueError:
-            raise GenTlDeviceError(f"No device with name: {self.model_name} is present.")
-        self.device.start(run_as_thread=True)
+            self._configure_sensor(device)
+            # the acquisition thread's fetch doesn't honor timeouts, fetch straight from the producer if one is set
+            device.start(run_as_thread=self.fetch_timeout is None)
+        except Exception:
+            self.manager.close(device)
+            raise
+        return device
 
-    def get_next_image(self) -> ndarray:
-        """Get the next available frame from the camera stream"""
+    def _configure_sensor(self, device):
+        """Apply pixel format, binning and sensor window through the GenICam node map. Must happen before start.
+
+        The settings persist on the camera, so the full sensor is restored first (see `_reset_sensor`): a device
+        opened without a sensor_window always delivers the full sensor, whatever the previous process configured.
+        """
+        node_map = device.remote_device.node_map
+        self._reset_sensor(node_map)
+        if self.pixel_format:
+            node_map.PixelFormat.value = self.pixel_format
+        window = self.sensor_window
+        if window is None:
+            return
+
+        binning = self._set_binning(node_map, window.binning)
+        # reset the offsets first, otherwise they limit the maximal width and height
+        node_map.OffsetX.value = 0
+        node_map.OffsetY.value = 0
+        node_map.Width.value = self._fit_to_node(node_map.Width, -(-window.width // binning), round_up=True)
+        node_map.Height.value = self._fit_to_node(node_map.Height, -(-window.height // binning), round_up=True)
+        node_map.OffsetX.value = self._fit_to_node(node_map.OffsetX, window.offset_x // binning)
+        node_map.OffsetY.value = self._fit_to_node(node_map.OffsetY, window.offset_y // binning)
+        self.sensor_window = SensorWindow(
+            node_map.OffsetX.value * binning,
+            node_map.OffsetY.value * binning,
+            node_map.Width.value * binning,
+            node_map.Height.value * binning,
+            binning,
+        )
+
+    @classmethod
+    def _reset_sensor(cls, node_map) -> None:
+        """Read out the full sensor without binning or decimation, in DEFAULT_PIXEL_FORMAT. Must happen before start."""
+        cls._set_binning(node_map, 1)
+        node_map.OffsetX.value = 0
+        node_map.OffsetY.value = 0
+        for name in ("Width", "Height"):
+            node = getattr(node_map, name)
+            maximum = cls._get_node(node_map, name + "Max")
+            node.value = cls._fit_to_node(node, maximum.value if maximum is not None else node.max)
+        pixel_format = cls._get_node(node_map, "PixelFormat")
+        try:
+            pixel_format.value = cls.DEFAULT_PIXEL_FORMAT
+        except Exception:  # e.g. monochrome cameras, which have no color format to return to
+            pass
+
+    @staticmethod
+    def _get_node(node_map, name):
+        try:
+            return getattr(node_map, name)
+        except Exception:  # GenApi raises its own exception types for nodes the device doesn't implement
+            return None
+
+    @staticmethod
+    def _set_binning(node_map, binning: int) -> int:
+        """Set binning, or decimation on devices which don't support it. Returns the factor actually applied."""
+        for horizontal, vertical in (
+            ("BinningHorizontal", "BinningVertical"),
+            ("DecimationHorizontal", "DecimationVertical"),
+        ):
+            node_h = GenTlDevice._get_node(node_map, horizontal)
+            node_v = GenTlDevice._get_node(node_map, vertical)
+            if node_h is None or node_v is None:
+                continue
+            try:
+                node_h.value = binning
+                node_v.value = binning
+            except Exception:
+                continue
+            return int(node_h.value)
+        return 1
+
+    @staticmethod
+    def _fit_to_node(node, value: int, round_up=False) -> int:
+        """Snap value to the increment of an integer node and clamp it to the node's range"""
+        steps, remainder = divmod(value - node.min, node.inc)
+        if round_up and remainder:
+            steps += 1
+        return int(min(max(node.min + steps * node.inc, node.min), node.max))
+
+    def _fetch(self):
+        # fetch before handing back the previous buffer, so that the last image stays intact if the fetch fails
+        buffer = self.device.fetch(timeout=self.fetch_timeout) if self.fetch_timeout else self.device.fetch()
         if self.buffer:
             self.buffer.queue()  # data in buffer will not be available anymore after this
 
-        self.buffer = self.device.fetch()
+        self.buffer = buffer
         image = self.buffer.payload.components[0]
         data = image.data
-        data = data.reshape(image.height, image.width, int(image.num_components_per_pixel))
-        return data
+        num_components = int(image.num_components_per_pixel)
+        if num_components == 1:
+            return data.reshape(image.height, image.width)
+        return data.reshape(image.height, image.width, num_components)
+
+    def get_next_image(self) -> ndarray:
+        """Get the next available frame from the camera stream"""
+        return self.get_next_frame().image
+
+    def get_next_frame(self) -> Frame:
+        """Get the next available frame from the camera stream, stamped with the device's timestamp and frame id.
+
+        The device clock is mapped onto the host clock using the smallest observed difference between the two,
+        i.e. the fastest delivered frame is assumed to have arrived instantly. Capture times are therefore accurate
+        relative to each other and err on the late side by at most the minimal transfer time. Frames of producers
+        which provide no device timestamp are considered to be captured upon receiving them.
+
+        While a stalled device is being reopened, this is the last good frame, flagged as stale (see the class doc).
+        """
+        if self.device is None and not self._adopt_reconnected():
+            return self._stale_frame()
+        try:
+            image = self._fetch()
+        except Exception:  # GenTL raises its own exception types, for timeouts as well as lost devices
+            if not self.fetch_timeout:
+                raise
+            self._stall()
+            return self._stale_frame()
+
+        receive_time = time.perf_counter()
+        device_time = self._device_time(self.buffer)
+        if device_time is None:
+            device_time = receive_time  # no device clock, the frame is considered captured upon receiving it
+        offset = receive_time - device_time
+        if self._clock_offset is None or offset < self._clock_offset:
+            self._clock_offset = offset
+
+        frame_id = getattr(self.buffer, "frame_id", None)
+        if frame_id is None:
+            self._sequence += 1
+            frame_id = self._sequence
+        self._last_frame = Frame(image, frame_id, device_time + self._clock_offset, receive_time)
+        return self._last_frame
+
+    @staticmethod
+    def _device_time(buffer):
+        """The buffer's device timestamp in seconds, None if the producer provides none.
+
+        BUFFER_INFO_TIMESTAMP_NS is optional in GenTL, producers without it may still provide the timestamp in ticks.
+        """
+        try:
+            return buffer.timestamp_ns * 1e-9
+        except Exception:  # GenTL raises its own exception types for unsupported buffer infos
+            pass
+        try:
+            frequency = buffer.timestamp_frequency
+            if frequency:
+                return buffer.timestamp / frequency
+        except Exception:
+            pass
+        return None
+
+    def _stall(self) -> None:
+        """Close the stalled device and start reopening it in the background"""
+        self.stalls += 1
+        if self._last_frame is not None:
+            # the image is a view into the buffer, which goes away with the device
+            self._last_frame = replace(self._last_frame, image=self._last_frame.image.copy(), is_stale=True)
+        self.buffer = None
+        device, self.device = self.device, None
+        self.manager.close(device)
+        self._reconnect_event.clear()
+        self._reconnector = Thread(target=self._reconnect, name="td2d_gentl_reconnect", daemon=True)
+        self._reconnector.start()
+
+    def _reconnect(self) -> None:
+        while not self._is_stopped:
+            try:
+                device = self._open()
+            except Exception as e:
+                print(f"Reopening {self.model_name} ({self.serial_number}) failed: {e}")
+                if self._is_stopped or self._reconnect_event.wait(self.reconnect_interval):
+                    return
+                continue
+            with self._lock:
+                if self._is_stopped:
+                    self.manager.close(device)
+                else:
+                    self._reconnected = device
+            self._reconnect_event.set()
+            return
+
+    def _adopt_reconnected(self) -> bool:
+        """Switch over to the reopened device, if it's ready. Returns whether it was."""
+        with self._lock:
+            device, self._reconnected = self._reconnected, None
+        if device is None:
+            return False
+        self.device = device
+        self._clock_offset = None  # the device clock may have restarted
+        return True
+
+    def _stale_frame(self) -> Frame:
+        """The last good frame, once the device was reopened (the next call fetches from it) or after fetch_timeout"""
+        if self._reconnect_event.wait(self.fetch_timeout):
+            self._adopt_reconnected()
+        if self._last_frame is None:
+            raise GenTlDeviceError(f"No frame received from {self.model_name} within {self.fetch_timeout}s")
+        return self._last_frame
+
+    def _release(self, device) -> None:
+        """Stop the device, leave it reading out the full sensor for whoever opens it next, and close it"""
+        try:
+            device.stop()
+            self._reset_sensor(device.remote_device.node_map)
+        except Exception as e:  # the device may be gone, e.g. if it stalled
+            print(f"Could not restore the full sensor of {self.model_name} ({self.serial_number}): {e}")
+        self.manager.close(device)
 
     def stop(self) -> None:
-        """Cleanup"""
+        """Cleanup. The shared GenTL producer stays loaded, so that devices can be opened again quickly."""
+        with self._lock:
+            self._is_stopped = True
+            reconnected, self._reconnected = self._reconnected, None
+        self._reconnect_event.set()
         if self.buffer:
             self.buffer.queue()
-        if self.device:
-            self.device.destroy()
-        if self.harvester:
-            self.harvester.reset()
+            self.buffer = None
+        for device in (self.device, reconnected):
+            if device is not None:
+                self._release(device)
+        self.device = None
@@ -1,5 +1,7 @@
+import time
 from dataclasses import dataclass
-from copy import deepcopy
+from threading import Thread
+from typing import NamedTuple
 from typing import Tuple
 
 import numpy
@@ -17,6 +19,7 @@ class UserInput:
     threshold = 0
     should_exit = False
     should_save = False
+    should_reset = False
 
     def reset_booleans(self) -> None:
         """
@@ -24,11 +27,35 @@ class UserInput:
         """
         self.should_save = False
         self.should_exit = False
+        self.should_reset = False
+
+
+class _InputState(NamedTuple):
+    """Immutable snapshot of the controls, replaced as a whole by the display thread.
+
+    Key presses are counted rather than flagged, so that none are lost between two reads.
+    """
+
+    threshold: int
+    min_area: int
+    max_area: int
+    saves: int = 0
+    resets: int = 0
+    exits: int = 0
 
 
 class UiManager:
     """
     Wraps the windowing and user input functionality of openCV
+
+    The window lives on its own display thread, which renders the most recently posted image at most MAX_FPS
+    times per second and handles keyboard and trackbar events. Posting an image and reading the user input never
+    block the calling thread: the display thread publishes the state of the controls as an immutable snapshot,
+    which readers simply pick up (swapping a reference is atomic, no locks needed).
+
+    Posted images are copied, as capture devices may reuse their buffers for the next frame. Only images posted
+    while the display thread is ready for a new one are taken (and copied), the others are skipped: at most MAX_FPS
+    copies per second, however fast frames are posted.
     """
 
     THRESHOLD_SLIDER_MAX = 10
@@ -36,33 +63,93 @@ class UiManager:
     TILE_AREA_SLIDER_MAX = 60000
     DEF_MAX_TILE_AREA = TILE_AREA_SLIDER_MAX // 2
     DEF_MIN_TILE_AREA = 100
-    WAIT_FOR_INPUT_MS = 10
+    MAX_FPS = 15
 
     def __init__(self, window_name="Window"):
         self.window_name = window_name
         self.user_input = UserInput()
+        self._state = _InputState(self.DEFAULT_THRESHOLD, self.DEF_MIN_TILE_AREA, self.DEF_MAX_TILE_AREA)
+        self._consumed = self._state
+        self._posted = None
+        self._is_ready = True
+        self._canvas = None
+        self._is_displaying = False
+        self._display_thread = None
 
     def get_user_input(self) -> UserInput:
         """
-        Wait for user in put WAIT_FOR_USER
+        Get the current state of the controls, and which keys have been pressed since the last call
         :return:
         """
+        state = self._state
         self.user_input.reset_booleans()
-        k = cv2.waitKey(self.WAIT_FOR_INPUT_MS)
-        if k == ord("q") or self._is_window_closed():
-            self.user_input.should_exit = True
-        if k == ord("s"):
-            self.user_input.should_save = True
-
+        self.user_input.threshold = state.threshold
+        self.user_input.min_area = state.min_area
+        self.user_input.max_area = state.max_area
+        self.user_input.should_save = state.saves > self._consumed.saves
+        self.user_input.should_reset = state.resets > self._consumed.resets
+        self.user_input.should_exit = state.exits > 0
+        self._consumed = state
         return self.user_input
 
     def start(self):
         """
-        Start an OpenCV window and setup control callbacks
+        Start the display thread, which opens an OpenCV window and sets up control callbacks
         :return:
         """
+        self._state = self._consumed = _InputState(
+            self.DEFAULT_THRESHOLD, self.DEF_MIN_TILE_AREA, self.DEF_MAX_TILE_AREA
+        )
+        self._is_displaying = True
+        self._is_ready = True
+        self._display_thread = Thread(target=self._display, name="td2d_display", daemon=True)
+        self._display_thread.start()
+
+    def stop(self):
+        """Stop the display thread and close the window"""
+        self._is_displaying = False
+        if self._display_thread is not None:
+            self._display_thread.join()
+            self._display_thread = None
+
+    def _display(self):
         cv2.namedWindow(self.window_name)
         self._setup_controls()
+        interval = 1.0 / self.MAX_FPS
+        shown = None
+        while self._is_displaying:
+            started = time.perf_counter()
+            posted = self._posted
+            if posted is not None and posted is not shown:
+                self._render(*posted)
+                shown = posted
+                self._is_ready = True
+            remaining_ms = int((interval - (time.perf_counter() - started)) * 1000)
+            self._handle_key(cv2.waitKey(max(remaining_ms, 1)))
+        cv2.destroyWindow(self.window_name)
+
+    def _handle_key(self, k):
+        state = self._state
+        if k == ord("q") or self._is_window_closed():
+            state = state._replace(exits=state.exits + 1)
+        if k == ord("s"):
+            state = state._replace(saves=state.saves + 1)
+        if k == ord("r"):
+            state = state._replace(resets=state.resets + 1)
+        self._state = state
+
+    def _render(self, image: numpy.ndarray, tiles: Tuple[numpy.ndarray]):
+        # drawn into a buffer reused across frames, drawing in color requires converting grayscale images
+        shape = image.shape[:2] + (3,)
+        if self._canvas is None or self._canvas.shape != shape or self._canvas.dtype != image.dtype:
+            self._canvas = numpy.empty(shape, image.dtype)
+        if image.ndim == 2:
+            cv2.cvtColor(image, cv2.COLOR_GRAY2BGR, dst=self._canvas)
+        else:
+            numpy.copyto(self._canvas, image[..., :3])
+        if tiles:
+            cv2.drawContours(self._canvas, tiles, -1, (0, 255, 0), 3)
+        cv2.imshow(self.window_name, self._canvas)
 
     def _is_window_closed(self):
         try:
@@ -71,15 +158,15 @@ class UiManager:
             return True
 
     def _setup_controls(self):
-        # GUI event handlers
+        # GUI event handlers, called on the display thread
         def on_change(value):
-            self.user_input.threshold = value
+            self._state = self._state._replace(threshold=value)
 
         def min_on_change(value):
-            self.user_input.min_area = value
+            self._state = self._state._replace(min_area=value)
 
         def max_on_change(value):
-            self.user_input.max_area = value
+            self._state = self._state._replace(max_area=value)
 
         cv2.createTrackbar("threshold", self.window_name, self.DEFAULT_THRESHOLD, self.THRESHOLD_SLIDER_MAX, on_change)
         cv2.createTrackbar("min_area", self.window_name, self.DEF_MIN_TILE_AREA, self.TILE_AREA_SLIDER_MAX, min_on_change)
@@ -87,13 +174,18 @@ class UiManager:
 
     def draw_selected_tiles(self, on_img: numpy.ndarray, tiles: Tuple[numpy.ndarray]) -> None:
         """
-        Draw the found contours on top of the given image
-        :param on_img: image to draw on
+        Have the found contours drawn on top of the given image by the display thread
+        :param on_img: image to draw on. Copied if the display thread is ready for it, otherwise skipped
         :param tiles: the contours to draw
         """
-        img_copy = deepcopy(on_img)
-        cv2.drawContours(img_copy, tiles, -1, (0, 255, 0), 3)
-        self.show_image(img_copy)
+        self._post(on_img, tiles)
 
     def show_image(self, image):
-        cv2.imshow(self.window_name, image)
+        """Have the image shown by the display thread, like in `draw_selected_tiles`"""
+        self._post(image, ())
+
+    def _post(self, image: numpy.ndarray, tiles) -> None:
+        if not self._is_ready:
+            return  # the previous image hasn't been shown yet
+        self._is_ready = False
+        self._posted = image.copy(), tiles
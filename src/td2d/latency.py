@@ -0,0 +1,82 @@
+from collections import deque
+from dataclasses import dataclass
+from threading import Lock
+
+import numpy
+
+
+@dataclass
+class LatencyReport:
+    """Summary of the capture to publish latency of the most recently published tiles.
+
+    All durations are in milliseconds.
+
+    count: number of published tiles the report is based on
+    p50, p90, p99, max: capture->publish latency percentiles
+    transfer_p50: median capture->receive latency, i.e. the time the frame spent between the sensor and the host
+    dropped_frames: number of frames missing from the sequence numbers seen so far
+    """
+
+    count: int
+    p50: float
+    p90: float
+    p99: float
+    max: float
+    transfer_p50: float
+    dropped_frames: int
+
+    def __str__(self):
+        return (
+            f"latency over {self.count} tiles [ms]: p50:{self.p50:.1f} p90:{self.p90:.1f} p99:{self.p99:.1f} "
+            f"max:{self.max:.1f} (transfer p50:{self.transfer_p50:.1f}), dropped frames: {self.dropped_frames}"
+        )
+
+
+class LatencyTracker:
+    """Keeps track of the latency of published tiles and of gaps in their frames' sequence numbers.
+
+    Only the last `window` tiles are used for the percentiles, sequence gaps are counted since creation (or reset).
+    Safe to use from the publishing thread while another thread asks for reports.
+    """
+
+    def __init__(self, window=1000):
+        self._lock = Lock()
+        self._latencies = deque(maxlen=window)
+        self._transfers = deque(maxlen=window)
+        self._last_sequence = None
+        self.dropped_frames = 0
+
+    def record(self, tile) -> None:
+        """Record the timing information of a freshly published tile."""
+        with self._lock:
+            self._latencies.append(tile.publish_time - tile.capture_time)
+            self._transfers.append(tile.receive_time - tile.capture_time)
+            self._advance(tile.sequence)
+
+    def skip(self, sequence: int) -> None:
+        """Let the tracker know that a frame was received but yielded no tile, so it isn't counted as dropped."""
+        with self._lock:
+            self._advance(sequence)
+
+    def _advance(self, sequence: int) -> None:
+        """Count the frames missing between the last seen sequence number and this one. Call holding the lock."""
+        if self._last_sequence is not None and sequence > self._last_sequence + 1:
+            self.dropped_frames += sequence - self._last_sequence - 1
+        self._last_sequence = sequence
+
+    def report(self) -> LatencyReport:
+        with self._lock:
+            latencies = numpy.array(self._latencies) * 1000.0
+            transfers = numpy.array(self._transfers) * 1000.0
+            dropped = self.dropped_frames
+        if not len(latencies):
+            return LatencyReport(0, 0.0, 0.0, 0.0, 0.0, 0.0, dropped)
+        p50, p90, p99 = numpy.percentile(latencies, (50, 90, 99))
+        return LatencyReport(len(latencies), p50, p90, p99, latencies.max(), float(numpy.median(transfers)), dropped)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._latencies.clear()
+            self._transfers.clear()
+            self._last_sequence = None
+            self.dropped_frames = 0
@@ -1,42 +1,112 @@
 import os
+import time
 from dataclasses import dataclass
 from threading import Thread
+from typing import Any
+from typing import Optional
 from typing import Tuple
 
 import cv2
+import numpy
 from compas.geometry import Point
 from compas.geometry import Vector
 
-from .calibration import OpenCVCalibrationData
-from .calibration import OpenCVCalibrator
+from .calibration_cache import load_calibration_data
+from .calibration_cache import load_calibrator
+from .contours import find_area_contours
+from .detection_log import DetectionLogger
+from .device import Frame
+from .frame_gate import FrameGate
+from .genicam_device import GenTlDevice
 from .gui import UiManager
-from .perception import GenTlDevice
+from .latency import LatencyTracker
 
 
 @dataclass
 class Tile:
+    """A located tile, in real world coordinates.
+
+    sequence, capture_time and receive_time are those of the frame the tile was found in (see `td2d.device.Frame`).
+    publish_time is the time at which the tile was made available to client code, on the same clock.
+    polygon: pixel coordinates of the tile's 4 corners in the undistorted image
+    """
+
     centroid: Tuple[float, float, float]
     direction_vec: Vector
+    sequence: int = -1
+    capture_time: float = 0.0
+    receive_time: float = 0.0
+    publish_time: float = 0.0
+    polygon: Any = None
+
+    @property
+    def age(self) -> float:
+        """Seconds since the image this tile was found in has been captured"""
+        return time.perf_counter() - self.capture_time
 
 
 class TileLocator(Thread):
     """Locates a single tile in an image.
 
-    1. Open a GenTL device
-    2. Load previously created calibration data
+    1. Load previously created calibration data
+    2. Open a GenTL device
     3. Start the run loop
 
+    pixel_format: optionally have the camera deliver e.g. Mono8, as only luminance is used for the detection
+    use_sensor_window: have the camera only read out the part of its sensor needed for the calibration's region of
+        interest (see `OpenCVCalibrationData.sensor_window`), instead of the full sensor
+    show_ui: create the display window and controls. Without them, use `locate` (e.g. through
+        `td2d.aio.AsyncTileLocator`) instead of starting the thread.
+    use_frame_gate: skip the detection for frames which are static or blurred, keeping the last result (see
+        `td2d.frame_gate.FrameGate`, replace `frame_gate` for other settings)
+    subpixel_window: refine the tile's corners to sub-pixel accuracy by fitting lines to its edges, searched for
+        within this many pixels of the detected ones (see `refine_polygon`). This also makes the centroid and
+        direction floats. None to disable.
+    point_undistortion: detect the tile on the distorted frame and only undistort its corners and centroid (see
+        `OpenCVCalibrator.undistort_points`), instead of undistorting the whole frame first
+    log_file: append a record of every located tile to this file (see `td2d.detection_log`)
+    fetch_timeout: reopen the camera if it delivers no frame for this many seconds, keeping the last located tile
+        meanwhile (see `GenTlDevice`)
+
     """
 
-    def __init__(self, gentl_endpoint, camera_model, calibration_file):
+    def __init__(
+        self,
+        gentl_endpoint,
+        camera_model,
+        calibration_file,
+        pixel_format=None,
+        use_sensor_window=False,
+        show_ui=True,
+        use_frame_gate=True,
+        subpixel_window: int = None,
+        point_undistortion=False,
+        log_file: str = None,
+        fetch_timeout: float = None,
+    ):
         super().__init__()
         self._init_gui_values()
-        self.ui_manager = UiManager("Display")
-        self.device = GenTlDevice(camera_model, gentl_endpoint)
-        self.calibrator = OpenCVCalibrator(OpenCVCalibrationData.from_file(calibration_file))
-        self.calibrator.initialize(self.device.get_next_image())
+        self.ui_manager = UiManager("Display") if show_ui else None
+        sensor_window = None
+        if use_sensor_window:
+            sensor_window = load_calibration_data(calibration_file).sensor_window(GenTlDevice.WIDTH_HEIGHT)
+        self.device = GenTlDevice(
+            camera_model, gentl_endpoint, sensor_window, pixel_format, fetch_timeout=fetch_timeout
+        )
+        first_image = self.device.get_next_image()
+        self.calibrator = load_calibrator(
+            calibration_file,
+            image_sizes=(first_image.shape[1::-1],),
+            sensor_window=self.device.sensor_window,
+        )
+        self.calibrator.initialize(first_image)
         self.is_running = False
         self.current_tile = None
+        self.latency = LatencyTracker()
+        self.frame_gate = FrameGate() if use_frame_gate else None
+        self.subpixel_window = subpixel_window
+        self.point_undistortion = point_undistortion
+        self.detection_log = DetectionLogger(log_file) if log_file else None
 
     @staticmethod
     def _init_gui_values():
@@ -57,32 +127,81 @@ class TileLocator(Thread):
         """
         self.is_running = True
         self.ui_manager.start()
+        threshold = None
         while self.is_running:
-            image = self.device.get_next_image()
+            frame = self.device.get_next_frame()
             user_input = self.ui_manager.get_user_input()
-            image = self.calibrator.undistortify(image)
-            image = TileLocator.thresh_binary(image, user_input.threshold)
-
-            polygon, centroid = self.approx_polygon(image)
-
-            if polygon is not None:
-                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-                cv2.drawContours(image, (polygon,), -1, (0, 255, 0), 3)
-                cv2.circle(image, centroid, radius=10, color=(0, 0, 255), thickness=2)
-                pixel_spcae_dir = self._calculate_dir_vec([(p[0, 0], p[0, 1]) for p in polygon])
-                pixel_spcae_dir.scale(0.25)
-                end_x = int(centroid[0] + pixel_spcae_dir.x)
-                end_y = int(centroid[1] + pixel_spcae_dir.y)
-                cv2.line(image, centroid, (end_x, end_y), (255, 0, 0), 3)
-                irl_centroid = self.calibrator.pixel_to_irl_coords(centroid)
-                irl_dir = Vector(*self.calibrator.pixel_to_irl_coords((pixel_spcae_dir.x, pixel_spcae_dir.y)))
-                self.current_tile = Tile(irl_centroid, irl_dir)
-                print(f"irl_centroid: {irl_centroid}")
-            # cv2.circle(image, (1039, 617), radius=5, color=(0, 0, 255), thickness=2)
-            self.ui_manager.show_image(image)
+            if user_input.threshold != threshold and self.frame_gate is not None:
+                self.frame_gate.reset()
+            threshold = user_input.threshold
+            if frame.is_stale:
+                pass  # the camera is being reopened, the current tile remains the last known
+            elif self.frame_gate is not None and not self.frame_gate.check(frame.image):
+                # static or blurred, the current tile (and image on display) remain valid
+                self.latency.skip(frame.sequence)
+            else:
+                tile, image = self.locate(frame, threshold)
+                if tile is not None:
+                    self.current_tile = tile
+                    self.latency.record(tile)
+                    if self.detection_log is not None:
+                        self.detection_log.log(tile, threshold)
+                else:
+                    self.latency.skip(frame.sequence)
+                # cv2.circle(image, (1039, 617), radius=5, color=(0, 0, 255), thickness=2)
+                self.ui_manager.show_image(image)
             if user_input.should_exit:
                 self.stop()
+        self.ui_manager.stop()
         self.device.stop()
+        if self.detection_log is not None:
+            self.detection_log.close()
+        print(self.latency.report())
+
+    def locate(self, frame: Frame, threshold: int, annotate=True) -> Tuple[Optional[Tile], numpy.ndarray]:
+        """Locate the tile in a single frame.
+
+        Returns the tile, None if none was found, along with the thresholded image. If annotate is set, the image is
+        converted to color and the detected contour, centroid and direction are drawn onto it.
+        """
+        image = frame.image if self.point_undistortion else self.calibrator.undistortify(frame.image)
+        gray = TileLocator._smoothen(image)
+        _, image = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)
+
+        polygon, centroid = self.approx_polygon(image)
+        if polygon is None:
+            return None, image
+        if self.subpixel_window:
+            polygon, centroid = self.refine_polygon(gray, polygon, self.subpixel_window)
+        image_polygon, image_centroid = polygon, centroid
+        if self.point_undistortion:
+            points = numpy.vstack((polygon.reshape(-1, 2), centroid))
+            points = self.calibrator.undistort_points(points, frame.image.shape[1::-1])
+            polygon, centroid = points[:-1].reshape(-1, 1, 2), (points[-1, 0], points[-1, 1])
+
+        pixel_spcae_dir = self._calculate_dir_vec([(p[0, 0], p[0, 1]) for p in polygon])
+        pixel_spcae_dir.scale(0.25)
+        if annotate:
+            # drawn onto the thresholded image, which in point_undistortion mode is still distorted
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            center = (int(round(image_centroid[0])), int(round(image_centroid[1])))
+            cv2.drawContours(image, (numpy.round(image_polygon).astype(numpy.int32),), -1, (0, 255, 0), 3)
+            cv2.circle(image, center, radius=10, color=(0, 0, 255), thickness=2)
+            end_x = int(center[0] + pixel_spcae_dir.x)
+            end_y = int(center[1] + pixel_spcae_dir.y)
+            cv2.line(image, center, (end_x, end_y), (255, 0, 0), 3)
+        irl_centroid = self.calibrator.pixel_to_irl_coords(centroid)
+        irl_dir = Vector(*self.calibrator.pixel_to_irl_coords((pixel_spcae_dir.x, pixel_spcae_dir.y)))
+        tile = Tile(
+            irl_centroid,
+            irl_dir,
+            frame.sequence,
+            frame.capture_time,
+            frame.receive_time,
+            time.perf_counter(),
+            numpy.asarray(polygon, dtype=numpy.float32).reshape(-1, 2),
+        )
+        return tile, image
 
     @staticmethod
     def _calculate_dir_vec(points):
@@ -122,13 +241,11 @@ class TileLocator(Thread):
         min_arc_length_factor: the minimum curve length which shall be considered as a contour.
             This is calculated as a fraction of the p
 
-        1. find contours
-        2. filter with given min and max area (in pixel space)
-        3. approximate the corners using and algorithm made by some dude whose initials are (probably were) DP
-        4. get centroid using contour
+        1. find contours, filtered with given min and max area (in pixel space), see `find_area_contours`
+        2. approximate the corners using and algorithm made by some dude whose initials are (probably were) DP
+        3. get centroid using contour
         """
-        contours, hierarchy = cv2.findContours(image, 1, 2)
-        contours = tuple(cnt for cnt in contours if max_area > cv2.contourArea(cnt) > min_area)
+        contours = find_area_contours(image, min_area, max_area, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
         if len(contours) != 1:
             return None, None
         cnt = contours[0]
@@ -139,6 +256,79 @@ class TileLocator(Thread):
         centroid = TileLocator.get_centroid(cnt)
         return polygon, centroid
 
+    @staticmethod
+    def refine_polygon(gray, polygon, window=5, samples=32, margin=0.15, passes=2):
+        """Refine the corners of a polygon found by `approx_polygon` to sub-pixel accuracy.
+
+        Each edge of the polygon is searched for the strongest intensity step along its normal, within window pixels
+        on either side, at samples points. A line is fit through these sub-pixel edge points (cv2.fitLine) and the
+        corners are moved to where adjacent lines intersect. The ends (margin of the edge's length) are left out, so
+        that blurred or rounded corners don't bend the lines; a corner whose edges can't be fit is kept. Unlike
+        cv2.cornerSubPix, which is drawn into the rounding of such corners, this finds the corner of the tile's
+        straight edges. Further passes start from the refined corners, whose edges run closer to the actual ones.
+        Use the grayscale image the polygon was thresholded from, the binary image has no sub-pixel information.
+
+        Returns the refined polygon (float32) and its centroid as floats.
+        """
+        corners = polygon.astype(numpy.float64).reshape(-1, 2)
+        for _ in range(passes):
+            corners = TileLocator._fit_edges(gray, corners, window, samples, margin)
+        refined = corners.astype(numpy.float32).reshape(-1, 1, 2)
+        m = cv2.moments(refined)
+        return refined, (m["m10"] / m["m00"], m["m01"] / m["m00"])
+
+    @staticmethod
+    def _fit_edges(gray, corners, window, samples, margin):
+        """One pass of `refine_polygon`, returns the (n, 2) corners at the intersections of the fitted edges"""
+        starts, ends = corners, numpy.roll(corners, -1, axis=0)
+        directions = ends - starts
+        directions /= numpy.linalg.norm(directions, axis=1, keepdims=True)
+        normals = numpy.column_stack((-directions[:, 1], directions[:, 0]))
+
+        # intensity profiles across each edge: (edges, samples, offsets) positions, interpolated all at once
+        fractions = numpy.linspace(margin, 1.0 - margin, samples)
+        offsets = numpy.arange(-window, window + 0.5, 0.5)
+        centers = starts[:, None, :] + fractions[None, :, None] * (ends - starts)[:, None, :]
+        positions = centers[:, :, None, :] + offsets[None, None, :, None] * normals[:, None, None, :]
+        positions = positions.reshape(-1, len(offsets), 2).astype(numpy.float32)
+        profiles = cv2.remap(gray.astype(numpy.float32), positions[..., 0], positions[..., 1], cv2.INTER_LINEAR)
+
+        # strongest step along each profile, located by fitting a parabola through the gradient around it
+        gradients = numpy.abs(numpy.diff(profiles, axis=1))
+        peaks = numpy.clip(gradients.argmax(axis=1), 1, gradients.shape[1] - 2)
+        rows = numpy.arange(len(peaks))
+        left, center, right = gradients[rows, peaks - 1], gradients[rows, peaks], gradients[rows, peaks + 1]
+        curvature = left - 2 * center + right
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            shift = numpy.where(curvature < 0, 0.5 * (left - right) / curvature, 0.0)
+        # a gradient sample lies between two profile samples, half a step apart
+        edge_offsets = offsets[0] + (peaks + 0.5 + shift) * (offsets[1] - offsets[0])
+        is_edge = (center > 0) & (numpy.abs(shift) <= 1)
+        edge_points = centers + edge_offsets.reshape(-1, samples, 1) * normals[:, None, :]
+        is_edge = is_edge.reshape(-1, samples)
+
+        lines = []
+        for edge in range(len(corners)):
+            points = edge_points[edge][is_edge[edge]]
+            if len(points) < 2:
+                lines.append(None)
+                continue
+            v_x, v_y, x, y = cv2.fitLine(points.astype(numpy.float32), cv2.DIST_HUBER, 0, 0.01, 0.01).ravel()
+            lines.append((numpy.array([x, y]), numpy.array([v_x, v_y])))
+
+        refined = corners.copy()
+        for index in range(len(corners)):
+            previous, current = lines[index - 1], lines[index]
+            if previous is None or current is None:
+                continue
+            (p_0, d_0), (p_1, d_1) = previous, current
+            matrix = numpy.column_stack((d_0, -d_1))
+            if abs(numpy.linalg.det(matrix)) < 1e-6:
+                continue  # (nearly) parallel edges
+            t, _ = numpy.linalg.solve(matrix, p_1 - p_0)
+            refined[index] = p_0 + t * d_0
+        return refined
+
     @staticmethod
     def get_centroid(contour):
         m = cv2.moments(contour)
@@ -146,7 +336,8 @@ class TileLocator(Thread):
 
     @staticmethod
     def _smoothen(image):
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         image = cv2.medianBlur(image, 5)
         return image
 
@@ -0,0 +1,199 @@
+from typing import List
+from typing import Sequence
+
+import numpy
+
+
+class TileIndex:
+    """Spatial index over the 2d footprints of a layout of tiles.
+
+    Tiles are referred to by their index in the layout, i.e. the order in which their meshes were saved.
+    Bounding boxes are bucketed in a uniform grid, stored packed (CSR style): the tile indices of grid cell c are
+    cell_tiles[cell_start[c]:cell_start[c + 1]]. Footprint polygons are stored packed as well, their vertices
+    being vertices[vertex_start[t]:vertex_start[t + 1]].
+
+    All queries are vectorized over the queried points or boxes and only look at tiles in the cells they touch.
+    """
+
+    def __init__(self, boxes, vertices, vertex_start, origin, cell_size, grid_shape, cell_start, cell_tiles):
+        self.boxes = boxes
+        self.vertices = vertices
+        self.vertex_start = vertex_start
+        self.origin = origin
+        self.cell_size = cell_size
+        self.grid_shape = grid_shape
+        self.cell_start = cell_start
+        self.cell_tiles = cell_tiles
+
+    def __len__(self):
+        return len(self.boxes)
+
+    @classmethod
+    def from_polygons(cls, polygons: Sequence[numpy.ndarray], cell_size: float = None) -> "TileIndex":
+        """Create an index from the footprint polygon (or contour) of each tile.
+
+        cell_size defaults to the median size of the tiles' bounding boxes, so a tile typically covers up to 4 cells.
+        """
+        polygons = [numpy.asarray(polygon, dtype=numpy.float64).reshape(-1, 2) for polygon in polygons]
+        counts = numpy.array([len(polygon) for polygon in polygons], dtype=numpy.int64)
+        vertex_start = numpy.concatenate(([0], numpy.cumsum(counts)))
+        if not polygons:
+            return cls(
+                numpy.zeros((0, 4)),
+                numpy.zeros((0, 2)),
+                vertex_start,
+                numpy.zeros(2),
+                1.0,
+                (1, 1),
+                numpy.zeros(2, dtype=numpy.int64),
+                numpy.zeros(0, dtype=numpy.int64),
+            )
+        vertices = numpy.concatenate(polygons)
+        boxes = numpy.hstack(
+            (numpy.minimum.reduceat(vertices, vertex_start[:-1]), numpy.maximum.reduceat(vertices, vertex_start[:-1]))
+        )
+
+        if cell_size is None:
+            sizes = numpy.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+            cell_size = max(float(numpy.median(sizes)), 1e-9)
+        origin = boxes[:, :2].min(axis=0)
+        extent = boxes[:, 2:].max(axis=0) - origin
+        grid_shape = tuple(int(n) for n in numpy.floor(extent / cell_size).astype(numpy.int64) + 1)
+
+        # every (cell, tile) pair for the cells overlapped by each tile's bounding box
+        low = numpy.floor((boxes[:, :2] - origin) / cell_size).astype(numpy.int64)
+        high = numpy.floor((boxes[:, 2:] - origin) / cell_size).astype(numpy.int64)
+        spans = high - low + 1
+        per_tile = spans[:, 0] * spans[:, 1]
+        tiles = numpy.repeat(numpy.arange(len(boxes)), per_tile)
+        local = numpy.arange(per_tile.sum()) - numpy.repeat(numpy.cumsum(per_tile) - per_tile, per_tile)
+        cell_x = low[tiles, 0] + local % spans[tiles, 0]
+        cell_y = low[tiles, 1] + local // spans[tiles, 0]
+        cells = cell_y * grid_shape[0] + cell_x
+
+        order = numpy.argsort(cells, kind="stable")
+        cell_tiles = tiles[order]
+        cell_start = numpy.zeros(grid_shape[0] * grid_shape[1] + 1, dtype=numpy.int64)
+        numpy.add.at(cell_start, cells + 1, 1)
+        cell_start = numpy.cumsum(cell_start)
+        return cls(boxes, vertices, vertex_start, origin, cell_size, grid_shape, cell_start, cell_tiles)
+
+    def _cells_of(self, points: numpy.ndarray) -> numpy.ndarray:
+        """Grid cell of each point, -1 for points outside the grid"""
+        cell_xy = numpy.floor((points - self.origin) / self.cell_size).astype(numpy.int64)
+        inside = (cell_xy >= 0).all(axis=1) & (cell_xy < numpy.array(self.grid_shape)).all(axis=1)
+        return numpy.where(inside, cell_xy[:, 1] * self.grid_shape[0] + cell_xy[:, 0], -1)
+
+    def _candidates(self, cells: numpy.ndarray):
+        """(query, tile) pairs for all tiles listed in each query's cell"""
+        valid = cells >= 0
+        starts = numpy.where(valid, self.cell_start[numpy.maximum(cells, 0)], 0)
+        counts = numpy.where(valid, self.cell_start[numpy.maximum(cells, 0) + 1] - starts, 0)
+        queries = numpy.repeat(numpy.arange(len(cells)), counts)
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        return queries, self.cell_tiles[numpy.repeat(starts, counts) + offsets]
+
+    def query_points(self, points) -> numpy.ndarray:
+        """Index of the tile under each of the given points, -1 where there is none.
+
+        If footprints overlap, the tile with the lowest index wins.
+        """
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        result = numpy.full(len(points), -1, dtype=numpy.int64)
+        queries, tiles = self._candidates(self._cells_of(points))
+        x, y = points[queries, 0], points[queries, 1]
+        box = self.boxes[tiles]
+        in_box = (x >= box[:, 0]) & (x <= box[:, 2]) & (y >= box[:, 1]) & (y <= box[:, 3])
+        queries, tiles = queries[in_box], tiles[in_box]
+        if not len(queries):
+            return result
+
+        hits = self._contains(points[queries], tiles)
+        lowest = numpy.full(len(points), len(self), dtype=numpy.int64)
+        numpy.minimum.at(lowest, queries[hits], tiles[hits])
+        return numpy.where(lowest < len(self), lowest, result)
+
+    def query_point(self, x: float, y: float) -> int:
+        """Index of the tile under the given point, -1 if there is none"""
+        return int(self.query_points(((x, y),))[0])
+
+    def _contains(self, points: numpy.ndarray, tiles: numpy.ndarray) -> numpy.ndarray:
+        """Even-odd point in polygon test of each point against the footprint of its paired tile"""
+        counts = self.vertex_start[tiles + 1] - self.vertex_start[tiles]
+        pairs = numpy.repeat(numpy.arange(len(tiles)), counts)
+        local = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        first = self.vertex_start[tiles][pairs]
+        start = self.vertices[first + local]
+        end = self.vertices[first + (local + 1) % counts[pairs]]
+        px, py = points[pairs, 0], points[pairs, 1]
+        straddles = (start[:, 1] > py) != (end[:, 1] > py)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            crossing_x = start[:, 0] + (py - start[:, 1]) * (end[:, 0] - start[:, 0]) / (end[:, 1] - start[:, 1])
+        crossings = numpy.bincount(pairs, weights=straddles & (px < crossing_x), minlength=len(tiles))
+        return crossings % 2 == 1
+
+    def query_boxes(self, boxes) -> List[numpy.ndarray]:
+        """Indices of the tiles whose bounding boxes overlap each of the given (xmin, ymin, xmax, ymax) boxes"""
+        boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+        if not len(boxes):
+            return []
+        low = numpy.floor((boxes[:, :2] - self.origin) / self.cell_size).astype(numpy.int64)
+        high = numpy.floor((boxes[:, 2:] - self.origin) / self.cell_size).astype(numpy.int64)
+        low = numpy.clip(low, 0, numpy.array(self.grid_shape) - 1)
+        high = numpy.clip(high, 0, numpy.array(self.grid_shape) - 1)
+        outside = (boxes[:, 2:] < self.origin).any(axis=1) | (
+            (boxes[:, :2] - self.origin) >= numpy.array(self.grid_shape) * self.cell_size
+        ).any(axis=1)
+        spans = numpy.where(outside[:, None], 0, high - low + 1)
+
+        # one query per overlapped cell, mapped back to the box it came from
+        per_box = spans[:, 0] * spans[:, 1]
+        box_ids = numpy.repeat(numpy.arange(len(boxes)), per_box)
+        local = numpy.arange(per_box.sum()) - numpy.repeat(numpy.cumsum(per_box) - per_box, per_box)
+        safe_spans = numpy.maximum(spans[box_ids, 0], 1)
+        cells = (low[box_ids, 1] + local // safe_spans) * self.grid_shape[0] + low[box_ids, 0] + local % safe_spans
+        queries, tiles = self._candidates(cells)
+        box_ids = box_ids[queries]
+
+        tile_boxes, query_boxes = self.boxes[tiles], boxes[box_ids]
+        overlaps = (
+            (tile_boxes[:, 0] <= query_boxes[:, 2])
+            & (tile_boxes[:, 2] >= query_boxes[:, 0])
+            & (tile_boxes[:, 1] <= query_boxes[:, 3])
+            & (tile_boxes[:, 3] >= query_boxes[:, 1])
+        )
+        # a tile spanning several cells of the same box shows up once per cell
+        pairs = numpy.unique(numpy.column_stack((box_ids[overlaps], tiles[overlaps])), axis=0)
+        splits = numpy.searchsorted(pairs[:, 0], numpy.arange(1, len(boxes)))
+        return numpy.split(pairs[:, 1], splits)
+
+    def query_box(self, xmin: float, ymin: float, xmax: float, ymax: float) -> numpy.ndarray:
+        """Indices of the tiles whose bounding boxes overlap the given box"""
+        return self.query_boxes(((xmin, ymin, xmax, ymax),))[0]
+
+    def save(self, path: str) -> None:
+        numpy.savez(
+            path,
+            boxes=self.boxes,
+            vertices=self.vertices,
+            vertex_start=self.vertex_start,
+            origin=self.origin,
+            cell_size=self.cell_size,
+            grid_shape=numpy.array(self.grid_shape),
+            cell_start=self.cell_start,
+            cell_tiles=self.cell_tiles,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "TileIndex":
+        with numpy.load(path) as data:
+            return cls(
+                data["boxes"],
+                data["vertices"],
+                data["vertex_start"],
+                data["origin"],
+                float(data["cell_size"]),
+                tuple(int(n) for n in data["grid_shape"]),
+                data["cell_start"],
+                data["cell_tiles"],
+            )
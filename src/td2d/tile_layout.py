@@ -0,0 +1,150 @@
+from dataclasses import dataclass
+from typing import List
+from typing import Sequence
+
+import cv2
+import numpy
+
+
+@dataclass
+class LayoutTile:
+    """A tile accumulated over several detections.
+
+    The outline is kept as the polygon of the first detection, whose vertices are running means over all detections:
+    each detection contributes the point of its outline closest to every vertex (see `TileLayout._correspond`).
+    Averaging vertices, rather than e.g. distances sampled at fixed angles, keeps corners sharp and works for any
+    (also non-convex) outline.
+
+    is_dirty: the outline changed noticeably since the tile's mesh was created last
+    mesh: the most recently created mesh (or whatever the owner caches per tile), see `set_mesh`
+    meshed_vertices: vertices the mesh was created from, None before the first mesh
+    """
+
+    centroid: numpy.ndarray
+    vertices: numpy.ndarray
+    count: int = 1
+    is_dirty: bool = True
+    mesh: object = None
+    meshed_vertices: numpy.ndarray = None
+
+    def set_mesh(self, mesh) -> None:
+        """Store the mesh created from the current outline, which is what later changes are measured against"""
+        self.mesh = mesh
+        self.meshed_vertices = self.vertices
+        self.is_dirty = False
+
+    def drift(self) -> float:
+        """How far the outline moved since the mesh was created: the largest displacement of a vertex"""
+        if self.meshed_vertices is None:
+            return float("inf")
+        return float(numpy.linalg.norm(self.vertices - self.meshed_vertices, axis=1).max())
+
+    def outline(self, tolerance: float = 0.0) -> numpy.ndarray:
+        """The averaged outline as an OpenCV contour (m, 1, 2), simplified by tolerance"""
+        points = self.vertices.astype(numpy.float32).reshape(-1, 1, 2)
+        return cv2.approxPolyDP(points, tolerance, True) if tolerance > 0 else points
+
+
+class TileLayout:
+    """Accumulates the tiles detected in several frames into one layout, without duplicates.
+
+    A detection is matched to a known tile if their centroids are close and their outlines overlap by at least
+    min_iou (intersection over union, of the convex hulls). Matched detections are averaged into the known tile,
+    unmatched ones are added as new tiles. Tiles whose averaged outline moved by more than change_tolerance since
+    their mesh was created are flagged as dirty, so that only those need to be re-meshed. Measuring against the
+    meshed outline, rather than per merge, also catches slow drifts.
+
+    All detections must be in the same coordinate system, i.e. the camera doesn't move between frames, or the
+    contours have been projected to world coordinates beforehand.
+    """
+
+    def __init__(self, min_iou=0.5, change_tolerance=1.0):
+        self.min_iou = min_iou
+        self.change_tolerance = change_tolerance
+        self.tiles: List[LayoutTile] = []
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def clear(self) -> None:
+        self.tiles = []
+
+    def merge(self, contours: Sequence[numpy.ndarray]) -> int:
+        """Merge the contours detected in one frame into the layout. Returns the number of new or changed tiles."""
+        if not len(contours):
+            return 0
+        polygons = [numpy.asarray(contour, dtype=numpy.float64).reshape(-1, 2) for contour in contours]
+        centroids = numpy.array([self._centroid(polygon) for polygon in polygons])
+        sizes = numpy.array([numpy.ptp(polygon, axis=0).max() for polygon in polygons])
+
+        matches = numpy.full(len(polygons), -1)
+        if self.tiles:
+            known = numpy.array([tile.centroid for tile in self.tiles])
+            distances = numpy.linalg.norm(centroids[:, None, :] - known[None, :, :], axis=2)
+            # centroids of the same tile can't be further apart than half its size
+            close = distances < sizes[:, None] / 2
+            for index in numpy.flatnonzero(close.any(axis=1)):
+                candidates = numpy.flatnonzero(close[index])
+                for candidate in candidates[numpy.argsort(distances[index, candidates])]:
+                    if self._iou(polygons[index], self.tiles[candidate]) >= self.min_iou:
+                        matches[index] = candidate
+                        break
+
+        changed = 0
+        claimed = set()
+        for polygon, centroid, match in zip(polygons, centroids, matches):
+            if match < 0 or match in claimed:
+                self.tiles.append(LayoutTile(centroid, polygon))
+                changed += 1
+                continue
+            claimed.add(match)
+            tile = self.tiles[match]
+            tile.count += 1
+            # corresponding points are found with both centered, so that a shifted detection doesn't distort the shape
+            points = self._correspond(tile.vertices - tile.centroid, polygon - centroid) + centroid
+            tile.centroid = tile.centroid + (centroid - tile.centroid) / tile.count
+            tile.vertices = tile.vertices + (points - tile.vertices) / tile.count
+            if not tile.is_dirty and tile.drift() > self.change_tolerance:
+                tile.is_dirty = True
+                changed += 1
+        return changed
+
+    def outlines(self, tolerance=0.0, hull=True) -> List[numpy.ndarray]:
+        """Averaged outlines of all tiles, in layout order. tolerance and hull as for `TileFinder.simplified_tiles`."""
+        outlines = [tile.outline(tolerance) for tile in self.tiles]
+        if hull:
+            outlines = [cv2.convexHull(outline) for outline in outlines]
+        return outlines
+
+    @staticmethod
+    def _centroid(polygon: numpy.ndarray) -> numpy.ndarray:
+        """Center of the polygon's area, unlike the mean of its vertices independent of how they are spaced"""
+        moments = cv2.moments(polygon.astype(numpy.float32))
+        if moments["m00"] == 0:
+            return polygon.mean(axis=0)
+        return numpy.array([moments["m10"], moments["m01"]]) / moments["m00"]
+
+    @staticmethod
+    def _correspond(vertices: numpy.ndarray, polygon: numpy.ndarray) -> numpy.ndarray:
+        """The point on the polygon's outline closest to each of vertices.
+
+        For a detection of the same outline, these are its vertices, whatever their order. Vertices the detection
+        lacks (e.g. a corner cut off) or has in addition (e.g. along an edge) only affect the points near them.
+        """
+        starts = polygon[None, :, :]
+        edges = numpy.roll(polygon, -1, axis=0)[None, :, :] - starts
+        lengths = numpy.maximum((edges**2).sum(axis=2), 1e-12)
+        # projection of every vertex onto every edge, clamped to the edge
+        s = numpy.clip(((vertices[:, None, :] - starts) * edges).sum(axis=2) / lengths, 0.0, 1.0)
+        closest = starts + s[:, :, None] * edges
+        distances = numpy.square(closest - vertices[:, None, :]).sum(axis=2)
+        return closest[numpy.arange(len(vertices)), distances.argmin(axis=1)]
+
+    @staticmethod
+    def _iou(polygon: numpy.ndarray, tile: LayoutTile) -> float:
+        """Intersection over union of the convex hulls of the polygon and the tile's outline"""
+        polygon = cv2.convexHull(polygon.astype(numpy.float32))
+        known = cv2.convexHull(tile.outline())
+        intersection, _ = cv2.intersectConvexConvex(polygon, known)
+        union = cv2.contourArea(polygon) + cv2.contourArea(known) - intersection
+        return intersection / union if union > 0 else 0.0
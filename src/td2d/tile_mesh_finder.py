@@ -1,10 +1,13 @@
 import argparse
+import os
 import threading
 from dataclasses import dataclass
+from dataclasses import replace
 from copy import deepcopy
 from typing import Any
 from typing import Callable
 from typing import List
+from typing import Sequence
 from typing import Tuple
 
 import cv2 as cv
@@ -12,12 +15,21 @@ import numpy
 from compas.datastructures import Mesh
 from compas.datastructures import mesh_thicken
 from compas.geometry import Polyhedron
-from compas.data import json_dump
+from compas.data import json_dumps
 
 from td2d.gui import UiManager
 from td2d.gui import UserInput
+from td2d.calibration import OpenCVCalibrator
+from td2d.calibration_cache import load_calibrator
+from td2d.contours import find_area_contours
+from td2d.contours import find_band_contours
+from td2d.device import ImageSequenceDevice
 from td2d.device import SingleImageDevice
+from td2d.frame_bus import SharedMemoryDevice
+from td2d.frame_pool import OrderedFramePool
 from td2d.genicam_device import GenTlDevice
+from td2d.tile_index import TileIndex
+from td2d.tile_layout import TileLayout
 
 
 class ThreadWithReturn(threading.Thread):
@@ -57,18 +69,82 @@ class ThreadWithReturn(threading.Thread):
         return self._result
 
 
+@dataclass
+class ContourSimplification:
+    """
+    Controls how much detail of the tiles' contours is kept, trading it for fewer points to process and store.
+
+    retrieval_mode: OpenCV contour retrieval mode. RETR_EXTERNAL skips contours nested in others (and building
+        the hierarchy), but misses tiles lying within a bright region
+    approximation: OpenCV chain approximation. CHAIN_APPROX_SIMPLE drops the inner points of straight runs, which
+        leaves convex hulls unchanged
+    hull: replace each contour by its convex hull
+    tolerance: maximal deviation of the simplified outline from the contour (Douglas-Peucker), in world units.
+        Zero disables this step
+    units_per_pixel: world units per pixel, to convert the tolerance to pixels. None to have `TileFinder` take it
+        from its calibrator (see `OpenCVCalibrator.units_per_pixel`), without a calibrator units are pixels
+    """
+
+    retrieval_mode: int = cv.RETR_TREE
+    approximation: int = cv.CHAIN_APPROX_SIMPLE
+    hull: bool = True
+    tolerance: float = 0.0
+    units_per_pixel: float = None
+
+    @property
+    def pixel_tolerance(self) -> float:
+        return self.tolerance / (self.units_per_pixel or 1.0)
+
+
 class TileFinder:
     """
     Finds tiles in an image, created meshed and serializes them to a file
 
+    Along with the meshes, a `TileIndex` over the tiles' footprints is saved to index_file, which defaults to
+    the output file's path with an `.index.npz` extension.
+
+    Tiles saved from several frames are accumulated into one `TileLayout`: tiles seen again are merged with their
+    earlier detections rather than duplicated, and only new or changed tiles are meshed again. Press 'r' to start
+    over with an empty layout. Saving also advances image sequences held at their current image (see
+    `ImageSequenceDevice`), the finder stops once the sequence is exhausted.
+
+    With several workers, consecutive frames are processed in parallel (see `OrderedFramePool`). Results are shown
+    and saved in frame order, results superseded before being shown are skipped.
+
+    With intensity bands (thresholds), tiles of different brightness are found in a single pass (see
+    `find_tiles_in_bands`), the threshold slider is then ignored.
+
+    Without a calibrator, meshes are saved in pixel coordinates, extruded by thickness pixels. With a calibrator,
+    tiles are undistorted and projected to world coordinates and extruded by thickness world units, so that the
+    saved meshes can be used as they are.
+
     """
 
     DEFAULT_TILE_THICKNESS = 2
 
-    def __init__(self, capture_device, output_file):
+    def __init__(
+        self,
+        capture_device,
+        output_file,
+        index_file=None,
+        simplification: ContourSimplification = None,
+        workers: int = 1,
+        bands: Sequence[int] = None,
+        calibrator: OpenCVCalibrator = None,
+        thickness: float = DEFAULT_TILE_THICKNESS,
+    ):
         self.is_running = False
+        self.calibrator = calibrator
+        self.thickness = thickness
+        self.image_size = None
+        self.workers = workers
+        self.bands = bands
+        self.simplification = simplification or ContourSimplification()
+        self.vertex_counts = (0, 0)
         self.capture_device = capture_device
         self.output_file = output_file
+        self.index_file = index_file or os.path.splitext(output_file)[0] + ".index.npz"
+        self.layout = TileLayout()
         self.ui_manager = UiManager("Display")
         self.ui_manager.THRESHOLD_SLIDER_MAX = 255
 
@@ -81,37 +157,101 @@ class TileFinder:
         2. read search parameters from user input
         3. find contours
         4. draw contours on top of the image
-        5. if asked to save, create polygons from contours -> create thick meshes from polygons
-            6. serialize meshes to file
+        5. if asked to save, merge contours into the layout -> create thick meshes for new or changed tiles
+            6. serialize meshes to file, along with a spatial index over them
         """
 
         self.is_running = True
         self.ui_manager.start()
+        pool = OrderedFramePool(self.detect, self.workers) if self.workers > 1 else None
+        simplified_tiles = ()
         while self.is_running:
-            image = self.capture_device.get_next_image()
+            try:
+                frame = self.capture_device.get_next_frame()
+            except StopIteration:
+                print("all images processed")
+                break
+            if self.calibrator is not None and not self.calibrator.is_initialized:
+                self.calibrator.initialize(frame.image)
+                if self.simplification.units_per_pixel is None:
+                    units_per_pixel = self.calibrator.units_per_pixel(frame.image.shape[1::-1])
+                    self.simplification = replace(self.simplification, units_per_pixel=units_per_pixel)
             user_input = self.ui_manager.get_user_input()
-            tiles = self.find_tiles(image, user_input.threshold, user_input.min_area, user_input.max_area)
-            simplified_tiles = self.simplified_tiles(tiles)
-            self.ui_manager.draw_selected_tiles(image, simplified_tiles)
-
+            search_parameters = user_input.threshold, user_input.min_area, user_input.max_area
+            if pool is None:
+                result = frame, self.detect(frame.image, *search_parameters)
+            else:
+                result = pool.submit(frame, *search_parameters)
+            if result is not None:
+                frame, (tiles, simplified_tiles) = result
+                self.image_size = frame.image.shape[1::-1]
+                self.vertex_counts = sum(len(t) for t in tiles), sum(len(t) for t in simplified_tiles)
+                self.ui_manager.draw_selected_tiles(frame.image, simplified_tiles)
+
+            if user_input.should_reset:
+                self.layout.clear()
+                print("layout cleared")
             if user_input.should_save:
-                print("started creating meshes..")
-                meshes = self.create_meshes(simplified_tiles)
+                raw_count, simplified_count = self.vertex_counts
+                print(f"simplified contours: {raw_count} -> {simplified_count} vertices")
+                changed = self.layout.merge(simplified_tiles)
+                print(f"started creating meshes.. ({changed} new or changed of {len(self.layout)})")
+                self.save_layout()
                 print("started creating meshes..Done")
-                self.save_meshes(meshes)
+                self.capture_device.advance()
             if user_input.should_exit:
                 self.stop()
 
+        self.ui_manager.stop()
+        if pool is not None:
+            pool.shutdown()
+
+    def detect(self, image: numpy.ndarray, threshold: int, min_area: int, max_area: int):
+        """Find the tiles in an image, returns them as found and simplified according to the finder's settings
+
+        If the finder has intensity bands, they are used instead of the threshold (and the retrieval mode).
+        """
+        if self.bands:
+            tiles = self.find_tiles_in_bands(image, self.bands, min_area, max_area, self.simplification.approximation)
+        else:
+            tiles = self.find_tiles(
+                image,
+                threshold,
+                min_area,
+                max_area,
+                self.simplification.retrieval_mode,
+                self.simplification.approximation,
+            )
+        return tiles, self.simplified_tiles(tiles, self.simplification.pixel_tolerance, self.simplification.hull)
+
     def stop(self) -> None:
         """Stop the finder"""
         self.is_running = False
 
     @staticmethod
-    def simplified_tiles(tiles):
-        return tuple(cv.convexHull(tile) for tile in tiles)
+    def simplified_tiles(tiles, tolerance: float = 0.0, hull: bool = True):
+        """
+        Simplify the tiles' contours
+        :param tiles: the contours tuple as found by OpenCV
+        :param tolerance: maximal deviation (in pixels) of the simplified contour, zero to skip Douglas-Peucker
+        :param hull: replace each contour by its convex hull
+        :return: Tuple containing the simplified contours
+        """
+        if hull:
+            tiles = tuple(cv.convexHull(tile) for tile in tiles)
+        if tolerance > 0:
+            tiles = tuple(cv.approxPolyDP(tile, tolerance, True) for tile in tiles)
+        return tiles
 
     @staticmethod
-    def find_tiles(image: numpy.ndarray, threshold: int, min_area: int, max_area: int) -> Tuple[numpy.ndarray]:
+    def find_tiles(
+        image: numpy.ndarray,
+        threshold: int,
+        min_area: int,
+        max_area: int,
+        retrieval_mode: int = cv.RETR_TREE,
+        approximation: int = cv.CHAIN_APPROX_SIMPLE,
+    ) -> Tuple[numpy.ndarray]:
         """
         Identify tiles in image by finding their shape's contour.
         Filters out contours whose area is smaller than min_area or larger than max_area.
@@ -121,37 +261,93 @@ class TileFinder:
         :param threshold: thresholding value
         :param min_area: max tile area allowed
         :param max_area: min tile area allowed
+        :param retrieval_mode: OpenCV contour retrieval mode
+        :param approximation: OpenCV contour approximation method
         :return: Tuple containing all the found contours which comply with the filter values
         """
-        gray_img = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+        gray_img = cv.cvtColor(image, cv.COLOR_BGR2GRAY) if image.ndim == 3 else image
         _, threshold = cv.threshold(gray_img, threshold, 255, 0)
-        contours, _ = cv.findContours(threshold, cv.RETR_TREE, cv.CHAIN_APPROX_NONE)
+        return tuple(find_area_contours(threshold, min_area, max_area, retrieval_mode, approximation))
 
-        def filter_(contour):
-            area = cv.contourArea(contour)
-            return min_area < area < max_area
+    @staticmethod
+    def find_tiles_in_bands(
+        image: numpy.ndarray,
+        thresholds: Sequence[int],
+        min_area: int,
+        max_area: int,
+        approximation: int = cv.CHAIN_APPROX_SIMPLE,
+    ) -> Tuple[numpy.ndarray]:
+        """
+        Identify tiles of different brightness in one pass, e.g. dark (threshold ~45) and bright (~150) ones.
+        See `find_band_contours`. The bands already separate the tiles from their surroundings, so only the
+        outermost contours of each band are used: nested ones are the holes left by the tiles of another band.
 
-        return tuple(cntr for cntr in contours if filter_(cntr))
+        :param image: an image of tiles
+        :param thresholds: lower bounds of the intensity bands, one band per kind of tile
+        :param min_area: min tile area allowed
+        :param max_area: max tile area allowed
+        :param approximation: OpenCV contour approximation method
+        :return: Tuple containing the found contours of all bands
+        """
+        gray_img = cv.cvtColor(image, cv.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        bands = find_band_contours(gray_img, thresholds, min_area, max_area, cv.RETR_EXTERNAL, approximation)
+        return tuple(contour for contours in bands for contour in contours)
 
-    def save_meshes(self, meshes: List[Polyhedron]) -> None:
+    def save_layout(self) -> None:
+        """
+        Mesh the new or changed tiles of the layout and save all tiles' meshes and the spatial index over them.
+        Serialized meshes are cached per tile, so unchanged tiles cost no meshing nor serialization.
+        With a calibrator, meshes and index are in world coordinates (see `world_outlines`).
         """
-        Serialize the list of meshes to json file
-        :param meshes: list of meshes
+        outlines = self.layout.outlines(self.simplification.pixel_tolerance, self.simplification.hull)
+        if self.calibrator is not None:
+            footprints = self.world_outlines(outlines)
+        else:
+            footprints = [outline.reshape(-1, 2) for outline in outlines]
+        for tile, footprint in zip(self.layout.tiles, footprints):
+            if tile.is_dirty or tile.mesh is None:
+                (mesh,) = self.create_meshes((footprint,), self.thickness)
+                tile.set_mesh(json_dumps(mesh))
+        with open(self.output_file, "w") as f:
+            f.write("[" + ", ".join(tile.mesh for tile in self.layout.tiles) + "]")
+        self.save_index([footprint[:, :2] for footprint in footprints])
+
+    def world_outlines(self, outlines) -> List[numpy.ndarray]:
         """
-        json_dump(meshes, self.output_file)
+        Project the outlines (pixel coordinates of the capture device's images) to world coordinates.
+        The vertices of all outlines are undistorted and projected at once.
+        :param outlines: the contours tuple as found by OpenCV
+        :return: list of (m, 3) arrays of world coordinates
+        """
+        if not len(outlines):
+            return []
+        points = numpy.concatenate([numpy.asarray(outline, dtype=numpy.float64).reshape(-1, 2) for outline in outlines])
+        points = self.calibrator.undistort_points(points, self.image_size)
+        world = self.calibrator.pixels_to_irl_coords(points, self.image_size)
+        return numpy.split(world, numpy.cumsum([len(outline) for outline in outlines])[:-1])
+
+    def save_index(self, contours) -> None:
+        """
+        Save a spatial index over the given contours, in the same order as the meshes created from them
+        :param contours: the contours tuple as found by OpenCV
+        """
+        TileIndex.from_polygons(contours).save(self.index_file)
 
     def create_meshes(self, contours, thickness=DEFAULT_TILE_THICKNESS) -> List[Polyhedron]:
         """
         Iterate on the tule of contours and generate inflated (thickened/extruded) meshes from them
-        :param contours: the contours tuple as found by OpenCV
+        :param contours: the contours tuple as found by OpenCV, or (m, 3) arrays of world coordinates
         :param thickness: the thickness value to use when extruding
         :return: list of meshes
         """
         tiles = []
 
         for cnt in contours:
-            self._remove_weird_extra_dimension_from_numpy_array(cnt)
-            vertices = [[v[0], v[1], 0] for v in cnt]
+            points = numpy.asarray(cnt, dtype=numpy.float64).reshape(len(cnt), -1)
+            if points.shape[1] == 2:
+                # pixel contours lie in the z=0 plane
+                points = numpy.column_stack((points, numpy.zeros(len(points))))
+            vertices = points.tolist()
             face = [list(range(len(vertices)))]
 
             mesh = Mesh.from_vertices_and_faces(vertices, face)
@@ -160,28 +356,84 @@ class TileFinder:
             tiles.append(Polyhedron(vertices, faces))
         return tiles
 
-    @staticmethod
-    def _remove_weird_extra_dimension_from_numpy_array(contour):
-        """(m, 1, n) => (m, n)"""
-        num_of_points = contour.shape[0]
-        point_dim = contour.shape[2]
-        contour.resize((num_of_points, point_dim))
+
+CHAIN_APPROXIMATIONS = {
+    "none": cv.CHAIN_APPROX_NONE,
+    "simple": cv.CHAIN_APPROX_SIMPLE,
+    "tc89_l1": cv.CHAIN_APPROX_TC89_L1,
+    "tc89_kcos": cv.CHAIN_APPROX_TC89_KCOS,
+}
 
 
 def main():
     parser = argparse.ArgumentParser(description="Find tiles in image.")
-    parser.add_argument("-i", "--input", help="Image file path or GenTL endpoint", required=True)
+    parser.add_argument(
+        "-i",
+        "--input",
+        help="Image file path, directory of images, GenTL endpoint or shm:<name> of a running frame server",
+        required=True,
+    )
     parser.add_argument("-o", "--output", help="Path to result file (JSON serialized COMPAS meshes)", required=True)
     parser.add_argument("-n", "--model_name", help="Name of the GenTL camera model to use")
+    parser.add_argument("--external", help="Only find outermost contours", action="store_true")
+    parser.add_argument(
+        "--approximation",
+        help="Contour chain approximation",
+        choices=CHAIN_APPROXIMATIONS.keys(),
+        default="simple",
+    )
+    parser.add_argument("--no_hull", help="Keep contours as found instead of their convex hulls", action="store_true")
+    parser.add_argument("--tolerance", help="Douglas-Peucker tolerance in world units", type=float, default=0.0)
+    parser.add_argument(
+        "--units_per_pixel", help="World units per pixel, default: from the calibration file, if any", type=float
+    )
+    parser.add_argument(
+        "--reduce", help="Decode image files at 1/n resolution", type=int, choices=(1, 2, 4, 8), default=1
+    )
+    parser.add_argument("--workers", help="Number of frames processed in parallel", type=int, default=1)
+    parser.add_argument(
+        "--bands", help="Thresholds of intensity bands, e.g. 45 150 for dark and bright tiles", type=int, nargs="+"
+    )
+    parser.add_argument("-c", "--calibration", help="Calibration file, to save meshes in world coordinates")
+    parser.add_argument(
+        "--thickness",
+        help="Tile thickness, in world units with a calibration file, otherwise in pixels",
+        type=float,
+        default=TileFinder.DEFAULT_TILE_THICKNESS,
+    )
+    parser.add_argument("--gray", help="Decode image files as grayscale", action="store_true")
+    parser.add_argument("--no_resize", help="Keep image files at their decoded resolution", action="store_true")
     args = parser.parse_args()
-
+    simplification = ContourSimplification(
+        cv.RETR_EXTERNAL if args.external else cv.RETR_TREE,
+        CHAIN_APPROXIMATIONS[args.approximation],
+        not args.no_hull,
+        args.tolerance,
+        args.units_per_pixel,
+    )
+
+    size = None if args.no_resize else SingleImageDevice.WIDTH_HEIGHT
     if args.input.endswith(".cti"):
         if not args.model_name:
             raise ValueError("When using a GenTL endpoint please provide a camera model name with '-n'.")
-        capture_device = GenTlDevice(args.input, args.model_name)
+        capture_device = GenTlDevice(args.model_name, args.input)
+    elif args.input.startswith("shm:"):
+        capture_device = SharedMemoryDevice(args.input[len("shm:") :])
+    elif os.path.isdir(args.input):
+        capture_device = ImageSequenceDevice.from_directory(
+            args.input, size=size, reduction=args.reduce, grayscale=args.gray, hold=True
+        )
     else:
-        capture_device = SingleImageDevice(args.input)
-    finder = TileFinder(capture_device, output_file=args.output)
+        capture_device = SingleImageDevice(args.input, size=size, reduction=args.reduce, grayscale=args.gray)
+    finder = TileFinder(
+        capture_device,
+        output_file=args.output,
+        simplification=simplification,
+        workers=args.workers,
+        bands=args.bands,
+        calibrator=load_calibrator(args.calibration) if args.calibration else None,
+        thickness=args.thickness,
+    )
     finder.run()
     capture_device.stop()
 
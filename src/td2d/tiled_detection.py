@@ -0,0 +1,234 @@
+import argparse
+import math
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from typing import Tuple
+
+import cv2
+import numpy
+
+
+def open_image(path: str) -> numpy.ndarray:
+    """Open an image for tiled processing.
+
+    `.npy` files are memory mapped, so only the strips being processed are ever read into memory. Other formats
+    can't be decoded partially by OpenCV and are decoded as a single grayscale image, a third of the size of a
+    color one.
+    """
+    if path.lower().endswith(".npy"):
+        return numpy.load(path, mmap_mode="r")
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError(f"Could not read image: {path}")
+    return image
+
+
+class TiledTileDetector:
+    """Finds tiles in images too large to process in one go, e.g. stitched images of full pallets.
+
+    The image is split into horizontal strips which are thresholded and searched for contours in parallel.
+    OpenCV releases the GIL while doing so, which lets a thread pool use all cores while the strips remain views
+    into the (possibly memory mapped) image. At most 2 * workers strips are in flight, which bounds memory.
+
+    Strips extend `overlap` rows into the next one. A contour belongs to the strip its top row lies in, so that
+    tiles in the overlap aren't found twice. Contours cut by a strip's border (tiles taller than the overlap) are
+    collected and detected again on a window around all of their pieces. Pieces larger than a tile (e.g. of the
+    background's contour) are left out, so that windows stay tile sized.
+
+    retrieval_mode: as for `TileFinder`. The default RETR_TREE also finds tiles darker than their surroundings,
+        which are holes in the background's region.
+    """
+
+    def __init__(
+        self,
+        threshold: int,
+        min_area: int,
+        max_area: int,
+        strip_height=2048,
+        overlap: int = None,
+        workers: int = None,
+        retrieval_mode=cv2.RETR_TREE,
+        approximation=cv2.CHAIN_APPROX_SIMPLE,
+    ):
+        self.threshold = threshold
+        self.min_area = min_area
+        self.max_area = max_area
+        self.strip_height = strip_height
+        # width and height of any tile of up to max_area which isn't overly elongated
+        self.max_extent = int(2 * math.sqrt(max_area)) + 2
+        self.overlap = overlap if overlap is not None else self.max_extent
+        self.workers = workers or os.cpu_count() or 1
+        self.retrieval_mode = retrieval_mode
+        self.approximation = approximation
+
+    def find_tiles(self, image: numpy.ndarray) -> Tuple[numpy.ndarray]:
+        """All tile contours in the image, in image coordinates"""
+        height = image.shape[0]
+        starts = range(0, height, self.strip_height)
+        tiles = []
+        pieces = []
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = deque()
+            for start in starts:
+                end = min(start + self.strip_height + self.overlap, height)
+                pending.append(pool.submit(self._process_strip, image, start, end, height))
+                if len(pending) >= 2 * self.workers:
+                    self._collect(pending.popleft().result(), tiles, pieces)
+            while pending:
+                self._collect(pending.popleft().result(), tiles, pieces)
+
+        boxes = [cv2.boundingRect(tile) for tile in tiles]
+        known = set(boxes)
+        pieces = self._unexplained_pieces(pieces, boxes)
+        for window in self._piece_windows(pieces, image.shape):
+            for tile in self._process_window(image, window):
+                box = cv2.boundingRect(tile)
+                if box not in known:
+                    known.add(box)
+                    tiles.append(tile)
+        return tuple(tiles)
+
+    @staticmethod
+    def _collect(result, tiles: list, pieces: list) -> None:
+        strip_tiles, strip_pieces = result
+        tiles.extend(strip_tiles)
+        pieces.extend(strip_pieces)
+
+    def _contours(self, region: numpy.ndarray) -> Tuple[List[numpy.ndarray], numpy.ndarray]:
+        if region.ndim == 3:
+            region = cv2.cvtColor(numpy.ascontiguousarray(region), cv2.COLOR_BGR2GRAY)
+        _, binary = cv2.threshold(numpy.ascontiguousarray(region), self.threshold, 255, cv2.THRESH_BINARY)
+        contours, _ = cv2.findContours(binary, self.retrieval_mode, self.approximation)
+        return contours, binary
+
+    def _is_tile(self, contour: numpy.ndarray) -> bool:
+        return self.min_area < cv2.contourArea(contour) < self.max_area
+
+    def _process_strip(self, image: numpy.ndarray, start: int, end: int, height: int):
+        """Complete tiles owned by this strip, and the bounding boxes of contours cut by its borders"""
+        tiles = []
+        pieces = []
+        core_end = start + self.strip_height
+        contours, binary = self._contours(image[start:end])
+        if self.retrieval_mode != cv2.RETR_EXTERNAL:
+            # a hole (a tile darker than its surroundings) cut by the border opens up into the surrounding contour,
+            # its piece is a region of the inverted image instead
+            holes, _ = cv2.findContours(cv2.bitwise_not(binary), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for hole in holes:
+                x, y, w, h = cv2.boundingRect(hole)
+                if self._is_piece(y, w, h, start, end, height):
+                    pieces.append((x, y + start, w, h))
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            is_cut = (y == 0 and start > 0) or (y + h == end - start and end < height)
+            if is_cut:
+                if self._is_piece(y, w, h, start, end, height):
+                    pieces.append((x, y + start, w, h))
+                continue
+            if start + y >= core_end or not self._is_tile(contour):
+                continue  # in the overlap, found by the next strip
+            contour += numpy.array((0, start), dtype=contour.dtype)
+            tiles.append(contour)
+        return tiles, pieces
+
+    def _is_piece(self, y: int, w: int, h: int, start: int, end: int, height: int) -> bool:
+        """Whether a contour's bounding box within the strip is cut by its border and could be part of a tile"""
+        is_cut = (y == 0 and start > 0) or (y + h == end - start and end < height)
+        return is_cut and w <= self.max_extent and h <= self.max_extent
+
+    @staticmethod
+    def _unexplained_pieces(pieces, boxes) -> list:
+        """Pieces which aren't part of a tile already found complete by a neighbouring strip"""
+        if not pieces or not boxes:
+            return pieces
+        piece_array = numpy.array(pieces)[:, None, :]
+        box_array = numpy.array(boxes)[None, :, :]
+        contained = (
+            (piece_array[..., 0] >= box_array[..., 0])
+            & (piece_array[..., 1] >= box_array[..., 1])
+            & (piece_array[..., 0] + piece_array[..., 2] <= box_array[..., 0] + box_array[..., 2])
+            & (piece_array[..., 1] + piece_array[..., 3] <= box_array[..., 1] + box_array[..., 3])
+        )
+        return [piece for piece, is_explained in zip(pieces, contained.any(axis=1)) if not is_explained]
+
+    @staticmethod
+    def _piece_windows(pieces, shape, margin=2) -> List[Tuple[int, int, int, int]]:
+        """Merge the bounding boxes of overlapping pieces into windows around the tiles they are cut from"""
+        windows = [list(piece) for piece in pieces]
+        merged = True
+        while merged:
+            merged = False
+            result = []
+            for window in windows:
+                for other in result:
+                    if (
+                        window[0] <= other[0] + other[2]
+                        and other[0] <= window[0] + window[2]
+                        and window[1] <= other[1] + other[3]
+                        and other[1] <= window[1] + window[3]
+                    ):
+                        x0, y0 = min(window[0], other[0]), min(window[1], other[1])
+                        x1 = max(window[0] + window[2], other[0] + other[2])
+                        y1 = max(window[1] + window[3], other[1] + other[3])
+                        other[:] = x0, y0, x1 - x0, y1 - y0
+                        merged = True
+                        break
+                else:
+                    result.append(window)
+            windows = result
+
+        height, width = shape[:2]
+        return [
+            (max(x - margin, 0), max(y - margin, 0), min(x + w + margin, width), min(y + h + margin, height))
+            for x, y, w, h in windows
+        ]
+
+    def _process_window(self, image: numpy.ndarray, window) -> List[numpy.ndarray]:
+        x0, y0, x1, y1 = window
+        tiles = []
+        contours, _ = self._contours(image[y0:y1, x0:x1])
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            touches_edge = (x == 0 and x0 > 0) or (y == 0 and y0 > 0)
+            touches_edge |= (x + w == x1 - x0 and x1 < image.shape[1]) or (y + h == y1 - y0 and y1 < image.shape[0])
+            if touches_edge or not self._is_tile(contour):
+                continue
+            contour += numpy.array((x0, y0), dtype=contour.dtype)
+            tiles.append(contour)
+        return tiles
+
+
+def main():
+    from td2d.tile_mesh_finder import TileFinder
+
+    parser = argparse.ArgumentParser(description="Find tiles in a very large (e.g. stitched) image.")
+    parser.add_argument("-i", "--input", help="Image file path, .npy files are memory mapped", required=True)
+    parser.add_argument("-o", "--output", help="Path to result file (JSON serialized COMPAS meshes)", required=True)
+    parser.add_argument("-t", "--threshold", help="Thresholding value", type=int, required=True)
+    parser.add_argument("--min_area", help="Minimal tile area in pixels", type=int, default=100)
+    parser.add_argument("--max_area", help="Maximal tile area in pixels", type=int, default=30000)
+    parser.add_argument("--strip_height", help="Height of the strips processed in parallel", type=int, default=2048)
+    parser.add_argument("--workers", help="Number of worker threads, default is all cores", type=int)
+    parser.add_argument("--external", help="Only find outermost contours", action="store_true")
+    args = parser.parse_args()
+
+    detector = TiledTileDetector(
+        args.threshold,
+        args.min_area,
+        args.max_area,
+        strip_height=args.strip_height,
+        workers=args.workers,
+        retrieval_mode=cv2.RETR_EXTERNAL if args.external else cv2.RETR_TREE,
+    )
+    tiles = detector.find_tiles(open_image(args.input))
+    print(f"found {len(tiles)} tiles")
+
+    finder = TileFinder(None, output_file=args.output)
+    finder.layout.merge(finder.simplified_tiles(tiles))
+    finder.save_layout()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import cv2
+import numpy
+import pytest
+
+CALIBRATION_SIZE = (800, 600)
+
+
+def write_calibration(path, size=CALIBRATION_SIZE, focal_length=1000.0, distortion=(-0.1, 0.01, 0.0, 0.0, 0.0)):
+    """Write a calibration file like the calibration scripts do, of a camera 50 units above the world's xy plane"""
+    width, height = size
+    camera_matrix = numpy.array([[focal_length, 0.0, width / 2], [0.0, focal_length, height / 2], [0.0, 0.0, 1.0]])
+    distortion = numpy.array([distortion], dtype=numpy.float64)
+    new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, distortion, size, 1, size)
+    storage = cv2.FileStorage(str(path), cv2.FILE_STORAGE_WRITE)
+    storage.write("K", camera_matrix)
+    storage.write("D", distortion)
+    storage.write("R", numpy.zeros((3, 1)))
+    storage.write("T", numpy.array([[0.0], [0.0], [50.0]]))
+    storage.write("NK", new_camera_matrix)
+    storage.write("ROI", numpy.array(roi, dtype=numpy.float64).reshape(4, 1))
+    storage.write("SIZE", numpy.array(size, dtype=numpy.float64).reshape(2, 1))
+    storage.release()
+    return str(path)
+
+
+@pytest.fixture
+def calibration_file(tmp_path):
+    return write_calibration(tmp_path / "camera.cal")
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import numpy
+
+from td2d.aio import AsyncCaptureDevice
+from td2d.aio import AsyncTileLocator
+from td2d.device import CaptureDevice
+from td2d.device import Frame
+from td2d.latency import LatencyTracker
+from td2d.perception import Tile
+
+
+class FiniteDevice(CaptureDevice):
+    """count frames, then StopIteration like an `ImageSequenceDevice` without loop"""
+
+    def __init__(self, count):
+        self.count = count
+        self.sequence = 0
+        self.is_stopped = False
+
+    def get_next_image(self):
+        return self.get_next_frame().image
+
+    def get_next_frame(self):
+        if self.sequence == self.count:
+            raise StopIteration
+        self.sequence += 1
+        now = time.perf_counter()
+        return Frame(numpy.zeros((4, 4), dtype=numpy.uint8), self.sequence, now, now)
+
+    def stop(self):
+        self.is_stopped = True
+
+
+class FakeLocator:
+    """The parts of `TileLocator` used by `AsyncTileLocator`, locating a tile in all frames but the rejected ones"""
+
+    def __init__(self, device, rejected=()):
+        self.device = device
+        self.rejected = set(rejected)
+        self.frame_gate = None
+        self.detection_log = None
+        self.current_tile = None
+        self.latency = LatencyTracker()
+
+    def locate(self, frame, threshold, show_ui):
+        if frame.sequence in self.rejected:
+            return None, None
+        tile = Tile((0.0, 0.0, 0.0), (1.0, 0.0, 0.0), frame.sequence, frame.capture_time, frame.receive_time)
+        return tile, None
+
+
+def collect(locator, delay=0.0, **kwargs):
+    async def run():
+        async with AsyncTileLocator(locator, **kwargs) as tiles:
+            sequences = []
+            async for tile in tiles.tiles():
+                sequences.append(tile.sequence)
+                await asyncio.sleep(delay)
+            return sequences, tiles.dropped_tiles
+
+    return asyncio.run(asyncio.wait_for(run(), 5.0))
+
+
+def test_tiles_end_with_the_frames():
+    device = FiniteDevice(5)
+    locator = FakeLocator(device, rejected=(3,))
+    assert collect(locator, drop_stale=False) == ([1, 2, 4, 5], 0)
+    assert locator.current_tile.sequence == 5
+    assert device.is_stopped
+
+
+def test_slow_consumer_gets_the_last_tile():
+    sequences, dropped = collect(FakeLocator(FiniteDevice(5)), delay=0.05)
+    assert sequences[0] == 1
+    assert sequences[-1] == 5
+    assert len(sequences) + dropped == 5
+
+
+def test_frames_end():
+    async def run():
+        async with AsyncCaptureDevice(FiniteDevice(3)) as frames:
+            return [frame.sequence async for frame in frames]
+
+    assert asyncio.run(asyncio.wait_for(run(), 5.0)) == [1, 2, 3]
@@ -0,0 +1,65 @@
+import cv2
+import numpy
+import pytest
+
+from td2d.calibration import OpenCVCalibrationData
+from td2d.calibration import OpenCVCalibrator
+from td2d.calibration import SensorWindow
+
+CALIBRATION_SIZE = (800, 600)  # see conftest.write_calibration
+
+
+@pytest.fixture
+def calibrator(calibration_file):
+    return OpenCVCalibrator(OpenCVCalibrationData.from_file(calibration_file))
+
+
+def to_size(points, scale):
+    """Pixel coordinates of the same points in an image scaled by scale, about pixel centers like cv2.resize"""
+    return (numpy.asarray(points, dtype=numpy.float64) + 0.5) * scale - 0.5
+
+
+def test_image_size_from_file(calibrator):
+    assert calibrator.calibration_image_size == CALIBRATION_SIZE
+
+
+@pytest.mark.parametrize("scale", [0.5, 0.25, 2.0])
+def test_scaled_views_agree_in_world_coordinates(calibrator, scale):
+    raw = numpy.array([[400.0, 300.0], [123.0, 456.0], [700.0, 50.0]])
+    world = calibrator.pixels_to_irl_coords(calibrator.undistort_points(raw, CALIBRATION_SIZE), CALIBRATION_SIZE)
+    size = int(CALIBRATION_SIZE[0] * scale), int(CALIBRATION_SIZE[1] * scale)
+    scaled = calibrator.pixels_to_irl_coords(calibrator.undistort_points(to_size(raw, scale), size), size)
+    numpy.testing.assert_allclose(scaled, world, atol=1e-6)
+
+
+def test_units_per_pixel_scale_with_the_image(calibrator):
+    full = calibrator.units_per_pixel(CALIBRATION_SIZE)
+    half = calibrator.units_per_pixel((CALIBRATION_SIZE[0] // 2, CALIBRATION_SIZE[1] // 2))
+    assert full > 0
+    assert half == pytest.approx(2 * full)
+
+
+def test_undistort_points_matches_undistortify(calibrator):
+    image = numpy.zeros(CALIBRATION_SIZE[::-1], dtype=numpy.uint8)
+    raw = numpy.array([[100.0, 80.0], [400.0, 300.0], [690.0, 520.0]])
+    for x, y in raw.astype(int):
+        cv2.circle(image, (int(x), int(y)), 4, 255, cv2.FILLED)
+
+    undistorted = calibrator.undistortify(image)
+    _, _, _, centroids = cv2.connectedComponentsWithStats(cv2.threshold(undistorted, 127, 255, cv2.THRESH_BINARY)[1])
+    expected = calibrator.undistort_points(raw, CALIBRATION_SIZE)
+    found = centroids[1:][numpy.argsort(centroids[1:, 0])]
+    numpy.testing.assert_allclose(found, expected[numpy.argsort(expected[:, 0])], atol=0.5)
+
+
+def test_sensor_window_view_matches_cropped_full_view(calibration_file):
+    data = OpenCVCalibrationData.from_file(calibration_file)
+    window = SensorWindow(100, 50, 600, 500, 2)
+    full = OpenCVCalibrator(data)
+    windowed = OpenCVCalibrator(data, sensor_window=window)
+    raw = numpy.array([[400.0, 300.0], [150.0, 120.0]])
+    world = full.pixels_to_irl_coords(full.undistort_points(raw, CALIBRATION_SIZE), CALIBRATION_SIZE)
+    binned = to_size(raw - (window.offset_x, window.offset_y), 1 / window.binning)
+    size = window.image_size
+    found = windowed.pixels_to_irl_coords(windowed.undistort_points(binned, size), size)
+    numpy.testing.assert_allclose(found, world, atol=1e-6)
@@ -0,0 +1,95 @@
+import os
+
+import numpy
+import pytest
+
+from td2d import calibration_cache
+from td2d.calibration import OpenCVCalibrationData
+from td2d.calibration import SensorWindow
+from td2d.calibration_cache import CalibrationCache
+from td2d.calibration_cache import load_calibration_data
+from td2d.calibration_cache import load_calibrator
+
+IMAGE_SIZES = [(800, 600), (400, 300)]
+
+
+@pytest.fixture
+def cache_file(tmp_path):
+    return str(tmp_path / "camera.cal.bin")
+
+
+def assert_same_views(cached, calibrator):
+    assert sorted(cached._views) == sorted(calibrator._views)
+    for size, view in calibrator._views.items():
+        cached_view = cached._views[size]
+        assert cached_view.region_of_interest == view.region_of_interest
+        for name in ("map_x", "map_y", "pixel_to_world"):
+            numpy.testing.assert_array_equal(getattr(cached_view, name), getattr(view, name))
+        numpy.testing.assert_array_equal(
+            cached_view.calibration_data.new_camera_matrix, view.calibration_data.new_camera_matrix
+        )
+
+
+def test_round_trip(calibration_file, cache_file):
+    calibrator = load_calibrator(calibration_file, cache_file, IMAGE_SIZES)
+    assert os.path.exists(cache_file)
+    source_hash = CalibrationCache.source_hash(calibration_file)
+    assert CalibrationCache(cache_file).is_valid(source_hash)
+
+    cached = load_calibrator(calibration_file, cache_file, IMAGE_SIZES)
+    assert isinstance(cached._views[IMAGE_SIZES[0]].map_x, numpy.memmap)
+    assert cached.calibration_image_size == calibrator.calibration_image_size
+    assert_same_views(cached, calibrator)
+    points = [[10.0, 20.0], [300.0, 200.0]]
+    numpy.testing.assert_array_equal(
+        cached.pixels_to_irl_coords(points, IMAGE_SIZES[1]), calibrator.pixels_to_irl_coords(points, IMAGE_SIZES[1])
+    )
+
+
+def test_sensor_window_round_trip(calibration_file, cache_file):
+    window = SensorWindow(100, 50, 600, 500, 2)
+    calibrator = load_calibrator(calibration_file, cache_file, [window.image_size], sensor_window=window)
+    cached = CalibrationCache(cache_file).read()
+    assert cached.sensor_window == window
+    assert_same_views(cached, calibrator)
+
+
+def test_stale_cache(calibration_file, cache_file):
+    load_calibrator(calibration_file, cache_file, IMAGE_SIZES)
+    cache = CalibrationCache(cache_file)
+    assert not cache.is_valid(CalibrationCache.source_hash(calibration_file, image_size=(1600, 1200)))
+    assert not cache.is_valid(CalibrationCache.source_hash(calibration_file, sensor_window=SensorWindow(0, 0, 8, 8)))
+
+    with open(calibration_file, "a") as f:
+        f.write("\n")
+    assert not cache.is_valid(CalibrationCache.source_hash(calibration_file))
+    assert cache.read_calibration_data(CalibrationCache.file_hash(calibration_file)) is None
+
+
+def test_calibration_data_regardless_of_views(calibration_file, cache_file):
+    load_calibrator(calibration_file, cache_file, IMAGE_SIZES, sensor_window=SensorWindow(100, 50, 600, 500, 2))
+    cached = CalibrationCache(cache_file).read_calibration_data(CalibrationCache.file_hash(calibration_file))
+    assert cached is not None
+    data = load_calibration_data(calibration_file, cache_file)
+    parsed = OpenCVCalibrationData.from_file(calibration_file)
+    for loaded in (cached, data):
+        numpy.testing.assert_array_equal(loaded.camera_matrix, parsed.camera_matrix)
+        numpy.testing.assert_array_equal(loaded.new_camera_matrix, parsed.new_camera_matrix)
+        assert tuple(loaded.image_size) == parsed.image_size
+
+
+def test_cache_in_use(calibration_file, cache_file, monkeypatch):
+    # on Windows, a memory mapped file can't be replaced
+    load_calibrator(calibration_file, cache_file, IMAGE_SIZES[:1])
+    with open(cache_file, "rb") as f:
+        contents = f.read()
+
+    def replace(source, destination):
+        raise PermissionError(destination)
+
+    monkeypatch.setattr(calibration_cache.os, "replace", replace)
+    calibrator = load_calibrator(calibration_file, cache_file, IMAGE_SIZES)
+    assert sorted(calibrator._views) == sorted(IMAGE_SIZES)
+    with open(cache_file, "rb") as f:
+        assert f.read() == contents
+    assert not [name for name in os.listdir(os.path.dirname(cache_file)) if name.endswith(".tmp")]
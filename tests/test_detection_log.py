@@ -0,0 +1,67 @@
+import numpy
+import pytest
+
+from td2d.detection_log import DetectionLogError
+from td2d.detection_log import DetectionLogger
+from td2d.detection_log import RECORD_DTYPE
+from td2d.detection_log import read_detection_log
+from td2d.perception import Tile
+
+
+def tile(sequence):
+    polygon = numpy.array([[0, 0], [10, 0], [10, 10], [0, 10]], dtype=numpy.float32) + sequence
+    return Tile(
+        (sequence, 2.0, 3.0), (1.0, 0.0, 0.0), sequence, sequence + 0.1, sequence + 0.2, sequence + 0.3, polygon
+    )
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "detections.log")
+
+
+def test_round_trip(path):
+    logger = DetectionLogger(path, batch_size=4)
+    for sequence in range(10):
+        logger.log(tile(sequence), threshold=5)
+    logger.log(Tile((0.0, 0.0, 0.0), (0.0, 1.0, 0.0), 10), threshold=6)
+    logger.close()
+
+    records = read_detection_log(path)
+    assert records.dtype == RECORD_DTYPE
+    numpy.testing.assert_array_equal(records["sequence"], numpy.arange(11))
+    numpy.testing.assert_allclose(records["capture_time"][:10], numpy.arange(10) + 0.1)
+    numpy.testing.assert_allclose(records["publish_time"][:10], numpy.arange(10) + 0.3)
+    numpy.testing.assert_array_equal(records["centroid"][3], (3.0, 2.0, 3.0))
+    numpy.testing.assert_array_equal(records["polygon"][3], tile(3).polygon)
+    assert numpy.isnan(records["polygon"][10]).all()
+    numpy.testing.assert_array_equal(records["threshold"], [5] * 10 + [6])
+    assert logger.dropped_records == 0
+
+
+def test_appends_and_drops_partial_records(path):
+    logger = DetectionLogger(path)
+    logger.log(tile(0), 5)
+    logger.close()
+    with open(path, "ab") as f:
+        f.write(b"\0" * (RECORD_DTYPE.itemsize // 2))  # a record cut short by a crash
+    assert len(read_detection_log(path)) == 1
+
+    logger = DetectionLogger(path)
+    logger.log(tile(1), 5)
+    logger.close()
+    numpy.testing.assert_array_equal(read_detection_log(path)["sequence"], [0, 1])
+
+
+def test_empty_log(path):
+    DetectionLogger(path).close()
+    assert len(read_detection_log(path)) == 0
+
+
+def test_not_a_log(path):
+    with open(path, "wb") as f:
+        f.write(b"something else entirely")
+    with pytest.raises(DetectionLogError):
+        read_detection_log(path)
+    with pytest.raises(DetectionLogError):
+        DetectionLogger(path)
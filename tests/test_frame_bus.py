@@ -0,0 +1,119 @@
+import time
+import uuid
+
+import numpy
+import pytest
+
+from td2d.device import CaptureDevice
+from td2d.device import Frame
+from td2d.frame_bus import FrameBusError
+from td2d.frame_bus import FrameServer
+from td2d.frame_bus import SharedMemoryDevice
+
+SHAPE = (48, 64, 3)
+
+
+def image(sequence):
+    return numpy.full(SHAPE, sequence % 256, dtype=numpy.uint8)
+
+
+class CountingDevice(CaptureDevice):
+    """Frames whose pixels all hold their sequence number, delivered every interval seconds"""
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+        self.sequence = 0
+        self.is_stopped = False
+
+    def get_next_image(self):
+        return self.get_next_frame().image
+
+    def get_next_frame(self):
+        time.sleep(self.interval)
+        self.sequence += 1
+        return Frame(image(self.sequence), self.sequence, self.sequence * 0.1, self.sequence * 0.1 + 0.01)
+
+    def stop(self):
+        self.is_stopped = True
+
+
+@pytest.fixture
+def server():
+    server = FrameServer(CountingDevice(), name=f"td2d_test_{uuid.uuid4().hex[:12]}", slot_count=4)
+    yield server
+    if server.ring is not None:
+        server.stop()
+
+
+@pytest.fixture
+def reader(server):
+    reader = SharedMemoryDevice(server.name, timeout=0.2)
+    yield reader
+    reader.stop()
+
+
+def test_reads_the_latest_frame(server, reader):
+    frame = reader.get_next_frame()
+    assert (frame.sequence, frame.capture_time, frame.receive_time) == (1, 0.1, 0.1 + 0.01)
+    numpy.testing.assert_array_equal(frame.image, image(1))
+
+    for _ in range(3):
+        server.publish(server.capture_device.get_next_frame())
+    frame = reader.get_next_frame()
+    assert frame.sequence == 4  # readers which can't keep up skip frames
+    numpy.testing.assert_array_equal(frame.image, image(4))
+    with pytest.raises(FrameBusError):
+        reader.get_next_frame()  # no newer frame within the timeout
+
+
+def test_frames_are_overwritten_after_slot_count_frames(server, reader):
+    frame = reader.get_next_frame()
+    for _ in range(server.slot_count - 1):
+        server.publish(server.capture_device.get_next_frame())
+        assert reader.is_intact()
+    server.publish(server.capture_device.get_next_frame())
+    assert not reader.is_intact()
+    numpy.testing.assert_array_equal(frame.image, image(5))
+
+
+def test_copies(server):
+    reader = SharedMemoryDevice(server.name, copy=True)
+    frame = reader.get_next_frame()
+    for _ in range(server.slot_count):
+        server.publish(server.capture_device.get_next_frame())
+    numpy.testing.assert_array_equal(frame.image, image(1))
+    del frame
+    reader.stop()
+
+
+def test_slot_being_written_is_not_read(server, reader):
+    latest = server.ring.latest
+    sequences = server.ring.sequences[latest % server.slot_count]
+    sequences[0] = latest + server.slot_count  # the server started overwriting the slot
+    assert reader._read(latest) is None
+    sequences[0] = latest
+    assert reader._read(latest).sequence == 1
+
+
+def test_concurrent_frames_are_intact(server):
+    server.capture_device.interval = 0.0005
+    reader = SharedMemoryDevice(server.name, copy=True, timeout=1.0)
+    server.start()
+    sequences = []
+    for _ in range(200):
+        frame = reader.get_next_frame()
+        assert (frame.image == frame.sequence % 256).all()
+        assert frame.capture_time == pytest.approx(frame.sequence * 0.1)
+        sequences.append(frame.sequence)
+    assert sequences == sorted(set(sequences))
+    server.stop()
+    with pytest.raises(FrameBusError, match="stopped"):
+        for _ in range(server.slot_count):  # frames published meanwhile are read first
+            reader.get_next_frame()
+    reader.stop()
+    assert server.capture_device.is_stopped
+
+
+def test_no_server():
+    with pytest.raises(FrameBusError):
+        SharedMemoryDevice(f"td2d_test_{uuid.uuid4().hex[:12]}")
@@ -0,0 +1,62 @@
+import cv2
+import numpy
+import pytest
+
+from td2d.frame_gate import FrameGate
+
+
+def scene(tile_x=100, noise=0, seed=0):
+    """A 1600 x 1200 tray of tiles, with one 40 x 40 tile at tile_x"""
+    image = numpy.full((1200, 1600), 40, dtype=numpy.uint8)
+    for y in range(100, 1100, 200):
+        for x in range(500, 1500, 200):
+            cv2.rectangle(image, (x, y), (x + 119, y + 119), 200, cv2.FILLED)
+    cv2.rectangle(image, (tile_x, 600), (tile_x + 39, 639), 220, cv2.FILLED)
+    if noise:
+        random = numpy.random.default_rng(seed)
+        image = cv2.add(image, random.integers(0, noise, image.shape, dtype=numpy.uint8))
+    return image
+
+
+@pytest.fixture
+def gate():
+    gate = FrameGate()
+    assert gate.check(scene())
+    return gate
+
+
+def test_static_frames_are_skipped(gate):
+    assert not any(gate.check(scene(noise=4, seed=seed)) for seed in range(5))
+    assert gate.static_frames == 5
+
+
+def test_single_moving_tile_passes(gate):
+    # a tile moving by half its size changes a tiny fraction of the frame, averaging over the whole frame hid it
+    assert gate.check(scene(tile_x=120))
+    assert gate.check(scene(tile_x=140))
+    assert gate.static_frames == 0
+
+
+def test_slow_drift_passes_eventually(gate):
+    passed = [gate.check(scene(tile_x=100 + shift)) for shift in range(1, 40)]
+    assert not all(passed)
+    assert any(passed)
+
+
+def test_blurred_frames_are_skipped(gate):
+    blurred = cv2.blur(scene(tile_x=300), (25, 25))
+    assert not gate.check(blurred)
+    assert gate.blurred_frames == 1
+    assert gate.check(scene(tile_x=300))
+
+
+def test_reset_lets_the_next_frame_pass(gate):
+    assert not gate.check(scene())
+    gate.reset()
+    assert gate.check(scene())
+
+
+def test_color_frames(gate):
+    color = cv2.cvtColor(scene(), cv2.COLOR_GRAY2BGR)
+    assert not gate.check(color)
+    assert gate.check(cv2.cvtColor(scene(tile_x=140), cv2.COLOR_GRAY2BGR))
@@ -0,0 +1,59 @@
+import time
+from threading import Event
+from threading import Timer
+
+import numpy
+
+from td2d.device import Frame
+from td2d.frame_pool import OrderedFramePool
+
+
+def frame(sequence):
+    return Frame(numpy.full((4, 4), sequence, dtype=numpy.uint8), sequence, sequence * 0.1, sequence * 0.1 + 0.01)
+
+
+def slow_on_even(image, offset):
+    # even frames take longer, so that later frames complete first
+    sequence = int(image[0, 0])
+    time.sleep(0.02 if sequence % 2 == 0 else 0.001)
+    return sequence + offset
+
+
+def test_results_in_frame_order():
+    pool = OrderedFramePool(slow_on_even, workers=4)
+    results = []
+    for sequence in range(40):
+        result = pool.submit(frame(sequence), 1000)
+        if result is not None:
+            results.append(result)
+    pool.shutdown()
+
+    sequences = [frame.sequence for frame, _ in results]
+    assert sequences == sorted(set(sequences))
+    assert all(value == frame.sequence + 1000 for frame, value in results)
+    assert all(frame.capture_time == frame.sequence * 0.1 for frame, _ in results)
+    assert len(results) + pool.skipped_results <= 40
+
+
+def test_waits_for_the_oldest_frame_once_max_pending_are_in_flight():
+    released = Event()
+    pool = OrderedFramePool(lambda image: released.wait(1.0), workers=2, max_pending=2)
+    assert pool.submit(frame(0)) is None
+    assert pool.submit(frame(1)) is None
+    Timer(0.05, released.set).start()
+    started = time.perf_counter()
+    done, _ = pool.submit(frame(2))
+    assert time.perf_counter() - started >= 0.04
+    assert len(pool._pending) + done.sequence == 2  # results completed meanwhile are returned as well
+    pool.shutdown()
+
+
+def test_images_are_copied():
+    pool = OrderedFramePool(slow_on_even, workers=1)
+    reused = frame(2)
+    pool.submit(reused, 0)
+    reused.image[...] = 7  # the capture device reuses its buffer for the next frame
+    time.sleep(0.05)
+    done, value = pool.submit(frame(3), 0)
+    assert (done.sequence, value) == (2, 2)
+    pool.shutdown()
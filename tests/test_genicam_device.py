@@ -0,0 +1,248 @@
+import time
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+from td2d import genicam_device
+from td2d.calibration import SensorWindow
+from td2d.genicam_device import GenTlDevice
+from td2d.genicam_device import GenTlDeviceError
+from td2d.genicam_device import GenTlDeviceManager
+
+SENSOR = (64, 48)
+
+
+class FakeNode:
+    def __init__(self, value, minimum=0, maximum=10**6, inc=1):
+        self.value = value
+        self.min = minimum
+        self._max = maximum
+        self.inc = inc
+
+    @property
+    def max(self):
+        return self._max() if callable(self._max) else self._max
+
+
+class FakeNodeMap:
+    """A camera left binned, windowed and in Mono8 by a previous process"""
+
+    def __init__(self):
+        self.BinningHorizontal = FakeNode(2, 1, 4)
+        self.BinningVertical = FakeNode(2, 1, 4)
+        self.OffsetX = FakeNode(8, 0, SENSOR[0], 2)
+        self.OffsetY = FakeNode(4, 0, SENSOR[1], 2)
+        self.Width = FakeNode(16, 8, lambda: SENSOR[0] // self.BinningHorizontal.value - self.OffsetX.value, 8)
+        self.Height = FakeNode(12, 4, lambda: SENSOR[1] // self.BinningVertical.value - self.OffsetY.value, 4)
+        self.WidthMax = FakeNode(SENSOR[0])
+        self.HeightMax = FakeNode(SENSOR[1])
+        self.PixelFormat = FakeNode("Mono8")
+
+
+class FakeBuffer:
+    def __init__(self, acquirer, frame_id, timestamps):
+        nodes = acquirer.remote_device.node_map
+        width, height = nodes.Width.value, nodes.Height.value
+        component = SimpleNamespace(
+            data=numpy.full(width * height, frame_id % 256, numpy.uint8),
+            width=width,
+            height=height,
+            num_components_per_pixel=1,
+        )
+        self.payload = SimpleNamespace(components=[component])
+        self.frame_id = frame_id
+        for name, value in timestamps(frame_id).items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # like GenTL producers, which raise for the buffer infos they don't provide
+        raise RuntimeError(f"{name} not available")
+
+    def queue(self):
+        pass
+
+
+class FakeAcquirer:
+    def __init__(self, harvester, serial_number):
+        self.harvester = harvester
+        self.serial_number = serial_number
+        self.remote_device = SimpleNamespace(node_map=FakeNodeMap())
+        self.frames = 0
+        self.is_valid = True
+        self.is_started = False
+
+    def start(self, run_as_thread=False):
+        self.is_started = True
+
+    def stop(self):
+        self.is_started = False
+
+    def destroy(self):
+        self.is_valid = False
+
+    def fetch(self, timeout=None):
+        if not self.is_valid:
+            raise RuntimeError("invalidated")
+        if self.harvester.cameras[self.serial_number] != "streaming":
+            time.sleep(timeout or 0)
+            raise RuntimeError("timeout")
+        self.frames += 1
+        return FakeBuffer(self, self.frames, self.harvester.timestamps)
+
+
+class FakeHarvester:
+    """One GenTL producer with cameras "A" and "B", which are either streaming, silent or gone.
+
+    Replugged cameras can only be opened once the producer enumerated them again.
+    """
+
+    instances = []
+
+    def __init__(self):
+        self.cameras = {"A": "streaming", "B": "streaming"}
+        self.timestamps = lambda frame_id: {"timestamp_ns": frame_id * 10**7}
+        self.device_info_list = []
+        self.acquirers = []
+        self.replugged = set()
+        self.updates = 0
+        FakeHarvester.instances.append(self)
+
+    def add_file(self, path):
+        pass
+
+    def update(self):
+        for acquirer in self.acquirers:
+            acquirer.destroy()  # like Harvester.update, which invalidates all image acquirers
+        self.acquirers = []
+        self.replugged.clear()
+        self.updates += 1
+        self.device_info_list = [
+            SimpleNamespace(model="Cam", serial_number=serial)
+            for serial, state in self.cameras.items()
+            if state != "gone"
+        ]
+
+    def create(self, search_key):
+        serial_number = search_key["serial_number"]
+        if self.cameras.get(serial_number) == "gone" or serial_number in self.replugged:
+            raise ValueError("not found")
+        acquirer = FakeAcquirer(self, serial_number)
+        self.acquirers.append(acquirer)
+        return acquirer
+
+    def reset(self):
+        self.device_info_list = []
+
+
+@pytest.fixture
+def harvester(monkeypatch):
+    monkeypatch.setattr(genicam_device, "Harvester", FakeHarvester)
+    monkeypatch.setattr(GenTlDeviceManager, "_managers", {})
+    monkeypatch.setattr(FakeHarvester, "instances", [])
+    yield lambda: FakeHarvester.instances[0]
+
+
+def wait_for_fresh_frame(device, timeout=2.0):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        frame = device.get_next_frame()
+        if not frame.is_stale:
+            return frame
+    raise AssertionError("device was not reopened")
+
+
+def test_devices_share_one_harvester(harvester):
+    a = GenTlDevice("Cam", "producer.cti", serial_number="A")
+    b = GenTlDevice("Cam", "producer.cti", serial_number="B")
+    assert a.harvester is b.harvester
+    assert len(FakeHarvester.instances) == 1
+    assert harvester().updates == 1
+    a.stop()
+    b.stop()
+
+
+def test_full_sensor_restored_on_open(harvester):
+    device = GenTlDevice("Cam", "producer.cti", serial_number="A")
+    nodes = device.device.remote_device.node_map
+    assert (nodes.BinningHorizontal.value, nodes.OffsetX.value, nodes.OffsetY.value) == (1, 0, 0)
+    assert (nodes.Width.value, nodes.Height.value) == SENSOR
+    assert nodes.PixelFormat.value == GenTlDevice.DEFAULT_PIXEL_FORMAT
+    assert device.get_next_image().shape == SENSOR[::-1]
+    device.stop()
+
+
+def test_full_sensor_restored_on_stop(harvester):
+    device = GenTlDevice("Cam", "producer.cti", serial_number="A", sensor_window=SensorWindow(16, 8, 32, 16, 2))
+    acquirer = device.device
+    nodes = acquirer.remote_device.node_map
+    assert device.sensor_window == SensorWindow(16, 8, 32, 16, 2)
+    assert (nodes.Width.value, nodes.Height.value) == (16, 8)
+    device.stop()
+    assert not acquirer.is_valid
+    assert (nodes.BinningHorizontal.value, nodes.Width.value, nodes.Height.value) == (1,) + SENSOR
+
+
+@pytest.mark.parametrize(
+    "timestamps, interval",
+    [
+        (lambda frame_id: {"timestamp_ns": frame_id * 1000}, 1e-6),
+        (lambda frame_id: {"timestamp": frame_id * 2, "timestamp_frequency": 10**6}, 2e-6),
+    ],
+)
+def test_capture_time_from_device_timestamps(harvester, timestamps, interval):
+    # the device clock runs slower than the host's here, so the first frame is the one arriving fastest
+    device = GenTlDevice("Cam", "producer.cti", serial_number="A")
+    harvester().timestamps = timestamps
+    first, second = device.get_next_frame(), device.get_next_frame()
+    assert first.capture_time == first.receive_time
+    assert second.capture_time - first.capture_time == pytest.approx(interval, abs=1e-12)
+    device.stop()
+
+
+def test_capture_time_without_device_timestamps(harvester):
+    device = GenTlDevice("Cam", "producer.cti", serial_number="A")
+    harvester().timestamps = lambda frame_id: {}
+    frames = [device.get_next_frame() for _ in range(3)]
+    assert all(frame.capture_time == frame.receive_time for frame in frames)
+    device.stop()
+
+
+def test_silent_reopened_device_returns_stale_frames(harvester):
+    # a reopened camera which doesn't deliver either must stall again, not recurse
+    device = GenTlDevice("Cam", "producer.cti", serial_number="A", fetch_timeout=0.01, reconnect_interval=0.01)
+    last = device.get_next_frame()
+    harvester().cameras["A"] = "silent"
+    frames = [device.get_next_frame() for _ in range(50)]
+    assert all(frame.is_stale and frame.sequence == last.sequence for frame in frames)
+    assert device.stalls > 1
+    harvester().cameras["A"] = "streaming"
+    assert not wait_for_fresh_frame(device).is_stale
+    device.stop()
+
+
+def test_reenumeration_waits_for_other_devices(harvester):
+    # enumerating again invalidates all open devices, the producer must neither be enumerated while B is open
+    # nor be opened a second time
+    a = GenTlDevice("Cam", "producer.cti", serial_number="A", fetch_timeout=0.01, reconnect_interval=0.01)
+    b = GenTlDevice("Cam", "producer.cti", serial_number="B")
+    a.get_next_frame()
+    harvester().cameras["A"] = "gone"
+    harvester().replugged.add("A")
+    for _ in range(20):
+        assert a.get_next_frame().is_stale
+    assert b.get_next_frame().sequence == 1
+    assert b.get_next_frame().sequence == 2
+    assert harvester().updates == 1
+
+    harvester().cameras["A"] = "streaming"
+    for _ in range(20):
+        assert a.get_next_frame().is_stale
+    with pytest.raises(GenTlDeviceError, match="Waiting for 1 open devices"):
+        a.manager.open("Cam", "A")
+    assert harvester().updates == 1
+    b.stop()
+    assert not wait_for_fresh_frame(a).is_stale
+    assert harvester().updates == 2
+    assert len(FakeHarvester.instances) == 1
+    a.stop()
@@ -0,0 +1,68 @@
+import numpy
+import pytest
+
+from td2d.tile_index import TileIndex
+
+
+def square(x, y, size=10.0):
+    return numpy.array([[x, y], [x + size, y], [x + size, y + size], [x, y + size]])
+
+
+@pytest.fixture
+def index():
+    # a 4 x 3 grid of tiles with 5 units gaps, plus a rotated one overlapping tile 0
+    polygons = [square(x * 15.0, y * 15.0) for y in range(3) for x in range(4)]
+    polygons.append(numpy.array([[5.0, -2.0], [12.0, 5.0], [5.0, 12.0], [-2.0, 5.0]]))
+    return TileIndex.from_polygons(polygons)
+
+
+def brute_force_boxes(index, box):
+    xmin, ymin, xmax, ymax = box
+    tiles = index.boxes
+    overlaps = (tiles[:, 0] <= xmax) & (tiles[:, 2] >= xmin) & (tiles[:, 1] <= ymax) & (tiles[:, 3] >= ymin)
+    return numpy.flatnonzero(overlaps)
+
+
+def test_query_points(index):
+    points = [[5.0, 5.0], [20.0, 5.0], [52.0, 37.0], [12.5, 5.0], [100.0, 100.0], [-1.0, 5.0], [11.0, 5.0]]
+    numpy.testing.assert_array_equal(index.query_points(points), [0, 1, 11, -1, -1, 12, 12])
+    assert index.query_point(20.0, 20.0) == 5
+    assert index.query_point(-50.0, 0.0) == -1
+
+
+def test_query_boxes(index):
+    boxes = [(0.0, 0.0, 1.0, 1.0), (12.0, 12.0, 16.0, 16.0), (-100.0, -100.0, -50.0, -50.0), (-5.0, -5.0, 70.0, 70.0)]
+    results = index.query_boxes(boxes)
+    assert len(results) == len(boxes)
+    for box, result in zip(boxes, results):
+        numpy.testing.assert_array_equal(numpy.sort(result), brute_force_boxes(index, box))
+    numpy.testing.assert_array_equal(index.query_box(12.0, 12.0, 16.0, 16.0), [5, 12])
+
+
+def test_query_no_boxes(index):
+    assert index.query_boxes(numpy.zeros((0, 4))) == []
+
+
+def test_random_queries_match_brute_force(index):
+    random = numpy.random.default_rng(0)
+    corners = random.uniform(-10, 70, (200, 4))
+    boxes = numpy.hstack((numpy.minimum(corners[:, :2], corners[:, 2:]), numpy.maximum(corners[:, :2], corners[:, 2:])))
+    for box, result in zip(boxes, index.query_boxes(boxes)):
+        numpy.testing.assert_array_equal(numpy.sort(result), brute_force_boxes(index, box))
+
+
+def test_empty_index():
+    index = TileIndex.from_polygons([])
+    assert len(index) == 0
+    numpy.testing.assert_array_equal(index.query_points([[0.0, 0.0]]), [-1])
+    assert len(index.query_box(0.0, 0.0, 1.0, 1.0)) == 0
+
+
+def test_save_and_load(index, tmp_path):
+    path = str(tmp_path / "tiles.npz")
+    index.save(path)
+    loaded = TileIndex.load(path)
+    assert len(loaded) == len(index)
+    assert loaded.grid_shape == index.grid_shape
+    points = [[5.0, 5.0], [20.0, 5.0], [12.5, 5.0]]
+    numpy.testing.assert_array_equal(loaded.query_points(points), index.query_points(points))
@@ -0,0 +1,76 @@
+import numpy
+import pytest
+
+from td2d.tile_layout import TileLayout
+
+L_SHAPE = numpy.array([[0, 0], [60, 0], [60, 20], [20, 20], [20, 60], [0, 60]], dtype=numpy.float64)
+
+
+def contour(points, offset=(0.0, 0.0)):
+    return (numpy.asarray(points, dtype=numpy.float64) + offset).astype(numpy.float32).reshape(-1, 1, 2)
+
+
+def square(x, y, size=40.0):
+    return numpy.array([[x, y], [x + size, y], [x + size, y + size], [x, y + size]])
+
+
+def test_identical_detections_are_one_tile():
+    layout = TileLayout()
+    assert layout.merge([contour(square(0, 0)), contour(square(100, 0))]) == 2
+    assert layout.merge([contour(square(100, 0)), contour(square(0, 0))]) == 0
+    assert len(layout) == 2
+    numpy.testing.assert_allclose(layout.tiles[0].vertices, square(0, 0))
+    assert layout.tiles[0].count == 2
+
+
+def test_detections_are_averaged_vertex_by_vertex():
+    layout = TileLayout()
+    layout.merge([contour(L_SHAPE)])
+    layout.merge([contour(L_SHAPE, (2.0, 1.0))])
+    numpy.testing.assert_allclose(layout.tiles[0].vertices, L_SHAPE + (1.0, 0.5), atol=1e-9)
+    numpy.testing.assert_allclose(layout.outlines(hull=False)[0].reshape(-1, 2), L_SHAPE + (1.0, 0.5), atol=1e-5)
+
+
+def test_corners_stay_sharp():
+    # detections with differing vertices along the edges, e.g. of CHAIN_APPROX_NONE contours, mustn't round corners
+    layout = TileLayout()
+    random = numpy.random.default_rng(0)
+    for _ in range(8):
+        edges = numpy.linspace(0.0, 40.0, int(random.integers(3, 9)))[:-1]
+        points = numpy.concatenate(
+            [
+                numpy.column_stack((edges, numpy.zeros_like(edges))),
+                numpy.column_stack((numpy.full_like(edges, 40.0), edges)),
+                numpy.column_stack((40.0 - edges, numpy.full_like(edges, 40.0))),
+                numpy.column_stack((numpy.zeros_like(edges), 40.0 - edges)),
+            ]
+        )
+        layout.merge([contour(points + random.normal(0.0, 0.3, points.shape))])
+    assert len(layout) == 1
+    corners = layout.tiles[0].outline(tolerance=2.0).reshape(-1, 2)
+    assert len(corners) == 4
+    distances = numpy.linalg.norm(corners[:, None, :] - square(0, 0)[None, :, :], axis=2).min(axis=0)
+    assert distances.max() < 1.0
+
+
+def test_overlapping_but_different_tiles_are_kept_apart():
+    layout = TileLayout(min_iou=0.5)
+    layout.merge([contour(square(0, 0))])
+    assert layout.merge([contour(square(25, 0))]) == 1
+    assert len(layout) == 2
+
+
+def test_tiles_are_dirty_once_they_drifted():
+    layout = TileLayout(change_tolerance=1.0)
+    layout.merge([contour(square(0, 0))])
+    tile = layout.tiles[0]
+    assert tile.is_dirty
+    tile.set_mesh("mesh")
+    assert not tile.is_dirty and tile.drift() == 0
+
+    # slow drifts add up, measured against the meshed outline rather than the previous merge
+    changed = [layout.merge([contour(square(0, 0), (shift, 0.0))]) for shift in (1.0, 1.5, 2.0, 2.5)]
+    assert changed[0] == 0
+    assert sum(changed) == 1
+    assert tile.is_dirty
+    assert tile.drift() == pytest.approx(float(numpy.linalg.norm(tile.vertices - square(0, 0), axis=1).max()))
@@ -0,0 +1,36 @@
+import cv2
+import numpy
+
+from td2d.tile_mesh_finder import TileFinder
+
+
+def tray_image():
+    """Bright tiles with a gray inlaid frame and plain gray tiles on a black background, slightly blurred"""
+    image = numpy.zeros((400, 600), dtype=numpy.uint8)
+    for y in range(20, 320, 100):
+        for x in range(20, 320, 100):
+            cv2.rectangle(image, (x, y), (x + 79, y + 79), 220, cv2.FILLED)
+            cv2.rectangle(image, (x + 10, y + 10), (x + 69, y + 69), 100, cv2.FILLED)
+            cv2.rectangle(image, (x + 18, y + 18), (x + 61, y + 61), 220, cv2.FILLED)
+    for y in range(20, 320, 100):
+        cv2.rectangle(image, (420, y), (479, y + 59), 100, cv2.FILLED)
+    return cv2.GaussianBlur(image, (5, 5), 0)
+
+
+def test_tiles_in_bands_are_found_once():
+    # the frames and centers of the bright tiles are nested in the tiles' regions, they must not be taken for tiles
+    tiles = TileFinder.find_tiles_in_bands(tray_image(), (45, 150), 1000, 10000)
+    boxes = sorted(cv2.boundingRect(tile) for tile in tiles)
+    assert len(boxes) == 9 + 3
+    centers = numpy.array([(x + w / 2, y + h / 2) for x, y, w, h in boxes])
+    distances = numpy.linalg.norm(centers[:, None, :] - centers[None, :, :], axis=2)
+    assert distances[numpy.triu_indices(len(centers), 1)].min() > 50
+    assert min(w for _, _, w, _ in boxes) >= 60
+
+
+def test_bands_match_thresholding_each_kind_of_tile():
+    image = tray_image()
+    bright = TileFinder.find_tiles(image, 150, 1000, 10000, cv2.RETR_EXTERNAL)
+    tiles = TileFinder.find_tiles_in_bands(image, (45, 150), 1000, 10000)
+    bright_boxes = {cv2.boundingRect(tile) for tile in bright}
+    assert bright_boxes <= {cv2.boundingRect(tile) for tile in tiles}
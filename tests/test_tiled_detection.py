@@ -0,0 +1,57 @@
+import cv2
+import numpy
+import pytest
+
+from td2d.tiled_detection import TiledTileDetector
+
+THRESHOLD = 100
+MIN_AREA = 200
+MAX_AREA = 3000
+
+
+def tray_image():
+    """Bright tiles on a black background on the left, dark tiles in a gray tray on the right, many on strip borders"""
+    image = numpy.zeros((700, 600), dtype=numpy.uint8)
+    image[20:680, 320:590] = 150
+    random = numpy.random.default_rng(1)
+    for row in range(11):
+        for column in range(4):
+            x, y = 20 + column * 70, 15 + row * 60 + int(random.integers(0, 15))
+            cv2.rectangle(image, (x, y), (x + 29 + row, y + 39), 220, cv2.FILLED)
+            x = 340 + column * 60
+            cv2.rectangle(image, (x, y + 5), (x + 34, y + 44), 20, cv2.FILLED)
+    return image
+
+
+def boxes(tiles):
+    return sorted(cv2.boundingRect(tile) for tile in tiles)
+
+
+@pytest.fixture(scope="module")
+def image():
+    return tray_image()
+
+
+@pytest.fixture(scope="module")
+def single_pass(image):
+    detector = TiledTileDetector(THRESHOLD, MIN_AREA, MAX_AREA, strip_height=image.shape[0], workers=1)
+    return boxes(detector.find_tiles(image))
+
+
+def test_single_pass_finds_bright_and_dark_tiles(single_pass):
+    assert len(single_pass) == 2 * 44
+    assert len(set(single_pass)) == len(single_pass)
+
+
+@pytest.mark.parametrize("strip_height, overlap", [(64, None), (64, 10), (100, 0), (37, 20), (256, 10)])
+def test_strips_find_the_same_tiles(image, single_pass, strip_height, overlap):
+    # with overlaps smaller than a tile, tiles are cut by strip borders and detected again on windows
+    detector = TiledTileDetector(THRESHOLD, MIN_AREA, MAX_AREA, strip_height=strip_height, overlap=overlap, workers=3)
+    assert boxes(detector.find_tiles(image)) == single_pass
+
+
+def test_color_and_memory_mapped_images(image, single_pass, tmp_path):
+    path = str(tmp_path / "tray.npy")
+    numpy.save(path, cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+    detector = TiledTileDetector(THRESHOLD, MIN_AREA, MAX_AREA, strip_height=64, overlap=10, workers=2)
+    assert boxes(detector.find_tiles(numpy.load(path, mmap_mode="r"))) == single_pass